@@ -0,0 +1,10 @@
+'''
+Benchmarks of the Python layer of the BioSIM web API. They run against the simulation backend so that
+they can be carried out on any platform. This package is not distributed with the biosim package.
+
+@author: M. Fortin and R. Saint-Amant, Canadian Forest Service, August 2020
+@copyright: Her Majesty the Queen in right of Canada
+'''
+import os
+
+os.environ.setdefault("BIOSIM_BACKEND", "simulator")
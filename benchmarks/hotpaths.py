@@ -0,0 +1,251 @@
+'''
+Microbenchmarks of the hot paths of the Python layer: the parsing, merging and serialization of the
+TeleIODict instances, the conversions, the registration in the wgout library under contention and the
+parsing of the requests.
+
+Usage from the root of the repository:
+    python -m benchmarks.hotpaths                                   ### run the quick scenarios
+    python -m benchmarks.hotpaths --full                            ### add the largest payloads (150 years x 100 replications)
+    python -m benchmarks.hotpaths --output benchmarks/baselines/1.0.7.json
+    python -m benchmarks.hotpaths --compare benchmarks/baselines/1.0.7.json --tolerance .25
+
+A baseline is a JSON file produced with the --output option. The comparison reports the ratio of the
+median times and the exit code is 1 if one of the benchmarks is slower than the baseline by more than
+the tolerance. The baselines are only comparable on the same hardware.
+
+@author: M. Fortin and R. Saint-Amant, Canadian Forest Service, August 2020
+@copyright: Her Majesty the Queen in right of Canada
+'''
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from benchmarks.payloads import createWeatherText, createModelText, createNormalsText, createTeleIO
+from biosim.bsrequest import WeatherGeneratorRequest, NormalsRequest
+from biosim.bssettings import Context, Shore, Normals, Daily, DEM, Gribs
+from biosim.bsstore import SQLiteWgoutStore
+from biosim.bsutility import BioSimUtility, TeleIODict, TeleIODictList, WgoutLibrary
+
+
+### name -> (number of years, number of replications, hourly)
+QuickScenarios = {"1y1r" : (1, 1, False),
+                  "30y10r" : (30, 10, False),
+                  "150y1r" : (150, 1, False),
+                  "10y100r" : (10, 100, False),
+                  "hourly1y10r" : (1, 10, True)}
+FullScenarios = {"150y100r" : (150, 100, False)}
+
+FinalDateYr = 2021
+
+
+class Benchmark():
+    '''
+    A benchmark is a function timed on the arguments returned by a setup function. The setup is called before
+    each call and it is not timed so that the functions that modify their arguments can be benchmarked as well.
+    '''
+
+    def __init__(self, name : str, function, setup = None):
+        self.name = name
+        self.function = function
+        self.setup = setup
+
+    def run(self, minTimeSec : float, nbRepeats : int, maxCalls = 1000):
+        '''
+        Call the function repeatedly for at least minTimeSec in each repeat.
+        @return: a dict with the median and minimum time per call in seconds and the number of calls
+        '''
+        timings = list()
+        for repeat in range(nbRepeats):
+            elapsed = 0
+            nbCalls = 0
+            while (elapsed < minTimeSec and nbCalls < maxCalls) or nbCalls == 0:
+                args = self.setup() if self.setup is not None else ()
+                start = time.perf_counter()
+                self.function(*args)
+                elapsed += time.perf_counter() - start
+                nbCalls += 1
+            timings.append(elapsed / nbCalls)
+        return {"medianSec" : statistics.median(timings),
+                "minSec" : min(timings),
+                "nbCalls" : nbCalls * nbRepeats}
+
+
+def createTeleIODictBenchmarks(scenario : str, nbYears : int, nbReplications : int, hourly : bool):
+    weatherText = createWeatherText(nbYears, nbReplications, hourly)
+    formerWeatherText = createWeatherText(nbYears, nbReplications, hourly, firstYear = FinalDateYr - 2 * nbYears + 1, seed = 2)
+    weatherTeleIO = createTeleIO(weatherText)
+    teleIODict = TeleIODict(weatherTeleIO, FinalDateYr)
+    formerTeleIODict = TeleIODict(createTeleIO(formerWeatherText), FinalDateYr - nbYears)
+    modelTeleIODict = TeleIODict(createTeleIO(createModelText(nbYears, nbReplications)), FinalDateYr, False)
+    modelTeleIODictList = TeleIODictList()
+    modelTeleIODictList.append(modelTeleIODict)
+    return [Benchmark("TeleIODict.__parseText__[" + scenario + "]", lambda: TeleIODict(weatherTeleIO, FinalDateYr)),
+            Benchmark("TeleIODict.__merge__[" + scenario + "]", lambda former, latter: former.__merge__(latter),
+                      lambda: (formerTeleIODict.clone(), teleIODict)),
+            Benchmark("TeleIODict.__getText__[" + scenario + "]", lambda: teleIODict.__getText__()),
+            Benchmark("TeleIODict.getTeleIO[" + scenario + "]", lambda: teleIODict.getTeleIO()),
+            Benchmark("TeleIODict.clone[" + scenario + "]", lambda: teleIODict.clone()),
+            Benchmark("TeleIODictList.getOutputText[" + scenario + "]", lambda: modelTeleIODictList.getOutputText()),
+            Benchmark("TeleIODictList.parseToJSON[" + scenario + "]", lambda: modelTeleIODictList.parseToJSON())]
+
+
+def createConversionBenchmarks():
+    normalsText = createNormalsText()
+    return [Benchmark("BioSimUtility.convertTeleIOTextToList[normals]", lambda: BioSimUtility.convertTeleIOTextToList(normalsText))]
+
+
+def createRegistrationBenchmarks(nbThreads : int):
+    '''
+    Each thread registers 10 locations of 30 years and 10 replications at the same time as the others. The
+    registration is measured in an empty library and in a library already filled up to its maximum number of
+    entries, whose cost should not depend on the number of entries.
+    '''
+    teleIODict = TeleIODict(createTeleIO(createWeatherText(30, 10)), FinalDateYr)
+    executor = ThreadPoolExecutor(max_workers = nbThreads)
+    directory = tempfile.mkdtemp(prefix = "biosim-benchmarks-")
+
+    def registerConcurrently(library):
+        BioSimUtility.library = library
+        teleIODictList = TeleIODictList()
+        teleIODictList += [teleIODict] * 10
+        futures = [executor.submit(teleIODictList.registerTeleIODictList, "benchmark") for i in range(nbThreads)]
+        for future in futures:
+            future.result()
+
+    filledLibraries = list()
+
+    def getFilledLibrary():
+        if len(filledLibraries) == 0:    ### filled once since the registrations then evict as many entries as they add
+            library = WgoutLibrary(4 * 1024 ** 3, 100000)
+            for i in range(100000):
+                library.put("filled" + str(i), teleIODict)
+            filledLibraries.append(library)
+        return (filledLibraries[0],)
+
+    def createSQLiteStore():
+        filename = os.path.join(directory, "wgout" + str(time.perf_counter_ns()) + ".sqlite")
+        return (SQLiteWgoutStore(filename, 4 * 1024 ** 3, 100000),)
+
+    suffix = "[" + str(nbThreads) + " threads]"
+    return [Benchmark("TeleIODictList.registerTeleIODictList[memory]" + suffix, registerConcurrently,
+                      lambda: (WgoutLibrary(4 * 1024 ** 3, 100000),)),
+            Benchmark("TeleIODictList.registerTeleIODictList[memory, 100000 entries]" + suffix, registerConcurrently, getFilledLibrary),
+            Benchmark("TeleIODictList.registerTeleIODictList[sqlite]" + suffix, registerConcurrently, createSQLiteStore)]
+
+
+def createRequestBenchmarks():
+    context = Context(Shore.Shore1, Normals.CanUSA1981_2010, Daily.CanUSA1980_2020, DEM.WorldWide30sec, Gribs.HRDPS_daily)
+    rng = np.random.default_rng(1)
+    wgParms = {"lat" : " ".join(["%.4f" % v for v in rng.uniform(45, 50, 10)]),
+               "long" : " ".join(["%.4f" % v for v in rng.uniform(-75, -70, 10)]),
+               "from" : "2000",
+               "to" : "2020"}
+    normalsParms = {"lat" : " ".join(["%.4f" % v for v in rng.uniform(45, 50, 50)]),
+                    "long" : " ".join(["%.4f" % v for v in rng.uniform(-75, -70, 50)]),
+                    "elev" : " ".join(["%.0f" % v for v in rng.uniform(0, 1000, 50)]),
+                    "period" : "1981_2010"}
+
+    def parseWeatherGeneratorRequest():
+        bioSimRequest = WeatherGeneratorRequest(dict(wgParms))
+        bioSimRequest.doesThisContextMatch(context)
+        return [bioSimRequest.parseRequest(i, context) for i in range(bioSimRequest.n)]
+
+    def parseNormalsRequest():
+        bioSimRequest = NormalsRequest(dict(normalsParms))
+        return [bioSimRequest.parseRequest(i, context) for i in range(bioSimRequest.n)]
+
+    return [Benchmark("WeatherGeneratorRequest[10 locations]", parseWeatherGeneratorRequest),
+            Benchmark("NormalsRequest[50 locations]", parseNormalsRequest)]
+
+
+def createBenchmarks(full : bool, nbThreads : int):
+    scenarios = dict(QuickScenarios)
+    if full:
+        scenarios.update(FullScenarios)
+    benchmarks = list()
+    for scenario, (nbYears, nbReplications, hourly) in scenarios.items():
+        benchmarks += createTeleIODictBenchmarks(scenario, nbYears, nbReplications, hourly)
+    benchmarks += createConversionBenchmarks()
+    benchmarks += createRegistrationBenchmarks(nbThreads)
+    benchmarks += createRequestBenchmarks()
+    return benchmarks
+
+
+def getMetadata():
+    return {"date" : time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python" : platform.python_version(),
+            "platform" : platform.platform(),
+            "processor" : platform.processor(),
+            "cpuCount" : os.cpu_count(),
+            "numpy" : np.__version__}
+
+
+def compare(results : dict, baseline : dict, tolerance : float):
+    '''
+    Print the ratio of the median times to those of the baseline.
+    @return: the names of the benchmarks that regressed beyond the tolerance
+    '''
+    regressions = list()
+    for name, result in results.items():
+        reference = baseline["benchmarks"].get(name)
+        if reference is None:
+            print("%-70s %12s" % (name, "new"))
+            continue
+        ratio = result["medianSec"] / reference["medianSec"]
+        flag = ""
+        if ratio > 1 + tolerance:
+            flag = " REGRESSION"
+            regressions.append(name)
+        print("%-70s %11.2fx%s" % (name, ratio, flag))
+    return regressions
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Microbenchmarks of the Python hot paths of the BioSIM web API")
+    parser.add_argument("--full", action = "store_true", help = "include the largest payloads")
+    parser.add_argument("--filter", default = None, help = "run only the benchmarks whose name contains this string")
+    parser.add_argument("--threads", type = int, default = 8, help = "number of threads registering concurrently")
+    parser.add_argument("--min-time", type = float, default = .2, help = "minimum time per repeat in seconds")
+    parser.add_argument("--repeats", type = int, default = 5, help = "number of repeats")
+    parser.add_argument("--output", default = None, help = "save the results as a JSON baseline in this file")
+    parser.add_argument("--compare", default = None, help = "compare the results to this JSON baseline")
+    parser.add_argument("--tolerance", type = float, default = .25, help = "relative slowdown beyond which a benchmark regresses")
+    args = parser.parse_args(argv)
+
+    results = dict()
+    for benchmark in createBenchmarks(args.full, args.threads):
+        if args.filter is not None and args.filter not in benchmark.name:
+            continue
+        result = benchmark.run(args.min_time, args.repeats)
+        results[benchmark.name] = result
+        print("%-70s %12.3f ms (min %.3f ms, %d calls)" % (benchmark.name, result["medianSec"] * 1000, result["minSec"] * 1000, result["nbCalls"]))
+
+    if args.output is not None:
+        directory = os.path.dirname(args.output)
+        if len(directory) > 0 and not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(args.output, "w") as f:
+            json.dump({"metadata" : getMetadata(), "benchmarks" : results}, f, indent = 2)
+        print("Results saved in " + args.output)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print("Comparison with " + args.compare + " (" + str(baseline["metadata"].get("date")) + ", " + str(baseline["metadata"].get("platform")) + ")")
+        regressions = compare(results, baseline, args.tolerance)
+        if len(regressions) > 0:
+            print(str(len(regressions)) + " benchmark(s) regressed beyond the tolerance of " + str(args.tolerance))
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,373 @@
+'''
+End-to-end load driver for the BioSIM web API. It sends a mix of requests to a running server or to a local
+server instance started in this process and reports the throughput, the latency percentiles and the error
+rate of each endpoint.
+
+The mix is either replayed from a JSONL request log or generated at random. Each record of a request log
+is a JSON object with either a "url" entry (the path and the query string) or an "endpoint" (or "path") entry
+and an optional "query" entry. The "method", "body" and "contentType" entries are optional. The slow request
+log of the server follows this format.
+
+Usage from the root of the repository:
+    python -m benchmarks.loaddriver --local --concurrency 16 --duration 60
+    python -m benchmarks.loaddriver --url http://localhost:5000 --rate 20 --requests 2000 --log requests.jsonl
+
+With a rate, the requests arrive at random (Poisson process) whether or not the former ones are completed and
+the latency includes the time a request waited for a free client. Without a rate, each client sends its next
+request as soon as it gets the response.
+
+@author: M. Fortin and R. Saint-Amant, Canadian Forest Service, August 2020
+@copyright: Her Majesty the Queen in right of Canada
+'''
+from queue import Queue, Empty
+from threading import Thread, Lock
+from urllib.error import HTTPError
+from urllib.parse import urlencode
+import argparse
+import json
+import os
+import random
+import sys
+import time
+import urllib.request
+
+import numpy as np
+
+
+DefaultMix = {"/BioSimNormals" : .4,
+              "/BioSimWG" : .2,
+              "/BioSimModel" : .2,
+              "/BioSimModelEphemeral" : .2}
+Models = ["DegreeDay_Annual", "DegreeDay_Monthly", "Climatic_Annual", "Climatic_Monthly"]
+Formats = ["CSV", "JSON"]
+
+
+class RequestSpec():
+
+    def __init__(self, endpoint : str, query = "", method = "GET", body = None, contentType = None):
+        self.endpoint = endpoint
+        self.query = query
+        self.method = method
+        self.body = body
+        self.contentType = contentType
+
+    def getUrl(self, baseUrl : str):
+        if len(self.query) > 0:
+            return baseUrl + self.endpoint + "?" + self.query
+        else:
+            return baseUrl + self.endpoint
+
+    @staticmethod
+    def fromRecord(record : dict):
+        if record.__contains__("url"):
+            url = record["url"]
+            endpoint, separator, query = url.partition("?")
+        else:
+            endpoint = record.get("endpoint", record.get("path"))
+            query = record.get("query", "")
+        if not endpoint.startswith("/"):
+            endpoint = "/" + endpoint
+        return RequestSpec(endpoint, query, record.get("method", "GET"), record.get("body"), record.get("contentType"))
+
+
+def getRandomLocations(rng : random.Random, n : int):
+    return {"lat" : " ".join(["%.4f" % rng.uniform(42, 52) for i in range(n)]),
+            "long" : " ".join(["%.4f" % rng.uniform(-80, -60) for i in range(n)])}
+
+
+class SyntheticMix():
+    '''
+    Generate requests at random according to the weights of the endpoints. The requests to /BioSimModel
+    refer to wgout instances registered by the driver beforehand.
+    '''
+
+    def __init__(self, weights : dict, seed : int, wgoutKeys : list):
+        self.endpoints = list(weights.keys())
+        self.weights = list(weights.values())
+        self.rng = random.Random(seed)
+        self.wgoutKeys = wgoutKeys
+        self.lock = Lock()
+
+    def next(self):
+        self.lock.acquire()
+        try:
+            endpoint = self.rng.choices(self.endpoints, self.weights)[0]
+            return RequestSpec(endpoint, urlencode(self.__createParameters__(endpoint)))
+        finally:
+            self.lock.release()
+
+    def __createParameters__(self, endpoint : str):
+        rng = self.rng
+        if endpoint == "/BioSimNormals":
+            parms = getRandomLocations(rng, rng.randint(1, 10))
+            parms["period"] = "1981_2010"
+        elif endpoint == "/BioSimWG":
+            parms = getRandomLocations(rng, rng.randint(1, 5))
+            parms["from"] = rng.randint(2010, 2020)
+            parms["to"] = parms["from"] + rng.randint(0, 5)
+        elif endpoint == "/BioSimModel":
+            n = min(len(self.wgoutKeys), rng.randint(1, 5))
+            parms = {"wgout" : " ".join(rng.sample(self.wgoutKeys, n)),
+                     "model" : rng.choice(Models),
+                     "format" : rng.choice(Formats)}
+        elif endpoint == "/BioSimModelEphemeral":
+            parms = getRandomLocations(rng, rng.randint(1, 5))
+            parms["from"] = rng.randint(2010, 2020)
+            parms["to"] = parms["from"] + rng.randint(0, 5)
+            parms["model"] = rng.choice(Models)
+            parms["format"] = rng.choice(Formats)
+        else:
+            raise Exception("The endpoint " + endpoint + " is not supported by the synthetic mix")
+        return parms
+
+
+class ReplayMix():
+    '''
+    Replay the requests of a JSONL log in a loop. The wgout references of the requests to /BioSimModel are
+    replaced by wgout instances registered by the driver since those of the log have most likely expired.
+    '''
+
+    def __init__(self, filename : str, wgoutKeys : list, refreshWgout : bool, seed : int):
+        self.specs = list()
+        with open(filename) as f:
+            for line in f:
+                if len(line.strip()) > 0:
+                    self.specs.append(RequestSpec.fromRecord(json.loads(line)))
+        if len(self.specs) == 0:
+            raise Exception("The request log " + filename + " is empty!")
+        self.wgoutKeys = wgoutKeys
+        self.refreshWgout = refreshWgout and len(wgoutKeys) > 0
+        self.rng = random.Random(seed)
+        self.index = 0
+        self.lock = Lock()
+
+    def next(self):
+        self.lock.acquire()
+        try:
+            spec = self.specs[self.index % len(self.specs)]
+            self.index += 1
+            if self.refreshWgout and spec.endpoint == "/BioSimModel" and "wgout=" in spec.query:
+                spec = self.__refreshWgout__(spec)
+            return spec
+        finally:
+            self.lock.release()
+
+    def __refreshWgout__(self, spec : RequestSpec):
+        tokens = list()
+        for token in spec.query.split("&"):
+            if token.startswith("wgout="):
+                n = min(len(self.wgoutKeys), max(1, len(token[6:].replace("+", " ").replace("%20", " ").split())))
+                token = "wgout=" + "+".join(self.rng.sample(self.wgoutKeys, n))
+            tokens.append(token)
+        return RequestSpec(spec.endpoint, "&".join(tokens), spec.method, spec.body, spec.contentType)
+
+
+def send(baseUrl : str, spec : RequestSpec, timeoutSec : float):
+    '''
+    Send the request and read the whole response.
+    @return: the status code or 0 if the request failed without a response
+    '''
+    data = spec.body.encode() if spec.body is not None else None
+    request = urllib.request.Request(spec.getUrl(baseUrl), data = data, method = spec.method)
+    if spec.contentType is not None:
+        request.add_header("Content-Type", spec.contentType)
+    try:
+        with urllib.request.urlopen(request, timeout = timeoutSec) as response:
+            response.read()
+            return response.status
+    except HTTPError as error:
+        error.read()
+        return error.code
+    except Exception:
+        return 0
+
+
+def registerWgout(baseUrl : str, nbLocations : int, seed : int, timeoutSec : float):
+    '''
+    Register wgout instances on the server for the requests to /BioSimModel.
+    @return: the list of keys
+    '''
+    rng = random.Random(seed)
+    keys = list()
+    while len(keys) < nbLocations:
+        parms = getRandomLocations(rng, min(5, nbLocations - len(keys)))
+        parms["from"] = 2015
+        parms["to"] = 2020
+        with urllib.request.urlopen(baseUrl + "/BioSimWG?" + urlencode(parms), timeout = timeoutSec) as response:
+            keys += response.read().decode().split()
+    return keys
+
+
+class LoadDriver():
+
+    def __init__(self, baseUrl : str, concurrency : int, rate : float, timeoutSec : float):
+        '''
+        Constructor
+        @param baseUrl: the url of the server, for instance http://localhost:5000
+        @param concurrency: the number of clients
+        @param rate: the arrival rate in requests per second or 0 for closed-loop clients
+        @param timeoutSec: the timeout of each request
+        '''
+        self.baseUrl = baseUrl.rstrip("/")
+        self.concurrency = concurrency
+        self.rate = rate
+        self.timeoutSec = timeoutSec
+        self.results = list()   ### tuples (endpoint, status code, latency in sec)
+        self.lock = Lock()
+
+    def run(self, mix, durationSec : float, nbRequests : int):
+        '''
+        Send requests until the duration has elapsed or the number of requests has been sent.
+        @return: the elapsed time in seconds
+        '''
+        self.results = list()
+        queue = Queue(maxsize = 0 if self.rate > 0 else self.concurrency)
+        start = time.perf_counter()
+        deadline = start + durationSec if durationSec > 0 else float("inf")
+        clients = [Thread(target = self.__client__, args = (queue,), daemon = True) for i in range(self.concurrency)]
+        for client in clients:
+            client.start()
+        rng = random.Random(0)
+        scheduled = start
+        nbSent = 0
+        while (nbRequests <= 0 or nbSent < nbRequests) and time.perf_counter() < deadline:
+            if self.rate > 0:
+                scheduled += rng.expovariate(self.rate)
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            else:
+                scheduled = None    ### the latency is measured from the time the request is sent
+            queue.put((mix.next(), scheduled))
+            nbSent += 1
+        for client in clients:
+            queue.put(None)
+        for client in clients:
+            client.join()
+        return time.perf_counter() - start
+
+    def __client__(self, queue : Queue):
+        while True:
+            try:
+                item = queue.get(timeout = 1)
+            except Empty:
+                continue
+            if item is None:
+                break
+            spec, scheduled = item
+            sent = time.perf_counter()
+            status = send(self.baseUrl, spec, self.timeoutSec)
+            latency = time.perf_counter() - (scheduled if scheduled is not None else sent)
+            self.lock.acquire()
+            self.results.append((spec.endpoint, status, latency))
+            self.lock.release()
+
+    def getReport(self, elapsedSec : float):
+        '''
+        @return: a dict endpoint -> statistics with an "all" entry for the whole mix
+        '''
+        byEndpoint = dict()
+        for endpoint, status, latency in self.results:
+            byEndpoint.setdefault(endpoint, list()).append((status, latency))
+        byEndpoint["all"] = [(status, latency) for endpoint, status, latency in self.results]
+        report = dict()
+        for endpoint, results in byEndpoint.items():
+            if len(results) == 0:
+                continue
+            latencies = np.array([latency for status, latency in results])
+            nbErrors = len([status for status, latency in results if status == 0 or status >= 400])
+            p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+            report[endpoint] = {"requests" : len(results),
+                                "errors" : nbErrors,
+                                "errorRate" : nbErrors / len(results),
+                                "throughputPerSec" : len(results) / elapsedSec,
+                                "meanMs" : float(latencies.mean() * 1000),
+                                "p50Ms" : float(p50 * 1000),
+                                "p95Ms" : float(p95 * 1000),
+                                "p99Ms" : float(p99 * 1000)}
+        return report
+
+
+def printReport(report : dict):
+    print("%-24s %9s %8s %8s %10s %10s %10s %10s" % ("endpoint", "requests", "errors", "req/s", "mean ms", "p50 ms", "p95 ms", "p99 ms"))
+    for endpoint, stats in report.items():
+        print("%-24s %9d %7.1f%% %8.1f %10.1f %10.1f %10.1f %10.1f" % (endpoint, stats["requests"], stats["errorRate"] * 100, stats["throughputPerSec"],
+                                                                     stats["meanMs"], stats["p50Ms"], stats["p95Ms"], stats["p99Ms"]))
+
+
+def startLocalServer(settingsFilename : str, nbThreads : int):
+    '''
+    Start the application on a free port of the loopback interface with waitress, as in production.
+    @return: the url of the server
+    '''
+    from waitress import create_server
+    from biosim.bsflaskroutes import BsFlaskRoutes
+    if settingsFilename is not None:
+        os.environ["BIOSIM_SETTINGS"] = os.path.abspath(settingsFilename)
+    app = BsFlaskRoutes.create_app(settingsFilename is not None)
+    server = create_server(app, host = "127.0.0.1", port = 0, threads = nbThreads)
+    Thread(target = server.run, daemon = True).start()
+    return "http://127.0.0.1:" + str(server.effective_port)
+
+
+def parseMix(mix : str):
+    weights = dict()
+    for token in mix.split(","):
+        endpoint, weight = token.split("=")
+        weights["/" + endpoint.strip().lstrip("/")] = float(weight)
+    return weights
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = "Load driver for the BioSIM web API")
+    parser.add_argument("--url", default = None, help = "url of a running server, for instance http://localhost:5000")
+    parser.add_argument("--local", action = "store_true", help = "start a local server instance in this process")
+    parser.add_argument("--settings", default = None, help = "settings file of the local server (the defaults and the simulation backend otherwise)")
+    parser.add_argument("--server-threads", type = int, default = 8, help = "number of waitress threads of the local server")
+    parser.add_argument("--log", default = None, help = "JSONL request log to replay instead of the synthetic mix")
+    parser.add_argument("--keep-wgout", action = "store_true", help = "send the wgout references of the log as is")
+    parser.add_argument("--mix", default = None, help = "weights of the synthetic mix, for instance BioSimNormals=.4,BioSimWG=.2,BioSimModel=.2,BioSimModelEphemeral=.2")
+    parser.add_argument("--concurrency", type = int, default = 8, help = "number of clients")
+    parser.add_argument("--rate", type = float, default = 0, help = "arrival rate in requests per second (0 means closed-loop clients)")
+    parser.add_argument("--duration", type = float, default = 30, help = "duration of the test in seconds (0 means no limit)")
+    parser.add_argument("--requests", type = int, default = 0, help = "number of requests (0 means no limit)")
+    parser.add_argument("--timeout", type = float, default = 300, help = "timeout of each request in seconds")
+    parser.add_argument("--wgout-locations", type = int, default = 50, help = "number of wgout instances registered for the requests to /BioSimModel")
+    parser.add_argument("--seed", type = int, default = 1, help = "seed of the synthetic mix")
+    parser.add_argument("--output", default = None, help = "save the report in this JSON file")
+    args = parser.parse_args(argv)
+
+    if args.local:
+        baseUrl = startLocalServer(args.settings, args.server_threads)
+    elif args.url is not None:
+        baseUrl = args.url.rstrip("/")
+    else:
+        parser.error("either --url or --local must be provided")
+    if args.duration <= 0 and args.requests <= 0:
+        parser.error("either --duration or --requests must be positive")
+
+    weights = parseMix(args.mix) if args.mix is not None else DefaultMix
+    needsWgout = weights.get("/BioSimModel", 0) > 0 if args.log is None else not args.keep_wgout
+    wgoutKeys = registerWgout(baseUrl, args.wgout_locations, args.seed, args.timeout) if needsWgout else list()
+    if args.log is not None:
+        mix = ReplayMix(args.log, wgoutKeys, not args.keep_wgout, args.seed)
+    else:
+        mix = SyntheticMix(weights, args.seed, wgoutKeys)
+
+    driver = LoadDriver(baseUrl, args.concurrency, args.rate, args.timeout)
+    print("Sending requests to " + baseUrl + " with " + str(args.concurrency) + " clients" + (" at " + str(args.rate) + " requests/s" if args.rate > 0 else "") + "...")
+    elapsedSec = driver.run(mix, args.duration, args.requests)
+    report = driver.getReport(elapsedSec)
+    printReport(report)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump({"url" : baseUrl,
+                       "concurrency" : args.concurrency,
+                       "rate" : args.rate,
+                       "elapsedSec" : elapsedSec,
+                       "endpoints" : report}, f, indent = 2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
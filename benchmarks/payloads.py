@@ -0,0 +1,78 @@
+'''
+Reproducible synthetic teleIO payloads with the shape and the size of the outputs of the BioSIM library.
+
+@author: M. Fortin and R. Saint-Amant, Canadian Forest Service, August 2020
+@copyright: Her Majesty the Queen in right of Canada
+'''
+import numpy as np
+
+from biosim.bsbackend import BioSIM_API
+
+
+DailyHeader = "Year,Month,Day,TN,T,TX,P"
+HourlyHeader = "Year,Month,Day,Hour,T,P,H,WS"
+ModelHeader = "Year,DD"
+NormalsHeader = "Month,TN,TX,P"
+
+
+def getDayColumns(nbYears : int, firstYear : int):
+    '''
+    Return the year, month and day columns of consecutive years of 365 days.
+    '''
+    monthLengths = [31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]
+    months = np.repeat(np.arange(1, 13), monthLengths)
+    days = np.concatenate([np.arange(1, m + 1) for m in monthLengths])
+    years = np.repeat(np.arange(firstYear, firstYear + nbYears), 365)
+    return years, np.tile(months, nbYears), np.tile(days, nbYears)
+
+
+def formatRows(rowFormat : str, columns : list):
+    return [rowFormat % row for row in zip(*[column.tolist() for column in columns])]
+
+
+def createWeatherText(nbYears : int, nbReplications : int, hourly = False, firstYear = None, seed = 1):
+    '''
+    Create the text of a weather generation output. The header is repeated for each replication.
+    @param firstYear: the first year or None for year offsets ending at 0 as in the outputs generated from the normals
+    '''
+    rng = np.random.default_rng(seed)
+    if firstYear is None:
+        firstYear = 1 - nbYears
+    years, months, days = getDayColumns(nbYears, firstYear)
+    lines = list()
+    for rep in range(nbReplications):
+        n = len(years)
+        if hourly:
+            hours = np.tile(np.arange(24), n)
+            columns = [np.repeat(years, 24), np.repeat(months, 24), np.repeat(days, 24), hours,
+                       rng.normal(5, 10, n * 24), rng.exponential(.2, n * 24), rng.uniform(40, 100, n * 24), rng.uniform(0, 30, n * 24)]
+            lines.append(HourlyHeader)
+            lines += formatRows("%d,%d,%d,%d,%.1f,%.1f,%.0f,%.1f", columns)
+        else:
+            t = rng.normal(5, 10, n)
+            columns = [years, months, days, t - 5, t, t + 5, rng.exponential(2, n)]
+            lines.append(DailyHeader)
+            lines += formatRows("%d,%d,%d,%.1f,%.1f,%.1f,%.1f", columns)
+    return "\n".join(lines) + "\n"
+
+
+def createModelText(nbYears : int, nbReplications : int, firstYear = 1991, seed = 1):
+    '''
+    Create the text of an annual model output. The header is repeated for each replication.
+    '''
+    rng = np.random.default_rng(seed)
+    lines = list()
+    for rep in range(nbReplications):
+        lines.append(ModelHeader)
+        lines += formatRows("%d,%.1f", [np.arange(firstYear, firstYear + nbYears), rng.normal(1500, 200, nbYears)])
+    return "\n".join(lines) + "\n"
+
+
+def createNormalsText(seed = 1):
+    rng = np.random.default_rng(seed)
+    t = rng.normal(5, 10, 12)
+    return NormalsHeader + "\n" + "\n".join(formatRows("%d,%.1f,%.1f,%.1f", [np.arange(1, 13), t - 5, t + 5, rng.uniform(40, 120, 12)])) + "\n"
+
+
+def createTeleIO(text : str):
+    return BioSIM_API.teleIO(False, "Success", "", "", text, "")
@@ -7,10 +7,29 @@ Entry point of the biosim module.
 from paste.translogger import TransLogger 
 from waitress import serve
 
+from biosim.bsbroker import serveWithFrontEnds
 from biosim.bsflaskroutes import BsFlaskRoutes
+from biosim.bssettings import Settings
 
 if __name__ == "__main__":
     print("Name set to " + str(__name__))
-    app = BsFlaskRoutes.create_app()                
-    url = "0.0.0.0:" + str(app.config["PORT"])
-    serve(TransLogger(app, setup_console_handler=True), listen=url, ident="BioSIM web API") 
+    config = BsFlaskRoutes.loadConfig()
+    Settings.setSettings(config)
+    if Settings.asyncMode:
+        print("Async mode set to True")
+        if Settings.nbFrontEnds > 1:
+            raise Exception("The async mode cannot be combined with several front ends (NB_FRONTENDS > 1)!")
+        try:
+            import uvicorn
+        except ImportError:
+            raise Exception("The async mode requires uvicorn! It can be installed with the async extra: pip install biosim[async]")
+        from biosim.bsasgi import BsAsgiApp
+        app = BsFlaskRoutes.create_app()
+        uvicorn.run(BsAsgiApp(app), host="0.0.0.0", port=app.config["PORT"])
+    elif Settings.nbFrontEnds > 1:
+        print("Front ends set to " + str(Settings.nbFrontEnds))
+        serveWithFrontEnds(config)
+    else:
+        app = BsFlaskRoutes.create_app()                
+        url = "0.0.0.0:" + str(app.config["PORT"])
+        serve(TransLogger(app, setup_console_handler=True), listen=url, ident="BioSIM web API") 
@@ -0,0 +1,322 @@
+'''
+Async serving mode. The requests for normals, weather generation and models are served by coroutines that
+wait for the worker processes through the futures of their pools, so that thousands of slow requests can be
+in progress on a handful of threads. The other endpoints are forwarded to the Flask application, which runs
+in the threads of the default executor of the event loop.
+
+The module provides an ASGI application that is served by uvicorn when the ASYNC_MODE setting is enabled.
+The number of requests in progress is bounded and the requests beyond the waiting limit are rejected with a
+503 status so that the clients back off. They are rejected before their body is read and the size of the 
+bodies is bounded as well.
+
+@author: M. Fortin and R. Saint-Amant, Canadian Forest Service, August 2020
+@copyright: Her Majesty the Queen in right of Canada
+'''
+from contextvars import copy_context
+from urllib.parse import parse_qsl
+import asyncio
+import io
+import json
+import sys
+import time
+
+from biosim.bsmetrics import Metrics
+from biosim.bsrequest import AbstractRequest, WeatherGeneratorRequest, NormalsRequest, ModelRequest, \
+    WeatherGeneratorEpheremalRequest, BioSimRequestException
+from biosim.bsserver import Server
+from biosim.bssettings import Settings
+from biosim.bstracing import Tracing, SlowRequestLog
+from biosim.bsutility import BioSimUtility, TeleIODictList
+
+
+TextMimeType = "text/html; charset=utf-8"
+
+
+class AsyncResponse():
+    '''
+    The status, the headers and the body of a response. The body is either a string or a generator of strings
+    for the streamed outputs.
+    '''
+
+    def __init__(self, body, status = 200, mimetype = TextMimeType):
+        self.body = body
+        self.status = status
+        self.headers = [(b"content-type", mimetype.encode("latin-1"))]
+
+
+class BsAsgiApp():
+    '''
+    The ASGI application of the async mode.
+    '''
+
+    ### the endpoints served by coroutines: path -> (request class, name of the endpoint in the Server class)
+    AsyncEndpoints = {"/BioSimNormals" : (NormalsRequest, "BioSimNormals"),
+                      "/BioSimWG" : (WeatherGeneratorRequest, "BioSimWG"),
+                      "/BioSimModel" : (ModelRequest, "BioSimModel"),
+                      "/BioSimModelEphemeral" : (WeatherGeneratorEpheremalRequest, "BioSimModelEphemeral"),
+                      "/BioSimWGEphemeralMode" : (WeatherGeneratorEpheremalRequest, "BioSimModelEphemeral")}
+
+    def __init__(self, flaskApp):
+        '''
+        Constructor
+        @param flaskApp: the Flask application, as returned by the BsFlaskRoutes.create_app method, that serves the other endpoints
+        '''
+        self.flaskApp = flaskApp
+        self.semaphore = None       ### created in the event loop of the server since it is bound to the loop of its creation with Python < 3.10
+        self.nbWaiting = 0
+        if Settings.slowRequestLogThresholdSec > 0:
+            self.slowRequestLog = SlowRequestLog(Settings.slowRequestLogThresholdSec, Settings.slowRequestLogSampleRate, Settings.slowRequestLogFilename)
+        else:
+            self.slowRequestLog = None
+
+    async def __call__(self, scope : dict, receive, send):
+        if scope["type"] == "lifespan":
+            while True:
+                message = await receive()
+                if message["type"] == "lifespan.startup":
+                    self.getSemaphore()
+                    await send({"type" : "lifespan.startup.complete"})
+                elif message["type"] == "lifespan.shutdown":
+                    for component in Server.Instance.getComponents():   ### the worker processes are not daemonic and they must be terminated explicitly
+                        if component.isLoaded():
+                            component.unload()
+                    await send({"type" : "lifespan.shutdown.complete"})
+                    return
+        elif scope["type"] == "http":
+            if BsAsgiApp.AsyncEndpoints.__contains__(scope["path"]):
+                await self.serveAsync(scope, receive, send)
+            else:
+                body = await self.readBody(scope, receive)
+                if body is None:
+                    await self.sendResponse(send, BsAsgiApp.getTooLargeResponse())
+                else:
+                    await self.serveWithFlask(scope, body, send)
+
+    async def readBody(self, scope : dict, receive):
+        '''
+        Read the body of the request.
+        @return: the body or None if it exceeds the asyncMaxBodyBytes setting
+        '''
+        contentLength = BsAsgiApp.getHeader(scope, b"content-length")
+        if contentLength is not None and contentLength.isdigit() and int(contentLength) > Settings.asyncMaxBodyBytes:
+            return None
+        pieces = list()
+        nbBytes = 0
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                break
+            piece = message.get("body", b"")
+            nbBytes += len(piece)
+            if nbBytes > Settings.asyncMaxBodyBytes:
+                return None
+            pieces.append(piece)
+            if not message.get("more_body", False):
+                break
+        return b"".join(pieces)
+
+    @staticmethod
+    def getTooLargeResponse():
+        return AsyncResponse("The body of the request exceeds " + str(Settings.asyncMaxBodyBytes) + " bytes.", 413)
+
+    def getSemaphore(self):
+        '''
+        Return the semaphore that bounds the number of requests in progress. It is created upon the first call,
+        which must occur in the event loop of the server.
+        '''
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(Settings.asyncMaxRequestsInProgress)
+        return self.semaphore
+
+    @staticmethod
+    def getHeader(scope : dict, name : bytes):
+        for key, value in scope["headers"]:
+            if key.lower() == name:
+                return value.decode("latin-1")
+        return None
+
+    def getRequestParameters(self, scope : dict, body : bytes):
+        '''
+        Return the parameters of the request in a dict instance as the getRequestParameters function of
+        the Flask routes does: the first value of each parameter is kept and the columns of the body of a
+        POST request are merged with the parameters of the query string.
+        '''
+        d = dict()
+        for key, value in parse_qsl(scope["query_string"].decode("utf-8", errors = "replace"), keep_blank_values = True):
+            if not d.__contains__(key):
+                d[key] = value
+        if scope["method"] == "POST":
+            return AbstractRequest.mergeRequestBody(d, body.decode("utf-8", errors = "replace"), BsAsgiApp.getHeader(scope, b"content-type"))
+        else:
+            return d
+
+    async def serveAsync(self, scope : dict, receive, send):
+        '''
+        Serve a request for normals, weather generation or models. The request waits for a slot if the
+        maximum number of requests in progress is reached or it is rejected if too many requests are waiting.
+        The body is read once the request is admitted.
+        '''
+        requestStart = time.perf_counter()
+        path = scope["path"]
+        semaphore = self.getSemaphore()
+        if semaphore.locked() and self.nbWaiting >= Settings.asyncMaxRequestsWaiting:
+            response = AsyncResponse("The server is busy. Please try again later.", 503)
+            response.headers.append((b"retry-after", b"1"))
+            await self.sendResponse(send, response)
+            Metrics.observeRequest(path, response.status, time.perf_counter() - requestStart)
+            return
+        if Settings.serverTimingEnabled or self.slowRequestLog is not None:
+            trace = Tracing.start()
+        else:
+            trace = None
+        self.nbWaiting += 1
+        try:
+            body = await self.readBody(scope, receive)
+            if body is not None:
+                with Tracing.span("asyncWait"):
+                    await semaphore.acquire()
+        finally:
+            self.nbWaiting -= 1
+        if body is None:
+            response = BsAsgiApp.getTooLargeResponse()
+            await self.sendResponse(send, response)
+            Metrics.observeRequest(path, response.status, time.perf_counter() - requestStart)
+            return
+        try:
+            try:
+                requestClass, endpoint = BsAsgiApp.AsyncEndpoints[path]
+                with Tracing.span("parse"):
+                    bioSimRequest = requestClass(self.getRequestParameters(scope, body))
+                outputs = await Server.Instance.handleRequestAsync(endpoint, bioSimRequest)
+                response = await asyncio.get_running_loop().run_in_executor(None, copy_context().run, self.getResponse, endpoint, bioSimRequest, outputs)   ### the serialization would block the event loop
+            except Exception as error:
+                if isinstance(error, BioSimRequestException):
+                    response = AsyncResponse(str(error), 400)
+                else:
+                    response = AsyncResponse(str(error), 500)
+            if trace is not None:   ### the spans of a streamed body occur after the headers are sent and they are not reported
+                if Settings.serverTimingEnabled:
+                    response.headers.append((b"server-timing", trace.getServerTimingHeader().encode("latin-1")))
+                if self.slowRequestLog is not None and self.slowRequestLog.isSlow(trace.getElapsedSec()):
+                    self.slowRequestLog.log(path, scope["query_string"].decode(errors = "replace"), response.status, trace)
+            await self.sendResponse(send, response)
+        finally:
+            semaphore.release()
+        Metrics.observeRequest(path, response.status, time.perf_counter() - requestStart)
+
+    def getResponse(self, endpoint : str, bioSimRequest : AbstractRequest, outputs):
+        '''
+        Format the outputs as the corresponding Flask routes do.
+        '''
+        if endpoint == "BioSimWG":
+            return AsyncResponse(outputs)     ### the keys of the outputs registered in the library
+        elif endpoint == "BioSimNormals":
+            with Tracing.span("serialize"):
+                if bioSimRequest.isJSONFormatRequested():
+                    mainDict = dict()
+                    for i in range(bioSimRequest.n):
+                        output = outputs[i]
+                        if output.msg == "Success":
+                            mainDict.__setitem__(i, BioSimUtility.convertTeleIOTextToList(output.text))
+                        else:
+                            return AsyncResponse(output.msg)
+                    return AsyncResponse(json.dumps(mainDict, separators = (",", ":"), sort_keys = True) + "\n", mimetype = "application/json")
+                else:
+                    return AsyncResponse("".join([output.text if output.msg == "Success" else output.msg for output in outputs]))
+        else:
+            return self.getModelResponse(bioSimRequest, outputs)
+
+    def getModelResponse(self, bioSimRequest : AbstractRequest, teleIODictList : TeleIODictList):
+        '''
+        Return the CSV or JSON outputs of a model, which are streamed if the streaming is enabled.
+        '''
+        if bioSimRequest.isJSONFormatRequested():
+            generator = teleIODictList.iterJSON(Settings.streamingChunkSize)
+            mimetype = "application/json"
+        elif bioSimRequest.isNDJSONFormatRequested():
+            generator = teleIODictList.iterNDJSON(Settings.streamingChunkSize)
+            mimetype = "application/x-ndjson"
+        elif Settings.streamingEnabled:
+            generator = teleIODictList.iterOutputText(Settings.streamingChunkSize)
+            mimetype = TextMimeType
+        else:
+            with Tracing.span("serialize"):
+                return AsyncResponse(teleIODictList.getOutputText())
+        if Settings.streamingEnabled:
+            return AsyncResponse(generator, mimetype = mimetype)
+        else:
+            with Tracing.span("serialize"):
+                return AsyncResponse("".join(generator), mimetype = mimetype)
+
+    async def sendResponse(self, send, response : AsyncResponse):
+        await send({"type" : "http.response.start", "status" : response.status, "headers" : response.headers})
+        if isinstance(response.body, str):
+            await send({"type" : "http.response.body", "body" : response.body.encode("utf-8")})
+        else:   ### the pieces are formatted in the threads of the default executor so that the event loop serves the other requests meanwhile
+            loop = asyncio.get_running_loop()
+            iterator = iter(response.body)
+            piece = await loop.run_in_executor(None, next, iterator, None)
+            while piece is not None:
+                await send({"type" : "http.response.body", "body" : piece.encode("utf-8"), "more_body" : True})
+                piece = await loop.run_in_executor(None, next, iterator, None)
+            await send({"type" : "http.response.body", "body" : b""})
+
+    async def serveWithFlask(self, scope : dict, body : bytes, send):
+        '''
+        Forward the request to the Flask application in a thread. All the calls to the application and to its
+        body run in the same context since the Flask request context is kept in context variables.
+        '''
+        loop = asyncio.get_running_loop()
+        context = copy_context()
+        environ = self.getWSGIEnviron(scope, body)
+        startResponseArgs = list()
+        def startResponse(status, headers, excInfo = None):
+            startResponseArgs[:] = [status, headers]
+        def run(function, *args):
+            return loop.run_in_executor(None, context.run, function, *args)
+        iterable = await run(self.flaskApp, environ, startResponse)
+        try:
+            iterator = iter(iterable)
+            piece = await run(next, iterator, None)
+            status, headers = startResponseArgs
+            await send({"type" : "http.response.start",
+                        "status" : int(status.split(" ", 1)[0]),
+                        "headers" : [(key.lower().encode("latin-1"), value.encode("latin-1")) for key, value in headers]})
+            while piece is not None:
+                await send({"type" : "http.response.body", "body" : piece, "more_body" : True})
+                piece = await run(next, iterator, None)
+            await send({"type" : "http.response.body", "body" : b""})
+        finally:
+            if hasattr(iterable, "close"):
+                await run(iterable.close)
+
+    @staticmethod
+    def getWSGIEnviron(scope : dict, body : bytes):
+        server = scope.get("server") or ("localhost", 80)
+        environ = {"REQUEST_METHOD" : scope["method"],
+                   "SCRIPT_NAME" : scope.get("root_path", ""),
+                   "PATH_INFO" : scope["path"],
+                   "QUERY_STRING" : scope["query_string"].decode("latin-1"),
+                   "SERVER_NAME" : server[0],
+                   "SERVER_PORT" : str(server[1]),
+                   "SERVER_PROTOCOL" : "HTTP/" + scope.get("http_version", "1.1"),
+                   "REMOTE_ADDR" : scope["client"][0] if scope.get("client") else "",
+                   "CONTENT_LENGTH" : str(len(body)),
+                   "wsgi.version" : (1, 0),
+                   "wsgi.url_scheme" : scope.get("scheme", "http"),
+                   "wsgi.input" : io.BytesIO(body),
+                   "wsgi.errors" : sys.stderr,
+                   "wsgi.multithread" : True,
+                   "wsgi.multiprocess" : False,
+                   "wsgi.run_once" : False}
+        for key, value in scope["headers"]:
+            name = key.decode("latin-1").upper().replace("-", "_")
+            if name == "CONTENT_TYPE":
+                environ["CONTENT_TYPE"] = value.decode("latin-1")
+            elif name != "CONTENT_LENGTH":
+                name = "HTTP_" + name
+                if environ.__contains__(name):
+                    environ[name] += "," + value.decode("latin-1")
+                else:
+                    environ[name] = value.decode("latin-1")
+        return environ
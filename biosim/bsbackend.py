@@ -0,0 +1,63 @@
+'''
+Selection of the implementation of the BioSIM_API module. The native backend is the C++ extension
+in the biosimdll package, which is only available on Windows. The simulator backend is the pure-Python
+stand-in of the bssimulator module.
+
+The modules of the server import the BioSIM_API instance of this module instead of the extension. The
+backend is resolved on first use so that it can be selected in the settings, which are loaded after
+the modules have been imported.
+
+@author: M. Fortin and R. Saint-Amant, Canadian Forest Service, August 2020
+@copyright: Her Majesty the Queen in right of Canada
+'''
+from threading import Lock
+
+from biosim.bssettings import Settings
+
+
+NativeBackend = "native"
+SimulatorBackend = "simulator"
+
+
+def loadBackend(backend : str):
+    '''
+    Import the BioSIM_API module of this backend.
+    @raise exception: if the backend is unknown or if it cannot be imported on this platform
+    '''
+    if backend == NativeBackend:
+        try:
+            import biosim.biosimdll.BioSIM_API as module
+        except ImportError as error:
+            raise Exception("The native BioSIM_API extension cannot be imported (" + str(error) + "). Set BACKEND = \"" + SimulatorBackend + "\" in the settings or the BIOSIM_BACKEND environment variable to run the server with the simulator.")
+        return module
+    elif backend == SimulatorBackend:
+        import biosim.bssimulator as module
+        return module
+    else:
+        raise Exception("The backend " + str(backend) + " is unknown. It should be either " + NativeBackend + " or " + SimulatorBackend)
+
+
+class BackendProxy():
+    '''
+    A stand-in for the BioSIM_API module that forwards the attribute lookups to the selected backend.
+    '''
+
+    def __init__(self):
+        self.module = None
+        self.lock = Lock()
+
+    def getModule(self):
+        if self.module is None:
+            self.lock.acquire()
+            try:
+                if self.module is None:
+                    self.module = loadBackend(Settings.backend)
+            finally:
+                self.lock.release()
+        return self.module
+
+    def __getattr__(self, name):
+        return getattr(self.getModule(), name)
+
+
+BioSIM_API = BackendProxy()
@@ -0,0 +1,186 @@
+'''
+Deployment with several HTTP front-end processes. The Server instance, that is the contexts, the models and
+their worker processes, runs in a broker process. The front ends parse the requests and format the outputs
+while the broker processes them. The front ends call the broker through a multiprocessing manager.
+
+The wgout instances are registered by the front ends in the sqlite store, which is shared by all the
+processes on the host and whose tickets are unique across processes. The normals cache, the coalescing of
+identical requests and the jobs are shared as well since they belong to the broker.
+
+The front ends either listen on the same port with the SO_REUSEPORT option, which lets the kernel spread
+the connections over them, or on consecutive ports starting from the port in the settings if the option
+is not available (e.g. on Windows) or disabled.
+
+@author: M. Fortin and R. Saint-Amant, Canadian Forest Service, August 2020
+@copyright: Her Majesty the Queen in right of Canada
+'''
+from multiprocessing import Process, Queue
+from multiprocessing.managers import BaseManager, BaseProxy
+import os
+import signal
+import socket
+import sys
+
+from biosim.bsjobs import JobChunk
+from biosim.bsrequest import NormalsRequest
+from biosim.bssettings import Settings
+from biosim.bsstore import SQLiteStore
+from biosim.bstracing import Tracing
+from biosim.bsutility import BioSimUtility
+
+
+### the methods of the Server class called by the routes
+ExposedMethods = ("handleRequest", "getModelNames", "getModelHelp", "getModelDefaultParameters",
+                  "submitJob", "getJobStatus", "getJobChunk", "cancelJob",
+                  "getStartupReport", "getNormalsCacheStats", "getCoalescingStats", "getLibraryStats",
+                  "getUpdaterStatus", "getMetricsText")
+
+
+class BrokerServer():
+    '''
+    The facade of the Server instance in the broker process. The teleIO instances of the BioSIM library
+    cannot be pickled: they are converted into dict instances before being sent to the front ends.
+    '''
+
+    def __init__(self, server):
+        self.server = server
+
+    def __getattr__(self, name : str):
+        return getattr(self.server, name)
+
+    def handleRequest(self, endpoint : str, bioSimRequest):
+        outputs = self.server.handleRequest(endpoint, bioSimRequest)
+        if isinstance(bioSimRequest, NormalsRequest):
+            return [BioSimUtility.convertTeleIOToDict(output) for output in outputs]
+        return outputs
+
+    def getJobChunk(self, jobId : str, k : int):
+        chunk = self.server.getJobChunk(jobId, k)
+        if chunk.jobType == "Normals" and chunk.output is not None:
+            chunk = JobChunk(chunk.jobType, [BioSimUtility.convertTeleIOToDict(output) for output in chunk.output], chunk.firstIndex)
+        return chunk
+
+
+class ServerProxy(BaseProxy):
+    '''
+    The proxy of the Server instance in the front ends. It provides the methods listed in ExposedMethods and
+    the time spent waiting for the broker is reported in the "broker" span of the request.
+    '''
+
+    _exposed_ = ExposedMethods
+
+    def __getattr__(self, name : str):
+        if name not in ExposedMethods:
+            raise AttributeError(name)
+        def callMethod(*args):
+            with Tracing.span("broker"):
+                return self._callmethod(name, args)
+        return callMethod
+
+    def handleRequest(self, endpoint : str, bioSimRequest):
+        with Tracing.span("broker"):
+            outputs = self._callmethod("handleRequest", (endpoint, bioSimRequest))
+        if isinstance(bioSimRequest, NormalsRequest):
+            return [BioSimUtility.convertDictToTeleIO(d) for d in outputs]
+        return outputs
+
+    def getJobChunk(self, jobId : str, k : int):
+        with Tracing.span("broker"):
+            chunk = self._callmethod("getJobChunk", (jobId, k))
+        if chunk.jobType == "Normals" and chunk.output is not None:
+            chunk.output = [BioSimUtility.convertDictToTeleIO(d) for d in chunk.output]
+        return chunk
+
+
+def getBrokerServer():
+    from biosim.bsserver import Server
+    return BrokerServer(Server.Instance)
+
+
+class BrokerManager(BaseManager):
+    pass
+
+BrokerManager.register("getServer", callable = getBrokerServer, proxytype = ServerProxy, exposed = ExposedMethods)
+
+
+def do_job_broker(config : dict, port : int, authkey : bytes, ready : Queue):
+    '''
+    This function is passed to the Process instance of the broker. It instantiates the server and serves
+    the calls of the front ends until the process is interrupted.
+    '''
+    from biosim.bsbackend import SimulatorBackend
+    from biosim.bsserver import Server
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    Settings.setSettings(config)
+    try:
+        if Settings.backend != SimulatorBackend:    ### the simulator does not read the weather database
+            Settings.updateGribsRegistry()
+        Server.InstantiateServer()
+        manager = BrokerManager(address = ("127.0.0.1", port), authkey = authkey)
+        brokerServer = manager.get_server()
+    except Exception as error:
+        ready.put("Error: " + str(error))
+        raise error
+    ready.put(brokerServer.address)
+    try:
+        brokerServer.serve_forever()
+    finally:
+        for component in Server.Instance.getComponents():   ### the worker processes are not daemonic and they must be terminated explicitly
+            if component.isLoaded():
+                component.unload()
+
+
+def do_job_frontend(address : tuple, authkey : bytes, port : int, reusePort : bool):
+    '''
+    This function is passed to the Process instances of the front ends. It connects to the broker and
+    serves the HTTP requests with waitress.
+    '''
+    from paste.translogger import TransLogger
+    from waitress import create_server
+    from biosim.bsflaskroutes import BsFlaskRoutes
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    manager = BrokerManager(address = address, authkey = authkey)
+    manager.connect()
+    app = BsFlaskRoutes.create_app(True, manager.getServer())
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    if reusePort:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(("0.0.0.0", port))
+    print("Front end " + str(os.getpid()) + " listening on port " + str(port))
+    create_server(TransLogger(app, setup_console_handler=True), sockets = [sock], ident="BioSIM web API").run()
+
+
+def serveWithFrontEnds(config : dict):
+    '''
+    Start the broker and the front ends and wait until they terminate.
+    @param config: the app.config dictionary
+    @raise exception: if the settings are not compatible with several front ends or if the broker cannot start
+    '''
+    if Settings.wgoutStore != SQLiteStore:
+        raise Exception("Several front ends require the sqlite wgout store (WGOUT_STORE = \"" + SQLiteStore + "\") since the wgout instances are shared between them!")
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))      ### the broker and the front ends are terminated below
+    authkey = os.urandom(32)
+    ready = Queue()
+    broker = Process(target = do_job_broker, args = (dict(config), Settings.brokerPort, authkey, ready), name = "broker")
+    broker.start()
+    address = ready.get()
+    if isinstance(address, str):
+        broker.join()
+        raise Exception("The broker could not be started. " + address)
+    print("Broker listening on " + str(address[0]) + ":" + str(address[1]))
+    reusePort = Settings.frontEndReusePort and hasattr(socket, "SO_REUSEPORT")
+    frontEnds = list()
+    for i in range(Settings.nbFrontEnds):
+        port = config["PORT"] if reusePort else config["PORT"] + i
+        p = Process(target = do_job_frontend, args = (address, authkey, port, reusePort), name = "frontend-" + str(i))
+        p.start()
+        frontEnds.append(p)
+    try:
+        for p in frontEnds:
+            p.join()
+    finally:
+        for p in frontEnds:
+            if p.is_alive():
+                p.terminate()
+        broker.terminate()
+        broker.join()
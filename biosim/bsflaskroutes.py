@@ -4,15 +4,22 @@ Routing based on Flask.
 @author: M. Fortin and R. Saint-Amant, Canadian Forest Service, August 2020
 @copyright: Her Majesty the Queen in right of Canada
 '''
-from biosim.bsrequest import WeatherGeneratorRequest, NormalsRequest, ModelRequest , \
+import time
+
+from biosim.bsbackend import SimulatorBackend
+from biosim.bsjobs import JobNotFoundException, JobNotReadyException, JobSchedulerBusyException
+from biosim.bsmetrics import Metrics
+from biosim.bsrequest import AbstractRequest, WeatherGeneratorRequest, NormalsRequest, ModelRequest , \
     WeatherGeneratorEpheremalRequest, BioSimRequestException, \
     SimpleModelRequest, TeleIODictList
 from biosim.bsserver import Server
 from biosim.bssettings import Settings
+from biosim.bsstore import createWgoutStore
+from biosim.bstracing import Tracing, SlowRequestLog
 from biosim.bsutility import BioSimUtility
-from flask import Flask 
-from flask.globals import request
-from flask.helpers import make_response
+from flask import Config, Flask, Response 
+from flask.globals import request, g
+from flask.helpers import make_response, stream_with_context
 from flask.json import jsonify
 
 
@@ -22,19 +29,84 @@ FieldSeparator = ","
 class BsFlaskRoutes():
     
     @staticmethod
-    def create_app(allowEnvironmentalSettings = True):
-        app = Flask(__name__)
-        app.config.from_object('biosim.default_settings')
+    def loadConfig(allowEnvironmentalSettings = True):
+        '''
+        Load the default settings and, if allowed, the settings file in the BIOSIM_SETTINGS environment variable.
+        @return: a Config instance
+        '''
+        config = Config(Settings.ROOT_DIR)
+        config.from_object('biosim.default_settings')
         if allowEnvironmentalSettings:
-            app.config.from_envvar('BIOSIM_SETTINGS', silent=True)
+            config.from_envvar('BIOSIM_SETTINGS', silent=True)
+        return config
+
+    @staticmethod
+    def create_app(allowEnvironmentalSettings = True, server = None):
+        '''
+        Create the application.
+        @param allowEnvironmentalSettings: True to read the settings file in the BIOSIM_SETTINGS environment variable
+        @param server: None to instantiate the server in this process or the proxy of the server of a broker process
+        (see the bsbroker module)
+        '''
+        app = Flask(__name__)
+        app.config.update(BsFlaskRoutes.loadConfig(allowEnvironmentalSettings))
         print("Production mode set to " + str(app.config["PRODUCTION_MODE"]))
         print("Multiprocessing set to " + str(app.config["MULTIPROCESS_MODE"]))
         print("Minimal configuration set to " + str(app.config["MINIMAL_CONFIG"]))
+        print("Backend set to " + str(app.config["BACKEND"]))
         Settings.setSettings(app.config)
-        Settings.updateGribsRegistry()
-        
-        Server.InstantiateServer()
+        if server is None:
+            if Settings.backend != SimulatorBackend:    ### the simulator does not read the weather database
+                Settings.updateGribsRegistry()
+            Server.InstantiateServer()
+        else:       ### the front end registers the wgout instances in the store shared with the other front ends
+            BioSimUtility.library = createWgoutStore()
+            Server.Instance = server
+
+        if Settings.slowRequestLogThresholdSec > 0:
+            slowRequestLog = SlowRequestLog(Settings.slowRequestLogThresholdSec, Settings.slowRequestLogSampleRate, Settings.slowRequestLogFilename)
+        else:
+            slowRequestLog = None
+
+        @app.before_request
+        def startRequestTimer():
+            g.requestStart = time.perf_counter()
+            if Settings.serverTimingEnabled or slowRequestLog is not None:
+                g.trace = Tracing.start()
+            else:
+                Tracing.stop()  ### the thread may still hold the trace of a former request
+
+        @app.after_request
+        def observeRequest(response):
+            if hasattr(g, "requestStart"):
+                endpoint = request.url_rule.rule if request.url_rule is not None else "unmatched"   ### the path of unknown urls is not used to bound the number of series
+                Metrics.observeRequest(endpoint, response.status_code, time.perf_counter() - g.requestStart)
+                trace = getattr(g, "trace", None)
+                if trace is not None:   ### the spans of a streamed body occur after the headers are sent and they are not reported
+                    if Settings.serverTimingEnabled:
+                        response.headers["Server-Timing"] = trace.getServerTimingHeader()
+                    if slowRequestLog is not None and slowRequestLog.isSlow(trace.getElapsedSec()):
+                        slowRequestLog.log(endpoint, request.query_string.decode(errors = "replace"), response.status_code, trace)
+            return response
                 
+        def getRequestParameters():
+            '''
+            Return the parameters of the request in a dict instance. For a POST request, the columns of the
+            body are merged with the parameters of the query string.
+            '''
+            if request.method == "POST":
+                return AbstractRequest.mergeRequestBody(request.args.to_dict(), request.get_data(as_text = True), request.content_type)
+            else:
+                return request.args.to_dict()
+
+        def createRequest(requestClass):
+            '''
+            Parse the parameters of the request and create an instance of the request class.
+            '''
+            with Tracing.span("parse"):
+                return requestClass(getRequestParameters())
+        
+        
         @app.route('/BioSimMemoryLoad')
         def biosimMemoryLoad():
             try:
@@ -47,11 +119,87 @@ class BsFlaskRoutes():
         @app.route('/BioSimMaxMemory')
         def biosimMaxMemory():
             try:
-                return str(BioSimUtility.maxNumberWgoutInstances)
+                return str(BioSimUtility.library.maxEntries)
             except Exception as error:
                 return make_response(str(error), 500)
         
         
+        @app.route('/BioSimMemoryStats')
+        def biosimMemoryStats():
+            parms = request.args
+            try:
+                stats = BioSimUtility.library.getStats()
+                if parms.get("format", "CSV") == "JSON":
+                    return jsonify(stats)
+                else:
+                    return FieldSeparator.join(stats.keys()) + "\n" + FieldSeparator.join([str(v) for v in stats.values()])
+            except Exception as error:
+                return make_response(str(error), 500)
+        
+        
+        @app.route('/BioSimNormalsCacheStats')
+        def biosimNormalsCacheStats():
+            parms = request.args
+            try:
+                stats = Server.Instance.getNormalsCacheStats()
+                if parms.get("format", "CSV") == "JSON":
+                    return jsonify(stats)
+                else:
+                    return FieldSeparator.join(stats.keys()) + "\n" + FieldSeparator.join([str(v) for v in stats.values()])
+            except Exception as error:
+                return make_response(str(error), 500)
+
+
+        @app.route('/BioSimUpdaterStatus')
+        def biosimUpdaterStatus():
+            parms = request.args
+            try:
+                status = Server.Instance.getUpdaterStatus()
+                if parms.get("format", "CSV") == "JSON":
+                    return jsonify(status)
+                else:
+                    return FieldSeparator.join(status.keys()) + "\n" + FieldSeparator.join([str(v) for v in status.values()])
+            except Exception as error:
+                return make_response(str(error), 500)
+
+
+        @app.route('/BioSimMetrics')
+        def biosimMetrics():
+            try:
+                return Response(Metrics.render(Server.Instance), mimetype = "text/plain; version=0.0.4")
+            except Exception as error:
+                return make_response(str(error), 500)
+
+
+        @app.route('/BioSimCoalescingStats')
+        def biosimCoalescingStats():
+            parms = request.args
+            try:
+                stats = Server.Instance.getCoalescingStats()
+                if parms.get("format", "CSV") == "JSON":
+                    return jsonify(stats)
+                else:
+                    return FieldSeparator.join(stats.keys()) + "\n" + FieldSeparator.join([str(v) for v in stats.values()])
+            except Exception as error:
+                return make_response(str(error), 500)
+
+
+        @app.route('/BioSimStartupReport')
+        def biosimStartupReport():
+            parms = request.args
+            try:
+                report = Server.Instance.getStartupReport()
+                if parms.get("format", "CSV") == "JSON":
+                    return jsonify(report)
+                else:
+                    outputStr = "Component,Processes,InitSec,RSSDeltaMB\n"
+                    for entry in report["components"]:
+                        outputStr += entry["component"] + FieldSeparator + str(entry["processes"]) + FieldSeparator + str(entry["initSec"]) + FieldSeparator + str(entry["rssDeltaMB"]) + "\n"
+                    return outputStr
+            except Exception as error:
+                return make_response(str(error), 500)
+
+
         @app.route('/BioSimMemoryCleanUp')
         def biosimMemoryCleanUp():
             parms = request.args
@@ -60,28 +208,35 @@ class BsFlaskRoutes():
                     references = parms.get("ref").split()
                     TeleIODictList.removeTeleIODictList(references)
                     return "Done"
+                elif parms.__contains__("ns"):
+                    nbRemoved = BioSimUtility.library.removeNamespace(parms.get("ns"))
+                    return str(nbRemoved)
+                elif parms.__contains__("unusedSince"):
+                    try:
+                        delaySec = float(parms.get("unusedSince"))
+                    except ValueError:
+                        raise BioSimRequestException("The unusedSince argument must be a number of seconds!")
+                    nbRemoved = BioSimUtility.library.removeUnusedSince(delaySec)
+                    return str(nbRemoved)
                 else:
-                    raise BioSimRequestException("A request for a memory cleanup must contain a ref argument!")
+                    raise BioSimRequestException("A request for a memory cleanup must contain a ref, ns or unusedSince argument!")
             except Exception as error:
                 if isinstance(error, BioSimRequestException):
                     return make_response(str(error), 400)
                 return make_response(str(error), 500)
     
         
-        @app.route('/BioSimModelEphemeral')
+        @app.route('/BioSimModelEphemeral', methods = ['GET', 'POST'])
         def biosimModelEphemeral():
-            parms = request.args
             try:
-                bioSimRequest = WeatherGeneratorEpheremalRequest(parms)
-                teleIODictList = doWeatherGeneration(bioSimRequest)
-                bioSimRequest.storeTeleIODictList(teleIODictList)
-                    
-                bioSimRequest.weatherGenerated = True
-                modelResultTeleIODictList = Server.Instance.doProcessModelRequest(bioSimRequest)
+                bioSimRequest = createRequest(WeatherGeneratorEpheremalRequest)
+                modelResultTeleIODictList = Server.Instance.handleRequest("BioSimModelEphemeral", bioSimRequest)
                 if bioSimRequest.isJSONFormatRequested():
-                    return jsonify(modelResultTeleIODictList.parseToJSON())
+                    return getOutputJSONResponse(modelResultTeleIODictList, False)
+                elif bioSimRequest.isNDJSONFormatRequested():
+                    return getOutputJSONResponse(modelResultTeleIODictList, True)
                 else:
-                    return modelResultTeleIODictList.getOutputText()
+                    return getOutputTextResponse(modelResultTeleIODictList)
             except Exception as error:
                 if isinstance(error, BioSimRequestException):
                     return make_response(str(error), 400)
@@ -93,25 +248,40 @@ class BsFlaskRoutes():
             return biosimModelEphemeral()
     
         
-        def doWeatherGeneration(bioSimRequest : WeatherGeneratorRequest):
+        def getOutputTextResponse(teleIODictList : TeleIODictList):
+            '''
+            Return the CSV outputs, which are streamed location by location and replication by replication if the streaming is enabled
+            '''
+            if Settings.streamingEnabled:
+                return Response(stream_with_context(teleIODictList.iterOutputText(Settings.streamingChunkSize)))
+            else:
+                with Tracing.span("serialize"):
+                    return teleIODictList.getOutputText()
+        
+        
+        def getOutputJSONResponse(teleIODictList : TeleIODictList, isNDJSON : bool):
             '''
-            Perform the weather generation and returns a TeleIODictList instance
+            Return the JSON outputs, either as a single object or as one record per line (NDJSON). The
+            outputs are streamed if the streaming is enabled.
             '''
-            outputs = Server.Instance.processRequest(bioSimRequest)
-            if bioSimRequest.isForceClimateGenerationEnabled():
-                outputs.setLastDailyDate(-999)      # means climate is generated even for past dates
+            if isNDJSON:
+                generator = teleIODictList.iterNDJSON(Settings.streamingChunkSize)
+                mimetype = "application/x-ndjson"
             else:
-                outputs.setLastDailyDate(Server.Instance.lastDailyDate)     # means we are using observation
-            return outputs
+                generator = teleIODictList.iterJSON(Settings.streamingChunkSize)
+                mimetype = "application/json"
+            if Settings.streamingEnabled:
+                return Response(stream_with_context(generator), mimetype = mimetype)
+            else:
+                with Tracing.span("serialize"):
+                    return Response("".join(generator), mimetype = mimetype)
         
         
-        @app.route('/BioSimWG')
+        @app.route('/BioSimWG', methods = ['GET', 'POST'])
         def biosimWG():
-            parms = request.args
             try:
-                bioSimRequest = WeatherGeneratorRequest(parms)
-                teleIODictList = doWeatherGeneration(bioSimRequest)
-                keysToLibrary = teleIODictList.registerTeleIODictList()
+                bioSimRequest = createRequest(WeatherGeneratorRequest)
+                keysToLibrary = Server.Instance.handleRequest("BioSimWG", bioSimRequest)     ### the outputs are registered once even if the request is coalesced
                 return keysToLibrary
             
             except Exception as error:
@@ -120,13 +290,86 @@ class BsFlaskRoutes():
                 return make_response(str(error), 500)
     
         
+        @app.route('/BioSimJobSubmit', methods = ['GET', 'POST'])
+        def biosimJobSubmit():
+            try:
+                parms = getRequestParameters()
+                if not parms.__contains__("type"):
+                    raise BioSimRequestException("A job must include a type argument!")
+                jobType = parms.pop("type")
+                return Server.Instance.submitJob(jobType, parms)
+            except Exception as error:
+                if isinstance(error, BioSimRequestException):
+                    return make_response(str(error), 400)
+                elif isinstance(error, JobSchedulerBusyException):
+                    response = make_response(str(error), 503)
+                    response.headers["Retry-After"] = "60"
+                    return response
+                return make_response(str(error), 500)
+        
+        
+        @app.route('/BioSimJobStatus')
+        def biosimJobStatus():
+            parms = request.args
+            try:
+                status = Server.Instance.getJobStatus(parms.get("id"))
+                if parms.get("format", "CSV") == "JSON":
+                    return jsonify(status)
+                else:
+                    return FieldSeparator.join(status.keys()) + "\n" + FieldSeparator.join([str(v) for v in status.values()])
+            except Exception as error:
+                if isinstance(error, JobNotFoundException):
+                    return make_response(str(error), 404)
+                return make_response(str(error), 500)
+        
+        
+        @app.route('/BioSimJobResult')
+        def biosimJobResult():
+            parms = request.args
+            try:
+                try:
+                    chunk = int(parms.get("chunk", "0"))
+                except ValueError:
+                    raise BioSimRequestException("The chunk parameter must be an integer!")
+                outputFormat = parms.get("format", "CSV")
+                if outputFormat not in ["CSV", "JSON", "NDJSON"]:
+                    raise BioSimRequestException("The format parameter must be one of the following: CSV, JSON, NDJSON")
+                generator = Server.Instance.getJobChunk(parms.get("id"), chunk).iterOutput(outputFormat)
+                if outputFormat == "JSON":
+                    mimetype = "application/json"
+                elif outputFormat == "NDJSON":
+                    mimetype = "application/x-ndjson"
+                else:
+                    mimetype = "text/html"
+                return Response(stream_with_context(generator), mimetype = mimetype)
+            except Exception as error:
+                if isinstance(error, BioSimRequestException):
+                    return make_response(str(error), 400)
+                elif isinstance(error, JobNotFoundException):
+                    return make_response(str(error), 404)
+                elif isinstance(error, JobNotReadyException):
+                    return make_response(str(error), 409)
+                return make_response(str(error), 500)
+        
+        
+        @app.route('/BioSimJobCancel')
+        def biosimJobCancel():
+            parms = request.args
+            try:
+                Server.Instance.cancelJob(parms.get("id"))
+                return "Done"
+            except Exception as error:
+                if isinstance(error, JobNotFoundException):
+                    return make_response(str(error), 404)
+                return make_response(str(error), 500)
+        
+        
         @app.route('/BioSimModelHelp')
         def biosimModelHelp():
             parms = request.args
             try:
                 bioSimRequest = SimpleModelRequest(parms)
-                modelType = bioSimRequest.mod
-                return Server.Instance.models.get(modelType).getHelp()
+                return Server.Instance.getModelHelp(bioSimRequest.mod)
             except Exception as error:
                 if isinstance(error, BioSimRequestException):
                     return make_response(str(error), 400)
@@ -138,8 +381,7 @@ class BsFlaskRoutes():
             parms = request.args
             try:
                 bioSimRequest = SimpleModelRequest(parms)
-                modelType = bioSimRequest.mod
-                listObject = Server.Instance.models.get(modelType).getDefaultParameters()
+                listObject = Server.Instance.getModelDefaultParameters(bioSimRequest.mod)
                 outputString = ""
                 for p in listObject:
                     outputString += p + FieldSeparator
@@ -163,16 +405,17 @@ class BsFlaskRoutes():
                 return make_response(str(error), 500)
         
         
-        @app.route('/BioSimModel')
+        @app.route('/BioSimModel', methods = ['GET', 'POST'])
         def biosimModel():
-            parms = request.args
             try:
-                bioSimRequest = ModelRequest(parms)
-                modelResultTeleIODictList = Server.Instance.processRequest(bioSimRequest)
+                bioSimRequest = createRequest(ModelRequest)
+                modelResultTeleIODictList = Server.Instance.handleRequest("BioSimModel", bioSimRequest)
                 if bioSimRequest.isJSONFormatRequested():
-                    return jsonify(modelResultTeleIODictList.parseToJSON())
+                    return getOutputJSONResponse(modelResultTeleIODictList, False)
+                elif bioSimRequest.isNDJSONFormatRequested():
+                    return getOutputJSONResponse(modelResultTeleIODictList, True)
                 else:
-                    return modelResultTeleIODictList.getOutputText()
+                    return getOutputTextResponse(modelResultTeleIODictList)
             except Exception as error:
                 if isinstance(error, BioSimRequestException):
                     return make_response(str(error), 400)
@@ -183,10 +426,7 @@ class BsFlaskRoutes():
         def biosimModelList():
             parms = request.args
             try:
-                modelList = Server.Instance.models.keys()
-                outputList = list()
-                for obj in modelList:
-                    outputList.append(obj.name)
+                outputList = Server.Instance.getModelNames()
                 if parms.get("format", "CSV") == "JSON":
                     return jsonify(outputList)
                 else:
@@ -198,30 +438,30 @@ class BsFlaskRoutes():
                 return make_response(str(error), 500)
     
         
-        @app.route('/BioSimNormals')
+        @app.route('/BioSimNormals', methods = ['GET', 'POST'])
         def biosimNormals():            #### TODO the function needs to be refactored MF20201203
-            parms = request.args
             try:
-                bioSimRequest = NormalsRequest(parms)
-                outputs = Server.Instance.processRequest(bioSimRequest)
+                bioSimRequest = createRequest(NormalsRequest)
+                outputs = Server.Instance.handleRequest("BioSimNormals", bioSimRequest)
         
-                if bioSimRequest.isJSONFormatRequested():
-                    mainDict = dict()
-                    for i in range(bioSimRequest.n):
-                        output = outputs[i] 
-                        if output.msg == "Success":
-                            mainDict.__setitem__(i, BioSimUtility.convertTeleIOTextToList(output.text))
-                        else:
-                            return output.msg
-                    return jsonify(mainDict)
-                else:        
-                    strOutput = ""
-                    for output in outputs:
-                        if output.msg == "Success":
-                            strOutput += output.text
-                        else:
-                            strOutput += output.msg
-                    return strOutput 
+                with Tracing.span("serialize"):
+                    if bioSimRequest.isJSONFormatRequested():
+                        mainDict = dict()
+                        for i in range(bioSimRequest.n):
+                            output = outputs[i] 
+                            if output.msg == "Success":
+                                mainDict.__setitem__(i, BioSimUtility.convertTeleIOTextToList(output.text))
+                            else:
+                                return output.msg
+                        return jsonify(mainDict)
+                    else:        
+                        strOutput = ""
+                        for output in outputs:
+                            if output.msg == "Success":
+                                strOutput += output.text
+                            else:
+                                strOutput += output.msg
+                        return strOutput 
             except Exception as error:
                 if isinstance(error, BioSimRequestException):
                     return make_response(str(error), 400)
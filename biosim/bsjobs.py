@@ -0,0 +1,392 @@
+'''
+Asynchronous jobs for large batches of locations. A job is split into chunks that do not exceed the
+maximum number of coordinates per request. The chunks are processed in the background and the client
+polls the status of the job and downloads the outputs chunk by chunk. The outputs of the chunks are
+written on disk so that the jobs do not hold their outputs in memory.
+
+@author: M. Fortin and R. Saint-Amant, Canadian Forest Service, August 2020
+@copyright: Her Majesty the Queen in right of Canada
+'''
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+import json
+import os
+import pickle
+import time
+import uuid
+
+from biosim.bsrequest import WeatherGeneratorRequest, NormalsRequest, WeatherGeneratorEpheremalRequest, \
+    BioSimRequestException
+from biosim.bssettings import Settings
+from biosim.bsutility import BioSimUtility
+
+
+JobTypes = ["WG", "Normals", "Model"]
+
+Queued = "Queued"
+Running = "Running"
+Done = "Done"
+Cancelled = "Cancelled"
+
+
+class JobNotFoundException(Exception):
+
+    def __init__(self, message : str):
+        Exception.__init__(self, message)
+
+
+class JobNotReadyException(Exception):
+
+    def __init__(self, message : str):
+        Exception.__init__(self, message)
+
+
+class JobSchedulerBusyException(Exception):
+
+    def __init__(self, message : str):
+        Exception.__init__(self, message)
+
+
+class Job():
+    '''
+    A batch of locations processed in chunks. Each chunk is an ordinary request of the job type:
+        - WG: weather generation
+        - Normals: climate normals
+        - Model: weather generation and model application as in the ephemeral mode
+    '''
+
+    def __init__(self, jobType : str, d : dict):
+        '''
+        Constructor
+        @param jobType: one of the JobTypes
+        @param d: the parameters of the request with the coordinates of all the locations
+        @raise BioSimRequestException: if the parameters of one of the chunks are invalid
+        '''
+        if jobType not in JobTypes:
+            raise BioSimRequestException("The type parameter must be one of the following: " + str(JobTypes))
+        self.jobId = uuid.uuid4().hex
+        self.jobType = jobType
+        self.state = Queued
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.nbLocations = 0
+        self.firstIndices = list()      ### the index of the first location of each chunk
+        self.requests = self.__createRequests__(d)
+        self.outputFiles = [None] * len(self.requests)     ### the files of the outputs of the chunks
+        self.nbBytes = 0        ### the size of the output files
+        self.errors = dict()    ### chunk index -> error message
+        self.nbChunksDone = 0
+        self.lock = Lock()
+
+    def __createRequests__(self, d : dict):
+        for key in ["lat", "long"]:
+            if not d.__contains__(key):
+                raise BioSimRequestException("A job must at least include lat= and long=")
+        coordinates = dict()
+        for key in ["lat", "long", "elev"]:
+            if d.__contains__(key):
+                value = d.get(key)
+                coordinates[key] = value.split() if isinstance(value, str) else value
+        nbLocations = len(coordinates["lat"])
+        for values in coordinates.values():
+            if len(values) != nbLocations:
+                raise BioSimRequestException("Error: the number of coordinates seems to be inconsistent. Typically more latitudes than longitudes.")
+        if nbLocations == 0:
+            raise BioSimRequestException("A job must include at least one location!")
+        self.nbLocations = nbLocations
+        if nbLocations > Settings.jobsMaxCoordinates:
+            raise BioSimRequestException("The maximum number of coordinates in a job is limited to " + str(Settings.jobsMaxCoordinates))
+        if self.jobType == "Normals":
+            chunkSize = Settings.nbMaxCoordinatesNormals
+        else:
+            chunkSize = Settings.nbMaxCoordinatesWG
+        requests = list()
+        for start in range(0, nbLocations, chunkSize):
+            chunkDict = dict(d)
+            for key, values in coordinates.items():
+                chunkDict[key] = values[start:(start + chunkSize)]
+            self.firstIndices.append(start)
+            try:
+                requests.append(self.__createRequest__(chunkDict))
+            except BioSimRequestException as error:
+                raise BioSimRequestException("Locations " + str(start) + " to " + str(min(start + chunkSize, nbLocations) - 1) + ": " + str(error))
+        return requests
+
+    def __createRequest__(self, d : dict):
+        if self.jobType == "WG":
+            return WeatherGeneratorRequest(d)
+        elif self.jobType == "Normals":
+            return NormalsRequest(d)
+        else:
+            return WeatherGeneratorEpheremalRequest(d)
+
+    def getNbChunks(self):
+        return len(self.requests)
+
+    def isFinished(self):
+        return self.state == Done or self.state == Cancelled
+
+    def run(self, server, scheduler):
+        '''
+        Process the chunks one after the other. A failure of a chunk does not stop the job.
+        @param scheduler: the JobScheduler instance that provides the directory and the byte budget of the outputs
+        '''
+        self.lock.acquire()
+        if self.state == Cancelled:
+            self.lock.release()
+            return
+        self.state = Running
+        self.started = time.time()
+        self.lock.release()
+        for k in range(len(self.requests)):
+            if self.state == Cancelled:
+                break
+            try:
+                self.__storeOutput__(k, self.__processRequest__(server, self.requests[k]), scheduler)
+            except Exception as error:
+                self.errors[k] = str(error)
+            self.requests[k] = None     ### the request is no longer needed
+            self.lock.acquire()
+            self.nbChunksDone += 1
+            self.lock.release()
+        self.lock.acquire()
+        if self.state != Cancelled:
+            self.state = Done
+        self.finished = time.time()
+        self.lock.release()
+
+    def __processRequest__(self, server, bioSimRequest):
+        if self.jobType == "WG":
+            return server.doWeatherGeneration(bioSimRequest)
+        elif self.jobType == "Normals":
+            return server.processRequest(bioSimRequest)
+        else:
+            return server.doProcessEphemeralModelRequest(bioSimRequest)
+
+    def __storeOutput__(self, k : int, output, scheduler):
+        '''
+        Write the output of chunk k on disk.
+        @raise JobSchedulerBusyException: if the output exceeds the remaining budget of the jobs
+        '''
+        if self.jobType == "Normals":
+            output = [BioSimUtility.convertTeleIOToDict(teleIOobj) for teleIOobj in output]    ### the teleIO instances cannot be pickled
+        payload = pickle.dumps(output, pickle.HIGHEST_PROTOCOL)
+        scheduler.reserveBytes(len(payload))
+        filename = os.path.join(scheduler.directory, "job-" + self.jobId + "-" + str(k) + ".pickle")
+        try:
+            with open(filename, "wb") as f:
+                f.write(payload)
+        except Exception as error:
+            scheduler.releaseBytes(len(payload))
+            raise error
+        self.lock.acquire()
+        self.outputFiles[k] = filename
+        self.nbBytes += len(payload)
+        self.lock.release()
+
+    def discard(self):
+        '''
+        Delete the output files of the job.
+        @return: the number of bytes released
+        '''
+        self.lock.acquire()
+        filenames = [filename for filename in self.outputFiles if filename is not None]
+        self.outputFiles = [None] * len(self.outputFiles)
+        nbBytes = self.nbBytes
+        self.nbBytes = 0
+        self.lock.release()
+        for filename in filenames:
+            if os.path.exists(filename):
+                os.remove(filename)
+        return nbBytes
+
+    def cancel(self):
+        self.lock.acquire()
+        if not self.isFinished():
+            self.state = Cancelled
+            if self.started is None:
+                self.finished = time.time()
+        self.lock.release()
+
+    def getStatus(self):
+        self.lock.acquire()
+        status = {"id" : self.jobId,
+                  "type" : self.jobType,
+                  "state" : self.state,
+                  "nbLocations" : self.nbLocations,
+                  "nbChunks" : len(self.requests),
+                  "nbChunksDone" : self.nbChunksDone,
+                  "nbChunksFailed" : len(self.errors),
+                  "nbBytes" : self.nbBytes,
+                  "submitted" : self.submitted,
+                  "started" : self.started,
+                  "finished" : self.finished}
+        self.lock.release()
+        return status
+
+    def getChunk(self, k : int):
+        '''
+        Return the outputs of chunk k in a JobChunk instance.
+        @raise JobNotReadyException: if the chunk has not been processed yet
+        '''
+        if k < 0 or k >= len(self.outputFiles):
+            raise BioSimRequestException("The chunk parameter must range from 0 to " + str(len(self.outputFiles) - 1))
+        if self.errors.__contains__(k):
+            return JobChunk(self.jobType, None, self.firstIndices[k], self.errors[k])
+        filename = self.outputFiles[k]
+        if filename is None:
+            raise JobNotReadyException("The chunk " + str(k) + " of job " + self.jobId + " is not available yet!")
+        try:
+            with open(filename, "rb") as f:
+                output = pickle.load(f)
+        except FileNotFoundError:   ### the job expired in the meantime
+            raise JobNotFoundException("The job " + self.jobId + " does not exist or it has expired!")
+        if self.jobType == "Normals":
+            output = [BioSimUtility.convertDictToTeleIO(d) for d in output]
+        return JobChunk(self.jobType, output, self.firstIndices[k])
+
+    def iterChunkOutput(self, k : int, outputFormat : str):
+        '''
+        Return a generator of the outputs of chunk k in the requested format.
+        @raise JobNotReadyException: if the chunk has not been processed yet
+        '''
+        return self.getChunk(k).iterOutput(outputFormat)
+
+
+class JobChunk():
+    '''
+    The outputs of a chunk of a job. The instance can be sent to another process, which then formats the outputs.
+    '''
+
+    def __init__(self, jobType : str, output, firstIndex : int, errorMessage = None):
+        self.jobType = jobType
+        self.output = output
+        self.firstIndex = firstIndex
+        self.errorMessage = errorMessage
+
+    def iterOutput(self, outputFormat : str):
+        if self.errorMessage is not None:
+            yield self.errorMessage
+            return
+        output = self.output
+        firstIndex = self.firstIndex
+        if self.jobType == "Normals":
+            if outputFormat == "CSV":
+                for teleIOobj in output:
+                    yield teleIOobj.text if teleIOobj.msg == "Success" else teleIOobj.msg
+            else:
+                for i in range(len(output)):
+                    if output[i].msg == "Success":
+                        records = BioSimUtility.convertTeleIOTextToList(output[i].text)
+                    else:
+                        records = output[i].msg
+                    if outputFormat == "NDJSON":
+                        yield json.dumps({"Location" : firstIndex + i, "records" : records}) + "\n"
+                    else:
+                        yield ("{" if i == 0 else ",") + "\"" + str(firstIndex + i) + "\":" + json.dumps(records)
+                if outputFormat == "JSON":
+                    yield "{}" if len(output) == 0 else "}"
+        elif outputFormat == "JSON":
+            for text in output.iterJSON(Settings.streamingChunkSize, firstIndex):
+                yield text
+        elif outputFormat == "NDJSON":
+            for text in output.iterNDJSON(Settings.streamingChunkSize, firstIndex):
+                yield text
+        else:
+            for text in output.iterOutputText(Settings.streamingChunkSize):
+                yield text
+
+
+class JobScheduler():
+    '''
+    Run the jobs in the background on a bounded number of threads. The number of jobs that are
+    queued or running is bounded as well: a job submitted beyond this limit is rejected. The outputs of
+    the jobs are written in a directory and their total size is bounded by a byte budget: a job is rejected
+    once the budget is used up and a chunk whose output exceeds the remaining budget fails. The finished
+    jobs and their outputs are discarded once their time to live has elapsed.
+    '''
+
+    def __init__(self, server):
+        self.server = server
+        self.executor = ThreadPoolExecutor(max_workers = Settings.jobsNbThreads, thread_name_prefix = "job")
+        self.jobs = dict()    ### job id -> Job instance
+        self.lock = Lock()
+        self.nbBytes = 0      ### the size of the output files of all the jobs
+        if Settings.jobsDirectory is None:
+            self.directory = Settings.ROOT_DIR + "data" + os.path.sep + "jobs"
+        else:
+            self.directory = Settings.jobsDirectory
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        for filename in os.listdir(self.directory):     ### the jobs of a former instance of the server are lost
+            if filename.startswith("job-") and filename.endswith(".pickle"):
+                os.remove(os.path.join(self.directory, filename))
+
+    def submit(self, jobType : str, d : dict):
+        '''
+        Create a job and schedule it.
+        @return: the Job instance
+        @raise JobSchedulerBusyException: if too many jobs are already queued or running or if the outputs of the jobs use up the byte budget
+        '''
+        job = Job(jobType, d)
+        self.lock.acquire()
+        try:
+            self.__removeExpiredJobs__()
+            nbPendingJobs = len([j for j in self.jobs.values() if not j.isFinished()])
+            if nbPendingJobs >= Settings.jobsMaxPending:
+                raise JobSchedulerBusyException("Too many jobs are pending (" + str(nbPendingJobs) + "). Please try again later.")
+            if self.nbBytes >= Settings.jobsMaxBytes:
+                raise JobSchedulerBusyException("The outputs of the jobs use up the budget of " + str(Settings.jobsMaxBytes) + " bytes. Please try again later.")
+            self.jobs[job.jobId] = job
+        finally:
+            self.lock.release()
+        self.executor.submit(job.run, self.server, self)
+        return job
+
+    def reserveBytes(self, nbBytes : int):
+        '''
+        Account for the output of a chunk in the byte budget.
+        @raise JobSchedulerBusyException: if the output exceeds the remaining budget
+        '''
+        self.lock.acquire()
+        try:
+            if self.nbBytes + nbBytes > Settings.jobsMaxBytes:
+                raise JobSchedulerBusyException("The output of this chunk (" + str(nbBytes) + " bytes) exceeds the remaining budget of the jobs!")
+            self.nbBytes += nbBytes
+        finally:
+            self.lock.release()
+
+    def releaseBytes(self, nbBytes : int):
+        self.lock.acquire()
+        self.nbBytes -= nbBytes
+        self.lock.release()
+
+    def __removeExpiredJobs__(self):
+        now = time.time()
+        for jobId in list(self.jobs.keys()):
+            job = self.jobs[jobId]
+            if job.finished is not None and now - job.finished > Settings.jobsTTLSec:
+                del self.jobs[jobId]
+                self.nbBytes -= job.discard()
+
+    def getJob(self, jobId : str):
+        '''
+        @raise JobNotFoundException: if the job does not exist or if it has expired
+        '''
+        self.lock.acquire()
+        self.__removeExpiredJobs__()
+        job = self.jobs.get(jobId)
+        self.lock.release()
+        if job is None:
+            raise JobNotFoundException("The job " + str(jobId) + " does not exist or it has expired!")
+        return job
+
+    def cancel(self, jobId : str):
+        self.getJob(jobId).cancel()
+
+    def getNbPendingJobs(self):
+        self.lock.acquire()
+        nbPendingJobs = len([j for j in self.jobs.values() if not j.isFinished()])
+        self.lock.release()
+        return nbPendingJobs
@@ -0,0 +1,222 @@
+'''
+Metrics of the server internals in the Prometheus text exposition format.
+
+The counters and the histograms are updated in place by the routes, the wrappers, the models and the
+worker pools. The gauges that reflect the state of the server (queue depths, library, caches, updater) are
+collected at scraping time only. Each update costs a lock acquisition and a few additions so that the
+metrics can be left on in production.
+
+@author: M. Fortin and R. Saint-Amant, Canadian Forest Service, August 2020
+@copyright: Her Majesty the Queen in right of Canada
+'''
+from bisect import bisect_left
+from threading import Lock
+
+
+LatencyBuckets = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def formatLabels(labelNames : tuple, labelValues : tuple):
+    if len(labelNames) == 0:
+        return ""
+    pairs = list()
+    for i in range(len(labelNames)):
+        value = str(labelValues[i]).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        pairs.append(labelNames[i] + "=\"" + value + "\"")
+    return "{" + ",".join(pairs) + "}"
+
+
+def formatValue(value):
+    if value == float("inf"):
+        return "+Inf"
+    elif isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    else:
+        return str(value)
+
+
+class AbstractMetric():
+    '''
+    A metric with a series of values identified by their labels.
+    '''
+
+    def __init__(self, name : str, helpText : str, metricType : str, labelNames = ()):
+        self.name = name
+        self.helpText = helpText
+        self.metricType = metricType
+        self.labelNames = tuple(labelNames)
+        self.values = dict()    ### tuple of label values -> value
+        self.lock = Lock()
+
+    def getHeaderLines(self):
+        return ["# HELP " + self.name + " " + self.helpText, "# TYPE " + self.name + " " + self.metricType]
+
+    def getLines(self):
+        self.lock.acquire()
+        items = sorted(self.values.items())
+        self.lock.release()
+        lines = self.getHeaderLines()
+        for labelValues, value in items:
+            lines.append(self.name + formatLabels(self.labelNames, labelValues) + " " + formatValue(value))
+        return lines
+
+
+class Counter(AbstractMetric):
+
+    def __init__(self, name : str, helpText : str, labelNames = ()):
+        AbstractMetric.__init__(self, name, helpText, "counter", labelNames)
+
+    def inc(self, labelValues = (), amount = 1):
+        self.lock.acquire()
+        self.values[labelValues] = self.values.get(labelValues, 0) + amount
+        self.lock.release()
+
+
+class Gauge(AbstractMetric):
+
+    def __init__(self, name : str, helpText : str, labelNames = ()):
+        AbstractMetric.__init__(self, name, helpText, "gauge", labelNames)
+
+    def set(self, labelValues = (), value = 0):
+        self.lock.acquire()
+        self.values[labelValues] = value
+        self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        self.values.clear()
+        self.lock.release()
+
+
+class Histogram(AbstractMetric):
+    '''
+    A histogram with cumulative buckets. Each series is stored as [bucket counts, sum, count].
+    '''
+
+    def __init__(self, name : str, helpText : str, labelNames = (), buckets = LatencyBuckets):
+        AbstractMetric.__init__(self, name, helpText, "histogram", labelNames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, labelValues, value : float):
+        index = bisect_left(self.buckets, value)    ### the bucket upper bounds are inclusive
+        self.lock.acquire()
+        series = self.values.get(labelValues)
+        if series is None:
+            series = [[0] * (len(self.buckets) + 1), 0., 0]
+            self.values[labelValues] = series
+        series[0][index] += 1
+        series[1] += value
+        series[2] += 1
+        self.lock.release()
+
+    def getLines(self):
+        self.lock.acquire()
+        items = [(labelValues, (list(series[0]), series[1], series[2])) for labelValues, series in sorted(self.values.items())]
+        self.lock.release()
+        lines = self.getHeaderLines()
+        labelNames = self.labelNames + ("le",)
+        for labelValues, series in items:
+            bucketCounts, total, count = series
+            cumulativeCount = 0
+            for i in range(len(self.buckets) + 1):
+                cumulativeCount += bucketCounts[i]
+                upperBound = self.buckets[i] if i < len(self.buckets) else float("inf")
+                lines.append(self.name + "_bucket" + formatLabels(labelNames, labelValues + (formatValue(float(upperBound)),)) + " " + str(cumulativeCount))
+            lines.append(self.name + "_sum" + formatLabels(self.labelNames, labelValues) + " " + formatValue(total))
+            lines.append(self.name + "_count" + formatLabels(self.labelNames, labelValues) + " " + str(count))
+        return lines
+
+
+class Metrics():
+    '''
+    The registry of the metrics of this process.
+    '''
+
+    requestCount = Counter("biosim_http_requests_total", "Number of HTTP requests by endpoint and status code.", ("endpoint", "status"))
+    requestErrors = Counter("biosim_http_request_errors_total", "Number of HTTP requests that ended with a status code of 400 or above.", ("endpoint",))
+    requestLatency = Histogram("biosim_http_request_duration_seconds", "Time spent producing the response, excluding the streaming of the body.", ("endpoint",))
+    nativeCallDuration = Histogram("biosim_native_call_duration_seconds", "Duration of the calls to the BioSIM library.", ("component", "call"))
+    busyTime = Counter("biosim_component_busy_seconds_total", "Time the component spent in the BioSIM library, summed over its worker processes.", ("component",))
+    queueDepth = Gauge("biosim_component_queue_depth", "Number of tasks or requests waiting for the component.", ("component",))
+    usesInProgress = Gauge("biosim_component_requests_in_progress", "Number of requests using the component.", ("component",))
+    componentLoaded = Gauge("biosim_component_loaded", "1 if the component is loaded, 0 otherwise.", ("component",))
+    workerRespawns = Gauge("biosim_component_worker_respawns", "Number of worker processes replaced since the component was loaded.", ("component",))
+    libraryStats = Gauge("biosim_wgout_library", "Statistics of the wgout library.", ("stat",))
+    normalsCacheStats = Gauge("biosim_normals_cache", "Statistics of the normals cache.", ("stat",))
+    coalescingStats = Gauge("biosim_coalescing", "Statistics of the coalescing of identical requests.", ("stat",))
+    pendingJobs = Gauge("biosim_jobs_pending", "Number of jobs queued or running.")
+    updaterStatus = Gauge("biosim_updater", "Status of the updater of the daily weather database.", ("stat",))
+
+    requestMetrics = [requestCount, requestErrors, requestLatency]
+    serverMetrics = [nativeCallDuration, busyTime]
+    collectedMetrics = [queueDepth, usesInProgress, componentLoaded, workerRespawns, libraryStats, normalsCacheStats,
+                        coalescingStats, pendingJobs, updaterStatus]
+
+    @staticmethod
+    def observeRequest(endpoint : str, statusCode : int, durationSec : float):
+        Metrics.requestCount.inc((endpoint, str(statusCode)))
+        if statusCode >= 400:
+            Metrics.requestErrors.inc((endpoint,))
+        Metrics.requestLatency.observe((endpoint,), durationSec)
+
+    @staticmethod
+    def observeNativeCall(component : str, call : str, durationSec : float):
+        Metrics.nativeCallDuration.observe((component, call), durationSec)
+        Metrics.busyTime.inc((component,), durationSec)
+
+    @staticmethod
+    def setNumericStats(gauge : Gauge, stats : dict):
+        gauge.clear()
+        for key, value in stats.items():
+            if isinstance(value, bool):
+                gauge.set((key,), 1 if value else 0)
+            elif isinstance(value, (int, float)):
+                gauge.set((key,), value)
+
+    @staticmethod
+    def collect(server):
+        '''
+        Update the gauges with the current state of the server.
+        '''
+        for gauge in [Metrics.queueDepth, Metrics.usesInProgress, Metrics.componentLoaded, Metrics.workerRespawns]:
+            gauge.clear()
+        for component in server.getComponents():
+            labelValues = (component.getComponentName(),)
+            Metrics.componentLoaded.set(labelValues, 1 if component.isLoaded() else 0)
+            Metrics.usesInProgress.set(labelValues, component.nbUsesInProgress)
+            Metrics.queueDepth.set(labelValues, component.getQueueDepth())
+            pool = getattr(component, "pool", None)
+            if pool is not None:
+                Metrics.workerRespawns.set(labelValues, pool.nbRespawns)
+        Metrics.setNumericStats(Metrics.libraryStats, server.getLibraryStats())
+        Metrics.setNumericStats(Metrics.normalsCacheStats, server.getNormalsCacheStats())
+        Metrics.setNumericStats(Metrics.coalescingStats, server.getCoalescingStats())
+        Metrics.pendingJobs.set((), server.jobScheduler.getNbPendingJobs())
+        Metrics.setNumericStats(Metrics.updaterStatus, server.getUpdaterStatus())
+
+    @staticmethod
+    def renderServerMetrics(server):
+        '''
+        Return the metrics of the server, which runs in this process, in the Prometheus text exposition format.
+        '''
+        Metrics.collect(server)
+        return Metrics.renderMetrics(Metrics.serverMetrics + Metrics.collectedMetrics)
+
+    @staticmethod
+    def renderMetrics(metrics : list):
+        lines = list()
+        for metric in metrics:
+            lines += metric.getLines()
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def render(server = None):
+        '''
+        Return the metrics in the Prometheus text exposition format.
+        @param server: the Server instance, or its proxy in a front end, whose metrics are appended or None to 
+        render only the metrics of the requests
+        '''
+        text = Metrics.renderMetrics(Metrics.requestMetrics)
+        if server is not None:
+            text += server.getMetricsText()
+        return text
@@ -4,75 +4,102 @@ Handle the different model types and the instantiation of models in BioSIM.
 @author: M. Fortin and R. Saint-Amant, Canadian Forest Service, August 2020
 @copyright: Her Majesty the Queen in right of Canada
 '''
-from multiprocessing import Queue, Process, Lock
+from multiprocessing import Queue, SimpleQueue
+from threading import Lock
+import time
 
+from biosim.bsbackend import BioSIM_API
 from biosim.bssettings import ModelType, Settings
 from biosim.bsrequest import ModelRequest
 from biosim.bsutility import TeleIODict, TeleIODictList
-import biosim.biosimdll.BioSIM_API as BioSIM_API
+from biosim.bspool import WorkerPool, LazyComponent
+from biosim.bstracing import Tracing
 
 
-def do_job(jobId, modelType : ModelType, tasks_to_accomplish : Queue, tasks_that_are_done : Queue):
+def do_job(workerId, modelType : ModelType, tasks_to_accomplish : Queue, tasks_that_are_done : SimpleQueue):
     '''
         This function is passed to a Process instance.
         
-        It first loads a weather generator associated with a context and then waits for requests to be sent through the
+        It first loads a model and then waits for requests to be sent through the
         tasks_to_accomplish Queue instance.
          
         The teleIO objects are converted into dict objects so that they can be sent back to the main process.
         Without conversion there would be a pickled exception. The dict are reconverted into teleIO object in the
         main process. 
         
+        The messages follow the protocol of the WorkerPool class. A failure of the model is sent back as 
+        an error message for this particular task so that the process keeps on running.
+        
         The code of this function was inspired by an example available on the JournalDev website at
         https://www.journaldev.com/15631/python-multiprocessing-example . We are thankful to the authors.
     '''
     innerModel = BioSIM_API.Model("Context name");
     initializationString = "Model=" + modelType.getPath();
     msg = innerModel.Initialize(initializationString)
-    if jobId == 0:
-        tasks_that_are_done.put(innerModel.GetWeatherVariablesNeeded())
-        tasks_that_are_done.put(innerModel.GetDefaultParameters())
-        tasks_that_are_done.put(innerModel.Help())
-        if msg != "Success":
-            raise Exception("Error: Failed to initialize model " + modelType.getName() + " - " + msg);
+    if msg != "Success":
+        tasks_that_are_done.put({"init" : workerId, "msg" : "Error: Failed to initialize model " + modelType.getName() + " - " + msg})
+        return ### we get out of the process, the msg has been sent to the main thread anyway
+    tasks_that_are_done.put({"init" : workerId, 
+                             "msg" : msg,
+                             "variables" : innerModel.GetWeatherVariablesNeeded(),
+                             "parameters" : innerModel.GetDefaultParameters(),
+                             "help" : innerModel.Help()})
     
     while True:
+        inputTeleIODict = tasks_to_accomplish.get()
+        tag = {"workerId" : workerId, 
+               "reqId" : inputTeleIODict["reqId"], 
+               "natOrd" : inputTeleIODict["natOrd"]}
+        tasks_that_are_done.put(dict(tag, started = True))
+        trace = Tracing.start()     ### the spans of the worker are sent back to the main process
         try:
-            inputTeleIODict = tasks_to_accomplish.get()
             parms = inputTeleIODict["parms"]
             lastDailyDate = inputTeleIODict["lastDailyDate"]
-            inputTeleIO = inputTeleIODict.getTeleIO()
-            outputTeleIO = innerModel.Execute(parms, inputTeleIO)
+            with Tracing.span("getTeleIO"):
+                inputTeleIO = inputTeleIODict.getTeleIO()
+            with Tracing.span("Execute"):
+                outputTeleIO = innerModel.Execute(parms, inputTeleIO)
             outputTeleIODict = TeleIODict(outputTeleIO, lastDailyDate, False)
-            outputTeleIODict["natOrd"] = inputTeleIODict["natOrd"]
-            tasks_that_are_done.put(outputTeleIODict)
+            outputTeleIODict.update(tag)
+            outputTeleIODict["spans"] = trace.getSpans()
         except Exception as error:
-            tasks_that_are_done(error)
+            outputTeleIODict = dict(tag, error = "Error: " + str(error))
+        tasks_that_are_done.put(outputTeleIODict)
 
 
 
-class Model():
+class Model(LazyComponent):
     
     '''
     A wrapper for models in BioSIM.
     '''
-    def __init__(self, modelType : ModelType):
+    def __init__(self, modelType : ModelType, lazy = False):
+        '''
+        Constructor
+        @param modelType: a ModelType enum
+        @param lazy: True to defer the initialization of the model until it is first used
+        '''
+        LazyComponent.__init__(self, modelType.name)
         self.lock = Lock()
         self.modelType = modelType
-         
+        self.climateVariableNeeded = None   ### these are set when the model is loaded and kept afterwards 
+        self.defaultParameters = None
+        self.help = None
+        self.pool = None
+        self.innerModel = None
+        if lazy == False:
+            self.ensureLoaded()
+
+    def load(self):
+        modelType = self.modelType
         if modelType.isMultiProcessEnabled():
-            self.processes = []
-            self.tasksToDo = Queue()
-            self.tasksDone = Queue()
-            for i in range(modelType.getNbProcesses()):   
-                p = Process(target=do_job, args = (i, modelType, self.tasksToDo, self.tasksDone))
-                self.processes.append(p)
-                p.start()
-            self.climateVariableNeeded = self.tasksDone.get().split("+")
-            self.defaultParameters = self.tasksDone.get().split("+")
-            self.help = self.tasksDone.get()
+            self.pool = WorkerPool(modelType.getName(), do_job, (modelType,), modelType.getNbProcesses())
+            initMessage = self.pool.start()[0]
+            self.climateVariableNeeded = initMessage["variables"].split("+")
+            self.defaultParameters = initMessage["parameters"].split("+")
+            self.help = initMessage["help"]
             if Settings.Verbose == True:
-                print("Successfully loaded model: " + modelType.getName() + " (" + str(len(self.processes)) + " processes)")
+                print("Successfully loaded model: " + modelType.getName() + " (" + str(self.pool.getNbProcesses()) + " processes)")
         else:
             self.innerModel = BioSIM_API.Model("Context name");
             initializationString = "Model=" + modelType.getPath();
@@ -86,46 +113,113 @@ class Model():
                     print("Successfully loaded model: " + modelType.getName())
             else:
                 raise Exception("Error: Failed to initialize model " + modelType.getName() + " - " + msg);
+
+    def unload(self):
+        if self.modelType.isMultiProcessEnabled():
+            self.pool.terminate()
+            self.pool = None
+        else:
+            self.innerModel = None
                     
+    def getNbProcesses(self):
+        return self.modelType.getNbProcesses()
+
     def getHelp(self):
+        if self.help is None:
+            self.ensureLoaded()
         return self.help
     
     def getDefaultParameters(self):
+        if self.defaultParameters is None:
+            self.ensureLoaded()
         return self.defaultParameters
     
     def doProcess(self, bioSimRequest : ModelRequest):
+        '''
+        Apply the model to each location. A failure at one location does not affect the 
+        others: the output of this location is then an invalid TeleIODict instance that
+        contains the error message. The model is loaded first if needed.
+        '''
+        self.beginUse()
+        try:
+            return self.__doProcess__(bioSimRequest)
+        finally:
+            self.endUse()
+
+    async def doProcessAsync(self, bioSimRequest : ModelRequest):
+        '''
+        The counterpart of the doProcess method in the async mode. In multiprocess mode, the coroutine waits
+        for the worker processes without holding a thread. Otherwise, the request is processed in a thread 
+        since the calls to the model are blocking.
+        '''
+        if not self.modelType.isMultiProcessEnabled():
+            return await self.runInThread(self.doProcess, bioSimRequest)
+        await self.runInThread(self.beginUse)     ### the component may have to be loaded and its lock may be held by another thread
+        try:
+            futures = self.pool.submit(self.createTasks(bioSimRequest))
+            await WorkerPool.waitAsync(futures)
+            return self.collectOutputs(futures, time.time())    ### the waiting is over
+        finally:
+            self.endUse()
+
+    def createTasks(self, bioSimRequest : ModelRequest):
+        '''
+        Create the tasks sent to the worker processes, one per location.
+        '''
+        tasks = list()
+        with Tracing.span("clone"):
+            for teleIODict in bioSimRequest.teleIODictList:
+                task = teleIODict.clone()
+                task["parms"] = bioSimRequest.parseRequest(0, None)
+                tasks.append(task)
+        return tasks
+
+    def collectOutputs(self, futures : list, deadline = None):
+        '''
+        Retrieve the outputs of the worker processes. The output of a failed task is an invalid TeleIODict instance.
+        @param deadline: the time until which the outputs are awaited (see the WorkerPool.getDeadline method), by default from now on
+        '''
+        if deadline is None:
+            deadline = WorkerPool.getDeadline()
+        outputTeleIODictList = TeleIODictList()
+        for future in futures:
+            try:
+                outputTeleIODictList.append(WorkerPool.getResult(future, deadline))
+            except Exception as error:
+                outputTeleIODictList.append(TeleIODict.createErrorInstance(str(error)))
+        return outputTeleIODictList
+
+    def __doProcess__(self, bioSimRequest : ModelRequest):
         outputTeleIODictList = TeleIODictList()
         inputTeleIODictList = bioSimRequest.teleIODictList
         nbLocations = len(inputTeleIODictList)
         if self.modelType.isMultiProcessEnabled():
-            mainDict = dict()
-            self.lock.acquire()     ### To avoid concurrent feeding of the taskToDo queue
-            for i in range(nbLocations):
-                teleIODict = inputTeleIODictList[i].clone()
-                teleIODict["natOrd"] = i
-                teleIODict["parms"] = bioSimRequest.parseRequest(0, None)
-                self.tasksToDo.put(teleIODict)
-            for i in range(nbLocations):
-                teleIODict = self.tasksDone.get()
-                naturalOrder = teleIODict["natOrd"]
-                del teleIODict["natOrd"]
-                mainDict[naturalOrder] = teleIODict
-            self.lock.release()      ### Release the lock for other threads
-            for i in range(nbLocations):
-                outputTeleIODictList.append(mainDict[i])
+            outputTeleIODictList = self.collectOutputs(self.pool.submit(self.createTasks(bioSimRequest)))
         else:
-            for i in range(nbLocations):
-                parms = bioSimRequest.parseRequest(0, None)
-                inputTeleIODict = inputTeleIODictList[i]
-                lastDailyDate = inputTeleIODict["lastDailyDate"]
-                inputTeleIO = inputTeleIODict.getTeleIO()
-                outputTeleIO = self.innerModel.Execute(parms, inputTeleIO)
-                outputTeleIODict = TeleIODict(outputTeleIO, lastDailyDate, False)
-                outputTeleIODictList.append(outputTeleIODict)
+            with Tracing.span("lockWait"):
+                self.lock.acquire()     ### The C++ instance is shared by all the threads
+            try:
+                for i in range(nbLocations):
+                    parms = bioSimRequest.parseRequest(0, None)
+                    inputTeleIODict = inputTeleIODictList[i]
+                    lastDailyDate = inputTeleIODict["lastDailyDate"]
+                    try:
+                        with Tracing.span("getTeleIO"):
+                            inputTeleIO = inputTeleIODict.getTeleIO()
+                        with Tracing.nativeCall(self.componentName, "Execute"):
+                            outputTeleIO = self.innerModel.Execute(parms, inputTeleIO)
+                        outputTeleIODict = TeleIODict(outputTeleIO, lastDailyDate, False)
+                    except Exception as error:
+                        outputTeleIODict = TeleIODict.createErrorInstance("Error: " + str(error))
+                    outputTeleIODictList.append(outputTeleIODict)
+            finally:
+                self.lock.release()
         return outputTeleIODictList
 
     def getRequiredVariables(self):
-            return self.climateVariableNeeded
+        if self.climateVariableNeeded is None:
+            self.ensureLoaded()
+        return self.climateVariableNeeded
 
 
 
@@ -0,0 +1,496 @@
+'''
+A pool of worker processes that can be shared by several concurrent requests.
+
+@author: M. Fortin and R. Saint-Amant, Canadian Forest Service, August 2020
+@copyright: Her Majesty the Queen in right of Canada
+'''
+from abc import ABC, abstractmethod
+from collections import deque
+from concurrent.futures import Future, TimeoutError
+from contextvars import copy_context
+from itertools import count
+from multiprocessing import Process, Queue, SimpleQueue
+from threading import Lock, Thread, Condition, Event, current_thread
+import asyncio
+import time
+
+from biosim.bssettings import Settings
+from biosim.bstracing import Tracing
+
+
+class WorkerPool():
+    '''
+    A pool of worker processes that receive their tasks one at a time.
+
+    Each task is tagged with a request id and its natural order within the request. The tasks wait in
+    the pool until a process is idle and they are then sent through the task queue of this particular
+    process. The pool therefore always knows which task each process is working on. A dispatcher
+    thread reads the results sent back by the processes, sets the future of the corresponding
+    task and sends the next waiting task to the process. Several requests can then be submitted 
+    concurrently without waiting for each other.
+
+    A supervisor thread checks the processes on a regular basis. A process that died or that has been
+    working on the same task for longer than the timeout is replaced by a new one and the future
+    of its task is set with an exception. The other tasks are not affected. A process that keeps failing
+    to initialize is respawned after an exponential backoff and it is given up after a maximum number of
+    attempts. The pool is then degraded and, once all its processes are given up, the pending tasks fail.
+
+    The target function receives the id of the worker, the args tuple and then the tasks_to_accomplish
+    Queue instance of the process and the tasks_that_are_done SimpleQueue instance. The messages it sends back are dict instances:
+        - upon initialization: {"init" : workerId, "msg" : "Success" or an error message, ...}
+        - before starting a task: {"started" : True, "workerId" : workerId, "reqId" : ..., "natOrd" : ...}
+        - once the task is done: the result with the "workerId", "reqId" and "natOrd" entries and optionally
+          a "spans" entry with the spans measured by the worker (see the Trace class)
+        - if the task failed: {"error" : message, "workerId" : workerId, "reqId" : ..., "natOrd" : ...}
+    '''
+
+    def __init__(self, name : str, target, args : tuple, nbProcesses : int):
+        '''
+        Constructor
+        @param name: the name of the pool for logging purposes
+        @param target: the function passed to the Process instances
+        @param args: the arguments of the target function, not including the worker id and the queues
+        @param nbProcesses: the number of processes
+        '''
+        self.name = name
+        self.target = target
+        self.args = args
+        self.nbProcesses = nbProcesses
+        self.tasksDone = SimpleQueue()   ### the messages are written synchronously so that they are not lost if a process dies
+        self.processes = dict()         ### workerId -> Process instance
+        self.taskQueues = dict()        ### workerId -> Queue instance of the process
+        self.waitingTasks = deque()     ### the tasks submitted but not sent to a process yet
+        self.idleWorkers = list()       ### the ids of the initialized processes without a task
+        self.tasksInProgress = dict()   ### workerId -> [(reqId, natOrd), start time] from the moment the task is sent to the process
+        self.pendingTasks = dict()      ### (reqId, natOrd) -> Future instance
+        self.taskTraces = dict()        ### (reqId, natOrd) -> [Trace instance of the request, submission time] for the traced requests
+        self.lock = Lock()
+        self.noMorePendingTask = Condition(self.lock)
+        self.requestIds = count()
+        self.dispatcher = None
+        self.supervisor = None
+        self.closed = Event()
+        self.nbRespawns = 0
+        self.respawnCounts = dict()     ### workerId -> number of respawns since the last successful initialization
+        self.respawnTimes = dict()      ### workerId -> time of the next respawn of a dead process
+        self.degraded = False           ### True once a process has been given up
+        self.successor = None           ### the pool that receives the tasks once this one is shut down
+
+    def startWorker(self, workerId : int):
+        self.taskQueues[workerId] = Queue()     ### a new queue since a process killed while reading would keep the lock of the queue
+        p = Process(target=self.target, args = (workerId,) + self.args + (self.taskQueues[workerId], self.tasksDone))
+        self.processes[workerId] = p
+        p.start()
+
+    def __assignTasks__(self):
+        '''
+        Send the waiting tasks to the idle processes. The lock must be held by the caller.
+        '''
+        while len(self.waitingTasks) > 0 and len(self.idleWorkers) > 0:
+            workerId = self.idleWorkers.pop()
+            task = self.waitingTasks.popleft()
+            self.tasksInProgress[workerId] = [(task["reqId"], task["natOrd"]), time.time()]
+            self.taskQueues[workerId].put(task)
+
+    def start(self):
+        '''
+        Start the processes and wait for their initialization messages.
+        @return: the initialization messages sorted by worker id
+        @raise exception: if one of the processes cannot be initialized
+        '''
+        for workerId in range(self.nbProcesses):
+            self.startWorker(workerId)
+        initMessages = dict()
+        for i in range(self.nbProcesses):
+            msg = self.tasksDone.get()
+            if msg["msg"] != "Success":
+                self.terminate()
+                raise Exception(msg["msg"])
+            initMessages[msg["init"]] = msg
+        self.idleWorkers = list(range(self.nbProcesses))
+        self.dispatcher = Thread(target=self.dispatch, name=self.name + "-dispatcher", daemon=True)
+        self.dispatcher.start()
+        self.supervisor = Thread(target=self.supervise, name=self.name + "-supervisor", daemon=True)
+        self.supervisor.start()
+        return [initMessages[workerId] for workerId in range(self.nbProcesses)]
+
+    def dispatch(self):
+        '''
+        Route the results to the futures of the pending tasks. A None result stops the dispatcher.
+        '''
+        while True:
+            result = self.tasksDone.get()
+            if result is None:
+                break
+            if "init" in result:    ### a respawned worker
+                if result["msg"] != "Success":
+                    print("Worker " + str(result["init"]) + " of " + self.name + " could not be respawned: " + result["msg"])
+                else:
+                    self.lock.acquire()
+                    self.respawnCounts.pop(result["init"], None)
+                    self.idleWorkers.append(result["init"])
+                    self.__assignTasks__()
+                    self.lock.release()
+                continue
+            workerId = result.pop("workerId")
+            key = (result.pop("reqId"), result.pop("natOrd"))
+            spans = result.pop("spans", None)
+            self.lock.acquire()
+            taskInProgress = self.tasksInProgress.get(workerId)
+            isCurrentTask = taskInProgress is not None and taskInProgress[0] == key     ### False for a message sent by a process that has been replaced since
+            if "started" in result:
+                if isCurrentTask:
+                    taskInProgress[1] = time.time()
+                future = None
+                taskTrace = self.taskTraces.get(key)
+            else:
+                if isCurrentTask:
+                    del self.tasksInProgress[workerId]
+                    self.idleWorkers.append(workerId)
+                    self.__assignTasks__()
+                future = self.pendingTasks.pop(key, None)
+                taskTrace = self.taskTraces.pop(key, None)
+                if len(self.pendingTasks) == 0:
+                    self.noMorePendingTask.notify_all()
+            self.lock.release()
+            if "started" in result:
+                if taskTrace is not None:
+                    taskTrace[0].add("queue", time.perf_counter() - taskTrace[1])
+            elif spans is not None:
+                Tracing.addWorkerSpans(self.name, None if taskTrace is None else taskTrace[0], spans)
+            if future is not None:
+                if "error" in result:
+                    future.set_exception(Exception(result["error"]))
+                else:
+                    future.set_result(result)
+
+    def supervise(self):
+        '''
+        Replace the processes that died or that exceed the task timeout. The future of the task
+        they were working on is set with an exception, whether or not the process had the time to 
+        report that it started the task.
+        '''
+        while not self.closed.wait(Settings.workerSupervisionIntervalSec):
+            for workerId in list(self.processes.keys()):
+                if self.respawnTimes.__contains__(workerId):     ### a dead process waiting for its respawn
+                    if time.time() >= self.respawnTimes[workerId] and not self.closed.is_set():
+                        del self.respawnTimes[workerId]
+                        self.__respawn__(workerId)
+                    continue
+                p = self.processes[workerId]
+                self.lock.acquire()
+                taskInProgress = self.tasksInProgress.get(workerId)
+                self.lock.release()
+                if not p.is_alive():
+                    reason = "terminated unexpectedly (exit code " + str(p.exitcode) + ")"
+                elif taskInProgress is not None and Settings.workerTaskTimeoutSec > 0 and time.time() - taskInProgress[1] > Settings.workerTaskTimeoutSec:
+                    reason = "exceeded the timeout of " + str(Settings.workerTaskTimeoutSec) + " sec."
+                    p.terminate()
+                    p.join()
+                else:
+                    continue
+                if self.closed.is_set():
+                    break
+                errorMessage = "Error: worker " + str(workerId) + " of " + self.name + " " + reason
+                print(errorMessage)
+                self.lock.acquire()
+                taskInProgress = self.tasksInProgress.pop(workerId, None)     ### read again since the dispatcher may have sent another task in the meantime
+                if workerId in self.idleWorkers:
+                    self.idleWorkers.remove(workerId)
+                future = None
+                if taskInProgress is not None:
+                    future = self.pendingTasks.pop(taskInProgress[0], None)
+                    self.taskTraces.pop(taskInProgress[0], None)
+                    if len(self.pendingTasks) == 0:
+                        self.noMorePendingTask.notify_all()
+                nbRespawns = self.respawnCounts.get(workerId, 0)
+                self.lock.release()
+                if future is not None:
+                    future.set_exception(Exception(errorMessage))
+                if nbRespawns == 0:
+                    self.__respawn__(workerId)
+                elif nbRespawns < Settings.workerMaxRespawns:    ### the process did not initialize since its last respawn
+                    self.respawnTimes[workerId] = time.time() + Settings.workerSupervisionIntervalSec * 2 ** nbRespawns
+                else:
+                    self.__giveUpWorker__(workerId)
+
+    def __respawn__(self, workerId : int):
+        self.lock.acquire()
+        self.respawnCounts[workerId] = self.respawnCounts.get(workerId, 0) + 1
+        self.nbRespawns += 1
+        self.lock.release()
+        self.startWorker(workerId)
+
+    def __giveUpWorker__(self, workerId : int):
+        '''
+        Stop respawning a process that fails to initialize. The pool is then degraded and, if no process
+        is left, the pending tasks fail.
+        '''
+        print("Error: worker " + str(workerId) + " of " + self.name + " is given up after " + str(Settings.workerMaxRespawns) + " failed respawns")
+        self.lock.acquire()
+        del self.processes[workerId]
+        del self.taskQueues[workerId]
+        self.degraded = True
+        if len(self.processes) == 0:
+            self.__failPendingTasks__("Error: the worker pool " + self.name + " is degraded: its processes could not be respawned")
+        self.lock.release()
+
+    def __failPendingTasks__(self, message : str):
+        '''
+        Set the futures of the pending tasks with an exception. The lock must be held by the caller.
+        '''
+        for future in self.pendingTasks.values():
+            future.set_exception(Exception(message))
+        self.pendingTasks.clear()
+        self.taskTraces.clear()
+        self.waitingTasks.clear()
+        self.noMorePendingTask.notify_all()
+
+    def submit(self, tasks : list):
+        '''
+        Tag the tasks with a new request id and send them to the idle processes. The other tasks wait
+        until a process completes its task.
+        @param tasks: a list of dict instances
+        @return: a list of Future instances in the same order as the tasks
+        '''
+        reqId = next(self.requestIds)
+        futures = list()
+        trace = Tracing.getCurrentTrace()
+        submitted = time.perf_counter()
+        self.lock.acquire()
+        if self.successor is not None:  ### the caller got this pool before it was replaced
+            self.lock.release()
+            return self.successor.submit(tasks)
+        if len(self.processes) == 0 and self.degraded:
+            self.lock.release()
+            futures = [Future() for task in tasks]
+            for future in futures:
+                future.set_exception(Exception("Error: the worker pool " + self.name + " is degraded: its processes could not be respawned"))
+            return futures
+        for i in range(len(tasks)):
+            tasks[i]["reqId"] = reqId
+            tasks[i]["natOrd"] = i
+            future = Future()
+            self.pendingTasks[(reqId, i)] = future
+            if trace is not None:
+                self.taskTraces[(reqId, i)] = [trace, submitted]
+            futures.append(future)
+        self.waitingTasks.extend(tasks)
+        self.__assignTasks__()
+        self.lock.release()
+        return futures
+
+    def process(self, tasks : list):
+        '''
+        Submit the tasks and wait for their results.
+        @return: the list of results in the same order as the tasks
+        @raise exception: if one of the tasks failed
+        '''
+        futures = self.submit(tasks)
+        deadline = WorkerPool.getDeadline()
+        return [WorkerPool.getResult(future, deadline) for future in futures]
+
+    @staticmethod
+    def getDeadline():
+        '''
+        Return the time until which a request waits for the results of its tasks according to the 
+        workerResultTimeoutSec setting, or None if the wait is not bounded.
+        '''
+        if Settings.workerResultTimeoutSec > 0:
+            return time.time() + Settings.workerResultTimeoutSec
+        else:
+            return None
+
+    @staticmethod
+    def getResult(future : Future, deadline = None):
+        '''
+        Wait for the result of a future returned by the submit method so that a request cannot wait forever.
+        @param deadline: the time returned by the getDeadline method or None to wait without bound
+        @raise exception: if the task failed or if the deadline is exceeded
+        '''
+        timeout = None if deadline is None else max(0, deadline - time.time())
+        try:
+            return future.result(timeout)
+        except TimeoutError:
+            raise Exception("Error: the result of the task was not received within " + str(Settings.workerResultTimeoutSec) + " sec.")
+
+    @staticmethod
+    async def waitAsync(futures : list):
+        '''
+        Wait for the futures returned by the submit method without holding a thread, in the async mode. 
+        The futures are shielded since they are set by the dispatcher: cancelling the caller does not
+        cancel the tasks. The wait is bounded by the workerResultTimeoutSec setting as in the getResult 
+        method. The results are then retrieved with the getResult method and a deadline already reached so
+        that the futures still pending once the timeout is exceeded fail at once.
+        '''
+        timeout = Settings.workerResultTimeoutSec if Settings.workerResultTimeoutSec > 0 else None
+        try:
+            await asyncio.wait_for(asyncio.gather(*[asyncio.shield(asyncio.wrap_future(future)) for future in futures], return_exceptions = True), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def shutdown(self, successor = None):
+        '''
+        Wait until the pending tasks are completed and terminate the processes.
+        @param successor: an optional WorkerPool instance that replaces this one: the tasks submitted in the meantime are forwarded to it
+        '''
+        self.lock.acquire()
+        self.successor = successor
+        while len(self.pendingTasks) > 0:
+            self.noMorePendingTask.wait()
+        self.lock.release()
+        self.terminate()
+
+    def terminate(self):
+        '''
+        Terminate the processes, the dispatcher and the supervisor. The tasks still pending are cancelled.
+        '''
+        self.closed.set()
+        if self.supervisor is not None and current_thread() is not self.supervisor:
+            self.supervisor.join()
+        if self.dispatcher is not None:     ### before the processes are terminated since a process killed while writing would keep the lock of the queue
+            self.tasksDone.put(None)
+            if current_thread() is not self.dispatcher:
+                self.dispatcher.join()
+        for p in self.processes.values():
+            p.terminate()
+        self.lock.acquire()
+        self.__failPendingTasks__("The worker pool " + self.name + " has been terminated")
+        self.lock.release()
+
+    def getNbProcesses(self):
+        return len(self.processes)
+
+    def isDegraded(self):
+        return self.degraded
+
+    def getNbQueuedTasks(self):
+        '''
+        Return the number of tasks submitted but not sent to a process yet.
+        '''
+        self.lock.acquire()
+        nbQueuedTasks = len(self.waitingTasks)
+        self.lock.release()
+        return nbQueuedTasks
+
+    def getProcessIds(self):
+        return [p.pid for p in self.processes.values()]
+
+
+class LazyComponent(ABC):
+    '''
+    A component whose initialization can be deferred until it is first used and which can 
+    be unloaded after a period of inactivity.
+
+    Derived classes implement the load and unload methods and surround each use of the component
+    by calls to the beginUse and endUse methods. The component is loaded at most once at a time 
+    thanks to its initialization lock.
+    '''
+
+    def __init__(self, componentName : str):
+        self.componentName = componentName
+        self.initLock = Lock()
+        self.loaded = False
+        self.nbUsesInProgress = 0
+        self.lastUsed = time.time()
+        self.pool = None        ### the WorkerPool instance of the component if it runs in worker processes
+
+    @abstractmethod
+    def load(self):
+        pass
+
+    @abstractmethod
+    def unload(self):
+        pass
+
+    @abstractmethod
+    def getNbProcesses(self):
+        '''
+        Return the number of worker processes of this component. A component with a single process
+        is loaded in the main process.
+        '''
+        pass
+
+    def getProcessIds(self):
+        '''
+        Return the ids of the worker processes or an empty list if the component is loaded in the main process.
+        '''
+        if self.getNbProcesses() > 1 and self.pool is not None:
+            return self.pool.getProcessIds()
+        else:
+            return []
+
+    def getComponentName(self):
+        return self.componentName
+
+    def getQueueDepth(self):
+        '''
+        Return the number of tasks waiting for a worker process or, if the component is loaded in the main
+        process, the number of requests waiting for the lock of the component.
+        '''
+        pool = self.pool
+        if pool is not None:
+            return pool.getNbQueuedTasks()
+        else:
+            return max(0, self.nbUsesInProgress - 1)
+
+    def isLoaded(self):
+        return self.loaded
+
+    def ensureLoaded(self):
+        '''
+        Load the component if it has not been loaded yet.
+        '''
+        self.initLock.acquire()
+        try:
+            if not self.loaded:
+                self.load()
+                self.loaded = True
+                self.lastUsed = time.time()
+        finally:
+            self.initLock.release()
+
+    def beginUse(self):
+        '''
+        Load the component if needed and prevent it from being unloaded until endUse is called.
+        '''
+        self.initLock.acquire()
+        try:
+            if not self.loaded:
+                self.load()
+                self.loaded = True
+            self.nbUsesInProgress += 1
+        finally:
+            self.initLock.release()
+
+    def endUse(self):
+        self.initLock.acquire()
+        self.nbUsesInProgress -= 1
+        self.lastUsed = time.time()
+        self.initLock.release()
+
+    @staticmethod
+    async def runInThread(function, *args):
+        '''
+        Run the function in a thread of the default executor of the event loop, in the async mode. This is
+        used for the components loaded in the main process, whose calls are blocking. The thread carries on
+        the trace of the request.
+        '''
+        return await asyncio.get_running_loop().run_in_executor(None, copy_context().run, function, *args)
+
+    def unloadIfIdle(self, idleDelaySec : float):
+        '''
+        Unload the component if it is not in use and it has not been used for longer than the delay.
+        @return: True if the component has been unloaded
+        '''
+        self.initLock.acquire()
+        try:
+            if self.loaded and self.nbUsesInProgress == 0 and time.time() - self.lastUsed > idleDelaySec:
+                self.unload()
+                self.loaded = False
+                if Settings.Verbose == True:
+                    print("Unloaded idle component: " + self.componentName)
+                return True
+            return False
+        finally:
+            self.initLock.release()
@@ -5,8 +5,13 @@ Different classes  of requests for normals, weather generation and model applica
 @copyright: Her Majesty the Queen in right of Canada
 '''
 from collections import OrderedDict
+import csv
+import io
+import json
 import math
 
+import numpy as np
+
 from biosim.bssettings import Context, ShortNormals, RCP, ClimateModel, ModelType, \
     Settings
 from biosim.bsutility import TeleIODictList
@@ -41,7 +46,7 @@ climModDict = {"Hadley" : ClimateModel.Hadley,
                    "RCM4" : ClimateModel.RCM4,
                    "GCM4" : ClimateModel.GCM4}
 
-formats = ["CSV", "JSON"]
+formats = ["CSV", "JSON", "NDJSON"]
 
    
     
@@ -91,43 +96,37 @@ class AbstractRequest:
         """
         
         listDoubleParsed = ["lat", "long", "elev"]
-        listIntParsed = ["from", "to", "compress", "rep", "nb_nearest_neighbor", "repmodel"]
+        listIntParsed = ["from", "to", "compress", "rep", "nb_nearest_neighbor", "repmodel", "seed"]
         errMsg = ""
         newDict = {}
         self.n = None
         
+        lengths = set()
         for key in d:
             try:
                 if key in listDoubleParsed:
                     value = d.get(key)
-                    args = value.split()
-                    length = len(args)
-                    if self.n is None:
-                        self.n = length
-                        self.checkIfNBustsMaxCapacity()
-                    elif self.n != length:
-                        raise BioSimRequestException("Error: the number of coordinates seems to be inconsistent. Typically more latitudes than longitudes.")  
-                    for i in range(length):
-                        if key == "elev":       ### special case for elev: a NAN can be passed and then BioSim will rely on the DEM
-                            try:
-                                args[i] = float(args[i])
-                            except:
-                                args[i] = float('NaN')
-                        else:
-                            v = float(args[i])
-                            if math.isnan(v):
-                                raise Exception("NaN is not accepted for parameter " + key)
-                            else:
-                                args[i] = v
-                    newDict.__setitem__(key, args) 
+                    if isinstance(value, str):
+                        value = value.split()
+                    coordinates, invalidIndices = AbstractRequest.parseFloatArray(value)    ### the values that cannot be parsed are NaN
+                    if key != "elev":       ### special case for elev: a NAN can be passed and then BioSim will rely on the DEM
+                        invalidIndices = np.flatnonzero(np.isnan(coordinates))
+                        if len(invalidIndices) > 0:
+                            errMsg = self.updateErrMsg(errMsg, "the " + key + " parameter cannot be parsed or is NaN at indices " + str(invalidIndices.tolist()))
+                    lengths.add(len(coordinates))
+                    newDict.__setitem__(key, coordinates) 
                 elif key in listIntParsed:
                     newDict.__setitem__(key, int(d.get(key))) 
                 else:
                     newDict.__setitem__(key, d.get(key)) 
-            except BioSimRequestException as err:  ### obvious exception that are immediately thrown
-                raise err 
             except:  ### other exception of parsing
                 errMsg = self.updateErrMsg(errMsg, "the " + key + " parameter cannot be parsed")
+
+        if len(lengths) > 1:
+            raise BioSimRequestException("Error: the number of coordinates seems to be inconsistent. Typically more latitudes than longitudes.")  
+        elif len(lengths) == 1:
+            self.n = lengths.pop()
+            self.checkIfNBustsMaxCapacity()
                     
         if errMsg.__len__() > 0:
             raise BioSimRequestException(errMsg)
@@ -135,6 +134,86 @@ class AbstractRequest:
             return newDict
 
 
+    @staticmethod
+    def mergeRequestBody(d : dict, body : str, contentType : str):
+        '''
+        Merge the parameters of the query string with those of the body of a POST request. The body is
+        either a JSON object or a CSV table with one column per parameter. In a JSON object, the lists are
+        the columns and the other values are ordinary parameters. The coordinates are parsed and validated
+        as arrays.
+        @param d: the parameters of the query string
+        @param body: the body of the request
+        @param contentType: the content type of the body (application/json or text/csv)
+        @return: a dict instance
+        @raise BioSimRequestException: if the body cannot be parsed or if some coordinates are invalid
+        '''
+        newDict = dict(d)
+        columns = dict()
+        if contentType is not None and "json" in contentType:
+            try:
+                content = json.loads(body)
+            except ValueError as error:
+                raise BioSimRequestException("Error: the body of the request is not valid JSON: " + str(error))
+            if not isinstance(content, dict):
+                raise BioSimRequestException("Error: the body of the request must be a JSON object!")
+            for key, value in content.items():
+                if isinstance(value, list):
+                    columns[key] = value
+                else:
+                    newDict[key] = str(value)
+        elif contentType is not None and "csv" in contentType:
+            rows = list(csv.reader(io.StringIO(body)))
+            rows = [row for row in rows if len(row) > 0]
+            if len(rows) == 0:
+                raise BioSimRequestException("Error: the body of the request is empty!")
+            header = [field.strip() for field in rows[0]]
+            if min([len(row) for row in rows]) != len(header) or max([len(row) for row in rows]) != len(header):
+                raise BioSimRequestException("Error: the number of values does not match the number of fields in the header of the body!")
+            for j in range(len(header)):
+                columns[header[j]] = [row[j].strip() for row in rows[1:]]
+        else:
+            raise BioSimRequestException("Error: the body of a POST request must be either application/json or text/csv!")
+
+        errMsg = ""
+        lengths = set()
+        for key, values in columns.items():
+            if key in ["lat", "long", "elev"]:
+                coordinates, invalidIndices = AbstractRequest.parseFloatArray(values)
+                if key == "elev":       ### special case for elev: a NAN can be passed and then BioSim will rely on the DEM
+                    coordinates[invalidIndices] = float("NaN")
+                else:
+                    invalidIndices = np.flatnonzero(np.isnan(coordinates))   ### the values that cannot be parsed are NaN as well
+                    if len(invalidIndices) > 0:
+                        errMsg += ("" if len(errMsg) == 0 else ", ") + "the " + key + " values at indices " + str(invalidIndices.tolist()) + " cannot be parsed"
+                newDict[key] = coordinates
+            else:
+                newDict[key] = " ".join([str(v) for v in values])    ### e.g. the wgout references
+            lengths.add(len(values))
+        if len(errMsg) > 0:
+            raise BioSimRequestException("Error: " + errMsg)
+        if len(lengths) > 1:
+            raise BioSimRequestException("Error: the columns of the body of the request do not have the same number of values!")
+        return newDict
+
+    @staticmethod
+    def parseFloatArray(values : list):
+        '''
+        Parse a list of values into an array of floats
+        @return: the array and the array of the indices of the values that could not be parsed (these are set to NaN)
+        '''
+        try:
+            return np.array(values, dtype=float), np.array([], dtype=int)
+        except (ValueError, TypeError):
+            coordinates = np.full(len(values), float("NaN"))
+            invalidIndices = list()
+            for i in range(len(values)):
+                try:
+                    coordinates[i] = float(values[i])
+                except (ValueError, TypeError):
+                    invalidIndices.append(i)
+            return coordinates, np.array(invalidIndices, dtype=int)
+
+
     def updateErrMsg(self, errMsg, newMessage):
         if errMsg.__len__() == 0:
             errMsg += "Error: " + newMessage
@@ -146,21 +225,11 @@ class AbstractRequest:
     def checkParmsValues(self, d : dict):
         errMsg = ""
 
-        latValues = d.get("lat")
-        for latValue in latValues:
-            if latValue < self.minLatDeg or latValue > self.maxLatDeg:
-                errMsg = self.updateErrMsg(errMsg, "the latitude must range between " + str(self.minLatDeg) + " and " + str(self.maxLatDeg))
-
-        longValues = d.get("long")
-        for longValue in longValues:
-            if longValue < self.minLongDeg or longValue > self.maxLongDeg:
-                errMsg = self.updateErrMsg(errMsg, "the longitude must range between " + str(self.minLongDeg) + " and " + str(self.maxLongDeg))
+        errMsg = self.__checkRange__(errMsg, d.get("lat"), self.minLatDeg, self.maxLatDeg, "latitude")
+        errMsg = self.__checkRange__(errMsg, d.get("long"), self.minLongDeg, self.maxLongDeg, "longitude")
         if d.__contains__("elev"):
             elevValues = d.get("elev")
-            for elevValue in elevValues:
-                if math.isnan(elevValue):
-                    if elevValue < self.minElevM or elevValue > self.maxElevM:
-                        errMsg = self.updateErrMsg(errMsg, "the elevation must range between " + str(self.minElevM) + " and " + str(self.maxElevM))    
+            errMsg = self.__checkRange__(errMsg, elevValues[~np.isnan(elevValues)], self.minElevM, self.maxElevM, "elevation", np.flatnonzero(~np.isnan(elevValues)))
 
         if d.__contains__("rcp"):
             rcpString = d.get("rcp")
@@ -190,6 +259,18 @@ class AbstractRequest:
         return errMsg
 
 
+    def __checkRange__(self, errMsg : str, values, minValue : float, maxValue : float, name : str, indices = None):
+        '''
+        Check the range of an array of values in a single pass and report the offending indices.
+        @param indices: the indices of the values in the request if they differ from their positions in the array
+        '''
+        outOfRange = np.flatnonzero((values < minValue) | (values > maxValue))
+        if len(outOfRange) > 0:
+            if indices is not None:
+                outOfRange = indices[outOfRange]
+            errMsg = self.updateErrMsg(errMsg, "the " + name + " must range between " + str(minValue) + " and " + str(maxValue) + " (indices " + str(outOfRange.tolist()) + ")")
+        return errMsg
+
     def getRCP(self):
         return self.dict.get("rcp")
 
@@ -206,11 +287,33 @@ class AbstractRequest:
         return requestString
 
 
+    def isCoalescable(self):
+        '''
+        Return True if identical requests produce identical outputs so that concurrent duplicates can share them.
+        '''
+        return True
+
+    def getCoalescingKey(self):
+        '''
+        Return a hashable key made of the parameters that affect the outputs. The format is ignored.
+        '''
+        items = list()
+        for key in sorted(self.dict.keys()):
+            if key != "format":
+                value = self.dict.get(key)
+                if isinstance(value, np.ndarray):
+                    value = value.tobytes()
+                items.append((key, value))
+        return (self.__class__.__name__,) + tuple(items)
+
     def isJSONFormatRequested(self):
         if (self.dict.__contains__("format")):
             if self.dict.get("format") == "JSON":
                 return True 
         return False
+
+    def isNDJSONFormatRequested(self):
+        return self.dict.get("format") == "NDJSON"
     
     def doesThisContextMatch(self, context : Context):
         return True
@@ -218,10 +321,10 @@ class AbstractRequest:
     def checkIfNBustsMaxCapacity(self):
         if isinstance(self, NormalsRequest):
             if self.n > Settings.nbMaxCoordinatesNormals:
-                raise BioSimRequestException("The maximum number of coordinates when requesting the normals is limited to " + str(AbstractRequest.nbMaxCoordinatesNormals))
+                raise BioSimRequestException("The maximum number of coordinates when requesting the normals is limited to " + str(Settings.nbMaxCoordinatesNormals))
         else: 
             if self.n > Settings.nbMaxCoordinatesWG:
-                raise BioSimRequestException("The maximum number of coordinates in a climate generation request is limited to " + str(AbstractRequest.nbMaxCoordinatesWG))
+                raise BioSimRequestException("The maximum number of coordinates in a climate generation request is limited to " + str(Settings.nbMaxCoordinatesWG))
 
     @staticmethod
     def parseVariableRequestString(variables):
@@ -274,6 +377,32 @@ class NormalsRequest(AbstractRequest):
 
     def getShortNormalsEnum(self):
         return self.dict.get("period")
+
+    def getCacheKey(self, i, coordinateTolerance : float, elevationTolerance : float):
+        '''
+        Provide a normalized key for location i. The coordinates are rounded to the tolerances
+        so that nearly identical locations share the same key. The RCP and the climate model are
+        ignored for past climate normals since they do not change the outputs.
+        @param i: the index of the location
+        @param coordinateTolerance: the rounding tolerance of the latitude and longitude (degrees)
+        @param elevationTolerance: the rounding tolerance of the elevation (m)
+        @return: a tuple
+        '''
+        shortNorm = self.getShortNormalsEnum()
+        if shortNorm.isPastClimate():
+            rcp = None
+            climMod = None
+        else:
+            rcp = self.getRCP()
+            climMod = self.getClimateModel()
+        lat = round(self.dict.get("lat")[i] / coordinateTolerance)
+        lon = round(self.dict.get("long")[i] / coordinateTolerance)
+        elev = None     ### None stands for an elevation provided by the DEM
+        if self.dict.__contains__("elev"):
+            elevValue = self.dict.get("elev")[i]
+            if math.isnan(elevValue) == False:
+                elev = round(elevValue / elevationTolerance)
+        return (shortNorm, rcp, climMod, lat, lon, elev)
     
     
 class SimpleModelRequest(AbstractRequest):
@@ -316,6 +445,13 @@ class SimpleModelRequest(AbstractRequest):
         else:
             return 1
 
+    def isCoalescable(self):
+        '''
+        The replications of a model are stochastic: the outputs of identical requests are identical only if
+        they are seeded or if no replication is requested.
+        '''
+        return not self.dict.__contains__("repmodel") or self.dict.__contains__("seed")
+
 class ModelRequest(SimpleModelRequest):
     '''
     A class that handles the request to a particular model 
@@ -335,7 +471,7 @@ class ModelRequest(SimpleModelRequest):
         self.n = len(keys)
         self.checkIfNBustsMaxCapacity()
         teleIODictList = TeleIODictList.getTeleIODictList(keys)
-        if teleIODictList is None:
+        if len(teleIODictList) != len(keys):
             errMsg = self.updateErrMsg(errMsg, "The wgout object reference is not found in the library!");
         else: 
             self.teleIODictList = teleIODictList
@@ -438,6 +574,9 @@ class WeatherGeneratorRequest(AbstractRequest):
             
         if self.dict.__contains__("nb_nearest_neighbor"):
             requestString += "&nb_nearest_neighbor=" + str(self.dict.get("nb_nearest_neighbor"))
+
+        if self.dict.__contains__("seed"):
+            requestString += "&Seed=" + str(self.dict.get("seed"))
                                                            
         return requestString
 
@@ -475,8 +614,20 @@ class WeatherGeneratorRequest(AbstractRequest):
         else:
             return 1
     
+    def isCoalescable(self):
+        '''
+        The weather generation is stochastic: the outputs of identical requests are identical only if they are seeded.
+        '''
+        return self.dict.__contains__("seed")
+
     def isForceClimateGenerationEnabled(self):
         return self.dict.get("source") == "FromNormals"
+
+    def getNamespace(self):
+        '''
+        Return the namespace under which the outputs are registered in the library (ns parameter) or None
+        '''
+        return self.dict.get("ns")
         
         
     
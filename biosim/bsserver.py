@@ -5,7 +5,10 @@ and handles the requests sent to them.
 @author: M. Fortin and R. Saint-Amant, Canadian Forest Service, August 2020
 @copyright: Her Majesty the Queen in right of Canada
 '''
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
 from multiprocessing import Queue, Process
+import asyncio
 import os
 import shutil
 import subprocess
@@ -13,15 +16,29 @@ import threading
 import time
 import zipfile
 
+try:
+    import psutil      ### optional, only used to report the memory footprint of the components at startup
+except ImportError:
+    psutil = None
+
+from biosim.bsbackend import BioSIM_API
+from biosim.bsjobs import JobScheduler
+from biosim.bsmetrics import Metrics
 from biosim.bsmodel import Model
 from biosim.bsrequest import AbstractRequest, ModelRequest, WeatherGeneratorRequest, NormalsRequest, \
     WeatherGeneratorEpheremalRequest, TeleIODictList
 from biosim.bssettings import Context, Shore, Normals, Daily, DEM, Gribs, ClimateModel, RCP, ModelType, \
-    CurrentDailyHandler, Settings
-from biosim.bswrappers import BioSimNormalsAndWeatherGeneratorWrapper
+    CurrentDaily, CurrentDailyHandler, Settings
+from biosim.bsstore import createWgoutStore
+from biosim.bstracing import Tracing
+from biosim.bsutility import LRUCache, BioSimUtility, SingleFlight
+from biosim.bswrappers import BioSimNormalsAndWeatherGeneratorWrapper, StandbyInstance
 
 PastClimateGeneration = "PastClimateForGeneration"
 
+NormalsIsolationGroup = "Normals"
+GenerationIsolationGroup = "Generation"
+
 class Server:
     '''
     Handles the initialization of the different instances of BioSim, of the available models
@@ -48,6 +65,11 @@ class Server:
                 self.nbProcessesForWrappers = 2
         else: 
             self.nbProcessesForWrappers = 1
+
+        if Settings.MultiprocessMode:
+            self.nbProcessesForNormals = Settings.nbProcessesNormals
+        else:
+            self.nbProcessesForNormals = 1
             
         print("Loading contexts and models...")    
         if Settings.MinimalConfiguration:
@@ -75,45 +97,47 @@ class Server:
                   Normals.CanUSA2051_2080GCM485, Normals.CanUSA2061_2090GCM485, Normals.CanUSA2071_2100GCM485]
                     
 
+        self.wrappers = dict()      ### the registry of the wrappers (see the getSharedWrapper method)
+        
         self.normals = dict()
         self.normals.__setitem__(RCP.PastClimate, dict())
         self.normals.__setitem__(RCP.RCP45, self.setClimateModelsInDict(True)) ### true a dict and not a list
         self.normals.__setitem__(RCP.RCP85, self.setClimateModelsInDict(True)) ### true a dict and not a list
         
         for norm in pastClimateNormals:
-            context = Context(Shore.Shore1, norm, None, DEM.WorldWide30sec, Gribs.HRDPS_daily)
-            wrapper = BioSimNormalsAndWeatherGeneratorWrapper(context)
+            context = Context(Shore.Shore1, norm, None, DEM.WorldWide30sec, Gribs.HRDPS_daily, nbProcesses=self.nbProcessesForNormals)
+            wrapper = self.getSharedWrapper(context, NormalsIsolationGroup)
             self.normals.get(RCP.PastClimate).__setitem__(context.normals.getShortNormals(), wrapper)
 
         for norm in rcm445:
-            context = Context(Shore.Shore1, norm, None, DEM.WorldWide30sec, Gribs.HRDPS_daily)
-            wrapper = BioSimNormalsAndWeatherGeneratorWrapper(context)
+            context = Context(Shore.Shore1, norm, None, DEM.WorldWide30sec, Gribs.HRDPS_daily, nbProcesses=self.nbProcessesForNormals)
+            wrapper = self.getSharedWrapper(context, NormalsIsolationGroup)
             self.normals.get(RCP.RCP45).get(ClimateModel.RCM4).__setitem__(context.normals.getShortNormals(), wrapper)
 
         if Settings.MinimalConfiguration == False:            
             for norm in hadley45:
-                context = Context(Shore.Shore1, norm, None, DEM.WorldWide30sec, Gribs.HRDPS_daily)
-                wrapper = BioSimNormalsAndWeatherGeneratorWrapper(context)
+                context = Context(Shore.Shore1, norm, None, DEM.WorldWide30sec, Gribs.HRDPS_daily, nbProcesses=self.nbProcessesForNormals)
+                wrapper = self.getSharedWrapper(context, NormalsIsolationGroup)
                 self.normals.get(RCP.RCP45).get(ClimateModel.Hadley).__setitem__(context.normals.getShortNormals(), wrapper)
             
             for norm in hadley85:
-                context = Context(Shore.Shore1, norm, None, DEM.WorldWide30sec, Gribs.HRDPS_daily)
-                wrapper = BioSimNormalsAndWeatherGeneratorWrapper(context)
+                context = Context(Shore.Shore1, norm, None, DEM.WorldWide30sec, Gribs.HRDPS_daily, nbProcesses=self.nbProcessesForNormals)
+                wrapper = self.getSharedWrapper(context, NormalsIsolationGroup)
                 self.normals.get(RCP.RCP85).get(ClimateModel.Hadley).__setitem__(context.normals.getShortNormals(), wrapper)
    
             for norm in rcm485:
-                context = Context(Shore.Shore1, norm, None, DEM.WorldWide30sec, Gribs.HRDPS_daily)
-                wrapper = BioSimNormalsAndWeatherGeneratorWrapper(context)
+                context = Context(Shore.Shore1, norm, None, DEM.WorldWide30sec, Gribs.HRDPS_daily, nbProcesses=self.nbProcessesForNormals)
+                wrapper = self.getSharedWrapper(context, NormalsIsolationGroup)
                 self.normals.get(RCP.RCP85).get(ClimateModel.RCM4).__setitem__(context.normals.getShortNormals(), wrapper)
     
             for norm in gcm445:
-                context = Context(Shore.Shore1, norm, None, DEM.WorldWide30sec, Gribs.HRDPS_daily)
-                wrapper = BioSimNormalsAndWeatherGeneratorWrapper(context)
+                context = Context(Shore.Shore1, norm, None, DEM.WorldWide30sec, Gribs.HRDPS_daily, nbProcesses=self.nbProcessesForNormals)
+                wrapper = self.getSharedWrapper(context, NormalsIsolationGroup)
                 self.normals.get(RCP.RCP45).get(ClimateModel.GCM4).__setitem__(context.normals.getShortNormals(), wrapper)
     
             for norm in gcm485:
-                context = Context(Shore.Shore1, norm, None, DEM.WorldWide30sec, Gribs.HRDPS_daily)
-                wrapper = BioSimNormalsAndWeatherGeneratorWrapper(context)
+                context = Context(Shore.Shore1, norm, None, DEM.WorldWide30sec, Gribs.HRDPS_daily, nbProcesses=self.nbProcessesForNormals)
+                wrapper = self.getSharedWrapper(context, NormalsIsolationGroup)
                 self.normals.get(RCP.RCP85).get(ClimateModel.GCM4).__setitem__(context.normals.getShortNormals(), wrapper)
         
         
@@ -137,56 +161,92 @@ class Server:
             finalDate = context.daily.getFinalDateYr();
             if finalDate > self.lastDailyDate:
                 self.lastDailyDate = finalDate;
-            wrapper = BioSimNormalsAndWeatherGeneratorWrapper(context)
+            wrapper = self.getSharedWrapper(context, GenerationIsolationGroup)
             self.weatherGen.get(RCP.PastClimate).append(wrapper)
         
         for norm in pastClimateNormals:         ### those serve for the climate generation. The wrapper for the normals dict cannot be used since the weather generation interferes with the normals
             context = Context(Shore.Shore1, norm, None, DEM.WorldWide30sec, Gribs.HRDPS_daily)
-            wrapper = BioSimNormalsAndWeatherGeneratorWrapper(context)
+            wrapper = self.getSharedWrapper(context, GenerationIsolationGroup)
             self.weatherGen.get(PastClimateGeneration).append(wrapper)
         
         for norm in rcm445:
             context = Context(Shore.Shore1, norm, None, DEM.WorldWide30sec, Gribs.HRDPS_daily, nbProcesses=self.nbProcessesForWrappers)
-            wrapper = BioSimNormalsAndWeatherGeneratorWrapper(context)
+            wrapper = self.getSharedWrapper(context, GenerationIsolationGroup)
             self.weatherGen.get(RCP.RCP45).get(ClimateModel.RCM4).append(wrapper)
 
         if Settings.MinimalConfiguration == False:
             for norm in hadley45:
                 context = Context(Shore.Shore1, norm, None, DEM.WorldWide30sec, Gribs.HRDPS_daily)
-                wrapper = BioSimNormalsAndWeatherGeneratorWrapper(context)
+                wrapper = self.getSharedWrapper(context, GenerationIsolationGroup)
                 self.weatherGen.get(RCP.RCP45).get(ClimateModel.Hadley).append(wrapper)
             
             for norm in hadley85:
                 context = Context(Shore.Shore1, norm, None, DEM.WorldWide30sec, Gribs.HRDPS_daily)
-                wrapper = BioSimNormalsAndWeatherGeneratorWrapper(context)
+                wrapper = self.getSharedWrapper(context, GenerationIsolationGroup)
                 self.weatherGen.get(RCP.RCP85).get(ClimateModel.Hadley).append(wrapper)
     
-            for norm in rcm445:
-                context = Context(Shore.Shore1, norm, None, DEM.WorldWide30sec, Gribs.HRDPS_daily, nbProcesses=self.nbProcessesForWrappers)
-                wrapper = BioSimNormalsAndWeatherGeneratorWrapper(context)
-                self.weatherGen.get(RCP.RCP45).get(ClimateModel.RCM4).append(wrapper)
-    
             for norm in rcm485:
                 context = Context(Shore.Shore1, norm, None, DEM.WorldWide30sec, Gribs.HRDPS_daily, nbProcesses=self.nbProcessesForWrappers)
-                wrapper = BioSimNormalsAndWeatherGeneratorWrapper(context)
+                wrapper = self.getSharedWrapper(context, GenerationIsolationGroup)
                 self.weatherGen.get(RCP.RCP85).get(ClimateModel.RCM4).append(wrapper)
     
             for norm in gcm445:
                 context = Context(Shore.Shore1, norm, None, DEM.WorldWide30sec, Gribs.HRDPS_daily)
-                wrapper = BioSimNormalsAndWeatherGeneratorWrapper(context)
+                wrapper = self.getSharedWrapper(context, GenerationIsolationGroup)
                 self.weatherGen.get(RCP.RCP45).get(ClimateModel.GCM4).append(wrapper)
     
             for norm in gcm485:
                 context = Context(Shore.Shore1, norm, None, DEM.WorldWide30sec, Gribs.HRDPS_daily)
-                wrapper = BioSimNormalsAndWeatherGeneratorWrapper(context)
+                wrapper = self.getSharedWrapper(context, GenerationIsolationGroup)
                 self.weatherGen.get(RCP.RCP85).get(ClimateModel.GCM4).append(wrapper)
         
+        self.contextExecutor = ThreadPoolExecutor(max_workers = Settings.nbThreadsContexts, thread_name_prefix = "context")
+
+        if Settings.normalsCacheEnabled:
+            self.normalsCache = LRUCache(Settings.normalsCacheMaxEntries, Settings.normalsCacheTTLSec)
+        else:
+            self.normalsCache = None
+
+        BioSimUtility.library = createWgoutStore()
+
+        self.jobScheduler = JobScheduler(self)
+
+        self.coalescer = SingleFlight()
+
+        self.updaterStatus = {"enabled" : Settings.UpdaterEnabled,
+                              "lastCheck" : 0,
+                              "lastUpdate" : 0,
+                              "lastUpdateDurationSec" : 0,
+                              "nbUpdates" : 0,
+                              "nbFailures" : 0,
+                              "swapInProgress" : False,
+                              "swapStage" : "none",   ### none, loading, warming, draining, done or failed
+                              "lastSwap" : 0,
+                              "lastSwapDurationSec" : 0,
+                              "lastSwapLoadSec" : 0,
+                              "lastSwapWarmSec" : 0,
+                              "lastSwapDrainSec" : 0,
+                              "lastSwapError" : "",
+                              "nbSwaps" : 0,
+                              "nbSwapFailures" : 0}
+
         self.models = dict()
         
         for modType in ModelType:
-            model = Model(modType)
+            model = Model(modType, True)     ### the models are loaded all at once below
             self.models.__setitem__(modType, model)
         
+        if Settings.lazyLoading:
+            componentsToLoad = [c for c in self.getComponents() if c.getComponentName() in Settings.warmComponents]
+        else:
+            componentsToLoad = self.getComponents()
+        self.loadComponents(componentsToLoad)
+        
+        if Settings.lazyLoading:
+            if Settings.idleUnloadDelaySec > 0:
+                print("Initiating idle component reaper thread...")
+                threading.Thread(target=do_job_reaper, args = (self,), name = "reaper", daemon = True).start()
+
         if Settings.UpdaterEnabled:    
             print("Initiating updater thread...")
             UpdaterThread(self)
@@ -194,6 +254,94 @@ class Server:
             print("Updater thread disabled.")
         print("Server initialized!")
     
+    def getSharedWrapper(self, context : Context, isolationGroup : str):
+        '''
+        Return the wrapper registered for this context name, number of processes and isolation group. If 
+        there is no such wrapper, a new one is created and registered. The wrappers are not loaded 
+        at this stage.
+        
+        Wrappers of different isolation groups are never shared on purpose: the weather generation 
+        interferes with the normals. 
+        '''
+        key = (context.getContextName(), context.getNbProcesses(), isolationGroup)
+        wrapper = self.wrappers.get(key)
+        if wrapper is None:
+            wrapper = BioSimNormalsAndWeatherGeneratorWrapper(context, True)     ### the contexts are loaded all at once in the constructor
+            self.wrappers.__setitem__(key, wrapper)
+        return wrapper
+
+    def loadComponents(self, components : list):
+        '''
+        Load the components concurrently and produce the startup report. The components that run
+        in the main process are loaded one at a time while the others are loaded concurrently 
+        up to the startup parallelism.
+        '''
+        startTime = time.time()
+        inProcessLock = threading.Lock()
+        BioSIM_API.getModule()      ### the backend is imported before the startup threads fork the worker processes, which could otherwise inherit the lock of the import
+        
+        def loadComponent(component):
+            if component.getNbProcesses() > 1:
+                initStart = time.time()
+                component.ensureLoaded()
+                initSec = time.time() - initStart
+                rssBytes = Server.getRSSBytes(component.getProcessIds())
+            else:
+                inProcessLock.acquire()
+                try:
+                    formerRSSBytes = Server.getRSSBytes([os.getpid()])
+                    initStart = time.time()
+                    component.ensureLoaded()
+                    initSec = time.time() - initStart
+                    rssBytes = Server.getRSSBytes([os.getpid()])
+                    if rssBytes is not None:
+                        rssBytes -= formerRSSBytes
+                finally:
+                    inProcessLock.release()
+            return {"component" : component.getComponentName(),
+                    "processes" : component.getNbProcesses(),
+                    "initSec" : round(initSec, 3),
+                    "rssDeltaMB" : None if rssBytes is None else round(rssBytes / 1024 / 1024, 1)}
+        
+        executor = ThreadPoolExecutor(max_workers = max(1, Settings.startupParallelism), thread_name_prefix = "startup")
+        try:
+            self.startupReport = list(executor.map(loadComponent, components))
+        finally:
+            executor.shutdown()
+        self.startupReport.sort(key = lambda entry: entry["initSec"], reverse = True)   ### the slowest components first
+        self.startupDurationSec = round(time.time() - startTime, 3)
+        if Settings.Verbose:
+            print("Startup report (component, processes, init sec, RSS delta MB):")
+            for entry in self.startupReport:
+                print("  " + entry["component"] + ", " + str(entry["processes"]) + ", " + str(entry["initSec"]) + ", " + str(entry["rssDeltaMB"]))
+        print(str(len(components)) + " components loaded in " + str(self.startupDurationSec) + " sec.")
+
+    @staticmethod
+    def getRSSBytes(pids : list):
+        '''
+        Return the total resident set size of these processes or None if psutil is not available.
+        '''
+        if psutil is None:
+            return None
+        total = 0
+        for pid in pids:
+            try:
+                total += psutil.Process(pid).memory_info().rss
+            except psutil.Error:
+                pass
+        return total
+
+    def getStartupReport(self):
+        return {"durationSec" : self.startupDurationSec, "components" : self.startupReport}
+
+    def getComponents(self):
+        '''
+        Provide all the wrappers and models of this server. Each shared wrapper appears only once.
+        '''
+        components = list(self.wrappers.values())
+        components.extend(self.models.values())
+        return components
+
     def getWrapperForWeatherGeneration(self, request : WeatherGeneratorRequest):
         '''
         Generates the proper list of BioSimNormalsAndWeatherGeneratorWrapper instances given the RCP and climate model.
@@ -220,55 +368,354 @@ class Server:
     
     def processRequest(self, bioSimRequest : AbstractRequest):
         if isinstance(bioSimRequest, WeatherGeneratorRequest):
-            if isinstance(bioSimRequest, WeatherGeneratorEpheremalRequest):
-                model = self.models.get(bioSimRequest.mod)
-                bioSimRequest.setVariables(model.getRequiredVariables())
             teleIODictList = TeleIODictList()
-            wrapperList = self.getWrapperForWeatherGeneration(bioSimRequest)
-            for wrapper in wrapperList:
-                context = wrapper.getContext()
-                if (bioSimRequest.doesThisContextMatch(context)):
-                    wgl = wrapper.doProcess(bioSimRequest)
-                    teleIODictList.add(wgl)
+            matchingWrappers = self.getMatchingWrappers(bioSimRequest)
+            if len(matchingWrappers) == 1:
+                outputs = [matchingWrappers[0].doProcess(bioSimRequest)]
+            else:   ### the time segments are generated concurrently and then merged in chronological order
+                futures = [self.contextExecutor.submit(copy_context().run, wrapper.doProcess, bioSimRequest) for wrapper in matchingWrappers]   ### the threads carry on the trace of the request
+                outputs = [future.result() for future in futures]
+            for wgl in outputs:
+                teleIODictList.add(wgl)
             return teleIODictList
         elif isinstance(bioSimRequest, ModelRequest):
             outputs = self.doProcessModelRequest(bioSimRequest)
             return outputs
         elif isinstance(bioSimRequest, NormalsRequest):   ### normal request
-            shortNorm = bioSimRequest.getShortNormalsEnum()
-            if shortNorm.isPastClimate():
-                wrapper = self.normals.get(RCP.PastClimate).get(shortNorm)
+            wrapper = self.getNormalsWrapper(bioSimRequest)
+            if self.normalsCache is None:
+                return wrapper.doProcess(bioSimRequest)
             else:
-                wrapper = self.normals.get(bioSimRequest.getRCP()).get(bioSimRequest.getClimateModel()).get(shortNorm)
-            return wrapper.doProcess(bioSimRequest)
+                return self.doProcessNormalsRequestWithCache(wrapper, bioSimRequest)
         else:
             raise Exception("Unknown request type!")
+
+    async def processRequestAsync(self, bioSimRequest : AbstractRequest):
+        '''
+        The counterpart of the processRequest method in the async mode. The matching contexts of a weather
+        generation request are processed concurrently without holding any thread.
+        '''
+        if isinstance(bioSimRequest, WeatherGeneratorRequest):
+            teleIODictList = TeleIODictList()
+            matchingWrappers = self.getMatchingWrappers(bioSimRequest)
+            outputs = await asyncio.gather(*[wrapper.doProcessAsync(bioSimRequest) for wrapper in matchingWrappers])
+            for wgl in outputs:
+                teleIODictList.add(wgl)
+            return teleIODictList
+        elif isinstance(bioSimRequest, ModelRequest):
+            return await self.models.get(bioSimRequest.mod).doProcessAsync(bioSimRequest)
+        elif isinstance(bioSimRequest, NormalsRequest):
+            wrapper = self.getNormalsWrapper(bioSimRequest)
+            if self.normalsCache is None:
+                return await wrapper.doProcessAsync(bioSimRequest)
+            outputs, keys, missingIndices = self.lookUpNormalsCache(bioSimRequest)
+            if len(missingIndices) > 0:
+                self.fillNormalsCache(outputs, keys, missingIndices, await wrapper.doProcessAsync(bioSimRequest, missingIndices))
+            return outputs
+        else:
+            raise Exception("Unknown request type!")
+
+    def getMatchingWrappers(self, bioSimRequest : WeatherGeneratorRequest):
+        '''
+        Return the wrappers whose contexts match the time interval of the weather generation request.
+        '''
+        if isinstance(bioSimRequest, WeatherGeneratorEpheremalRequest):
+            model = self.models.get(bioSimRequest.mod)
+            bioSimRequest.setVariables(model.getRequiredVariables())
+        wrapperList = self.getWrapperForWeatherGeneration(bioSimRequest)
+        matchingWrappers = list()
+        with Tracing.span("match"):
+            for wrapper in wrapperList:     ### the matching must be sequential since it sets the time interval of each context
+                context = wrapper.getContext()
+                if (bioSimRequest.doesThisContextMatch(context)):
+                    matchingWrappers.append(wrapper)
+        return matchingWrappers
+
+    def getNormalsWrapper(self, bioSimRequest : NormalsRequest):
+        shortNorm = bioSimRequest.getShortNormalsEnum()
+        if shortNorm.isPastClimate():
+            return self.normals.get(RCP.PastClimate).get(shortNorm)
+        else:
+            return self.normals.get(bioSimRequest.getRCP()).get(bioSimRequest.getClimateModel()).get(shortNorm)
     
+    def doProcessNormalsRequestWithCache(self, wrapper : BioSimNormalsAndWeatherGeneratorWrapper, bioSimRequest : NormalsRequest):
+        '''
+        Retrieve the normals from the cache and send only the locations that are not found in the cache
+        to the wrapper. Only the successful outputs are stored in the cache.
+        '''
+        outputs, keys, missingIndices = self.lookUpNormalsCache(bioSimRequest)
+        if len(missingIndices) > 0:
+            self.fillNormalsCache(outputs, keys, missingIndices, wrapper.doProcess(bioSimRequest, missingIndices))
+        return outputs
+
+    def lookUpNormalsCache(self, bioSimRequest : NormalsRequest):
+        '''
+        Look up the locations of the request in the normals cache.
+        @return: a tuple with the list of outputs (None if not found), the list of cache keys and the list of the missing indices
+        '''
+        outputs = list()
+        keys = list()
+        missingIndices = list()
+        with Tracing.span("cacheLookup"):
+            for i in range(bioSimRequest.n):
+                key = bioSimRequest.getCacheKey(i, Settings.normalsCacheCoordinateTolerance, Settings.normalsCacheElevationTolerance)
+                output = self.normalsCache.get(key)
+                keys.append(key)
+                outputs.append(output)
+                if output is None:
+                    missingIndices.append(i)
+        return outputs, keys, missingIndices
+
+    def fillNormalsCache(self, outputs : list, keys : list, missingIndices : list, newOutputs : list):
+        '''
+        Set the new outputs of the missing locations in the list of outputs and store the successful ones in the cache.
+        '''
+        for j in range(len(missingIndices)):
+            i = missingIndices[j]
+            output = newOutputs[j]
+            if output.msg == "Success":
+                self.normalsCache.put(keys[i], output)
+            outputs[i] = output
+
+    def getNormalsCacheStats(self):
+        if self.normalsCache is None:
+            return {"enabled" : False}
+        else:
+            stats = self.normalsCache.getStats()
+            stats["enabled"] = True
+            return stats
+
+    def handleRequest(self, endpoint : str, bioSimRequest : AbstractRequest):
+        '''
+        Process the request sent to this endpoint. The identical requests in progress are coalesced (see the
+        doCoalesced method). The routes go through this method and the other methods listed in the bsbroker
+        module so that the server can run in a broker process behind several front ends.
+        @param endpoint: the name of the endpoint
+        @param bioSimRequest: the AbstractRequest instance
+        @return: the outputs or, for the BioSimWG endpoint, the keys of the outputs registered in the library
+        '''
+        if endpoint == "BioSimWG":
+            function = lambda: self.doWeatherGenerationAndRegister(bioSimRequest)
+        elif endpoint == "BioSimModelEphemeral":
+            function = lambda: self.doProcessEphemeralModelRequest(bioSimRequest)
+        else:
+            function = lambda: self.processRequest(bioSimRequest)
+        return self.doCoalesced(endpoint, bioSimRequest, function)
+
+    async def handleRequestAsync(self, endpoint : str, bioSimRequest : AbstractRequest):
+        '''
+        The counterpart of the handleRequest method in the async mode (see the bsasgi module). The
+        coroutine waits for the worker processes without holding a thread.
+        @param endpoint: the name of the endpoint
+        @param bioSimRequest: the AbstractRequest instance
+        '''
+        if endpoint == "BioSimWG":
+            function = lambda: self.doWeatherGenerationAndRegisterAsync(bioSimRequest)
+        elif endpoint == "BioSimModelEphemeral":
+            function = lambda: self.doProcessEphemeralModelRequestAsync(bioSimRequest)
+        else:
+            function = lambda: self.processRequestAsync(bioSimRequest)
+        if endpoint in Settings.coalescingEndpoints and bioSimRequest.isCoalescable():
+            return await self.coalescer.doAsync((endpoint,) + bioSimRequest.getCoalescingKey(), function)
+        else:
+            return await function()
+
+    def doCoalesced(self, endpoint : str, bioSimRequest : AbstractRequest, function):
+        '''
+        Call the function or wait for the result of an identical request in progress. The requests are
+        coalesced only if the endpoint is listed in the settings and if their outputs are deterministic.
+        The result is shared by all the callers and it must not be modified.
+        @param endpoint: the name of the endpoint
+        @param bioSimRequest: the AbstractRequest instance
+        @param function: a function without arguments that processes the request
+        '''
+        if endpoint in Settings.coalescingEndpoints and bioSimRequest.isCoalescable():
+            return self.coalescer.do((endpoint,) + bioSimRequest.getCoalescingKey(), function)
+        else:
+            return function()
+
+    def getCoalescingStats(self):
+        stats = self.coalescer.getStats()
+        stats["endpoints"] = " ".join(Settings.coalescingEndpoints)
+        return stats
+
+    def getLibraryStats(self):
+        return BioSimUtility.library.getStats()
+
+    def getUpdaterStatus(self):
+        status = dict(self.updaterStatus)
+        status["lastDailyDate"] = self.lastDailyDate
+        status["currentDaily"] = CurrentDailyHandler.currentDaily.value
+        return status
+
+    def swapLatestDaily(self, currentDaily : CurrentDaily):
+        '''
+        Swap the contexts that use the latest daily database for new instances that load it from another
+        directory (see the StandbyInstance class). All the new instances are loaded and warmed before any
+        of them replaces the current one, so that a failure leaves the server as it was. The stage and the
+        duration of the swap are reported in the updater status.
+        @param currentDaily: the CurrentDaily enum of the directory of the new database
+        @return: True if the swap succeeded
+        '''
+        status = self.updaterStatus
+        standbys = [StandbyInstance(wrapper, currentDaily) for wrapper in self.wrappers.values() if wrapper.getContext().usesLatestDaily()]
+        start = time.time()
+        status["swapInProgress"] = True
+        try:
+            status["swapStage"] = "loading"
+            for standby in standbys:
+                standby.load()
+            loaded = time.time()
+            status["swapStage"] = "warming"
+            for standby in standbys:
+                standby.probe()
+        except Exception as error:
+            for standby in standbys:
+                standby.discard()
+            print("The swap of the latest daily database failed: " + str(error))
+            status["swapStage"] = "failed"
+            status["lastSwapError"] = str(error)
+            status["nbSwapFailures"] += 1
+            status["swapInProgress"] = False
+            return False
+        warmed = time.time()
+        status["swapStage"] = "draining"
+        for standby in standbys:
+            standby.switch()
+        CurrentDailyHandler.currentDaily = currentDaily
+        for standby in standbys:
+            standby.drain()
+        end = time.time()
+        status["swapStage"] = "done"
+        status["lastSwap"] = end
+        status["lastSwapDurationSec"] = end - start
+        status["lastSwapLoadSec"] = loaded - start
+        status["lastSwapWarmSec"] = warmed - loaded
+        status["lastSwapDrainSec"] = end - warmed    ### including the wait for the lock of the wrappers loaded in the main process
+        status["lastSwapError"] = ""
+        status["nbSwaps"] += 1
+        status["swapInProgress"] = False
+        print("Latest daily database swapped to " + currentDaily.value + " in " + str(round(end - start, 3)) + " sec.")
+        return True
+
+    def getMetricsText(self):
+        return Metrics.renderServerMetrics(self)
+
+    def getModelNames(self):
+        return [modelType.name for modelType in self.models.keys()]
+
+    def getModelHelp(self, modelType : ModelType):
+        return self.models.get(modelType).getHelp()
+
+    def getModelDefaultParameters(self, modelType : ModelType):
+        return self.models.get(modelType).getDefaultParameters()
+
+    def submitJob(self, jobType : str, d : dict):
+        '''
+        Submit a job to the scheduler.
+        @return: the id of the job
+        @raise JobSchedulerBusyException: if too many jobs are already queued or running
+        '''
+        return self.jobScheduler.submit(jobType, d).jobId
+
+    def getJobStatus(self, jobId : str):
+        return self.jobScheduler.getJob(jobId).getStatus()
+
+    def getJobChunk(self, jobId : str, k : int):
+        return self.jobScheduler.getJob(jobId).getChunk(k)
+
+    def cancelJob(self, jobId : str):
+        self.jobScheduler.cancel(jobId)
 
     def doProcessModelRequest(self, bioSimRequest:ModelRequest):
         model = self.models.get(bioSimRequest.mod)
         outputs = model.doProcess(bioSimRequest)
         return outputs
 
+    def doWeatherGeneration(self, bioSimRequest : WeatherGeneratorRequest):
+        '''
+        Perform the weather generation and returns a TeleIODictList instance
+        '''
+        return self.setLastDailyDate(bioSimRequest, self.processRequest(bioSimRequest))
+
+    async def doWeatherGenerationAsync(self, bioSimRequest : WeatherGeneratorRequest):
+        return self.setLastDailyDate(bioSimRequest, await self.processRequestAsync(bioSimRequest))
 
+    def doWeatherGenerationAndRegister(self, bioSimRequest : WeatherGeneratorRequest):
+        '''
+        Perform the weather generation and register the outputs in the library. The outputs are registered
+        once even if the request is coalesced: the callers share the keys.
+        @return: the keys separated by spaces
+        '''
+        return self.doWeatherGeneration(bioSimRequest).registerTeleIODictList(bioSimRequest.getNamespace())
+
+    async def doWeatherGenerationAndRegisterAsync(self, bioSimRequest : WeatherGeneratorRequest):
+        outputs = await self.doWeatherGenerationAsync(bioSimRequest)
+        return await asyncio.get_running_loop().run_in_executor(None, copy_context().run, outputs.registerTeleIODictList, bioSimRequest.getNamespace())
+
+    def setLastDailyDate(self, bioSimRequest : WeatherGeneratorRequest, outputs : TeleIODictList):
+        if bioSimRequest.isForceClimateGenerationEnabled():
+            outputs.setLastDailyDate(-999)      # means climate is generated even for past dates
+        else:
+            outputs.setLastDailyDate(self.lastDailyDate)     # means we are using observation
+        return outputs
+
+    def doProcessEphemeralModelRequest(self, bioSimRequest : WeatherGeneratorEpheremalRequest):
+        '''
+        Generate the weather and apply the model to it without registering the weather in the library.
+        '''
+        teleIODictList = self.doWeatherGeneration(bioSimRequest)
+        bioSimRequest.storeTeleIODictList(teleIODictList)
+        bioSimRequest.weatherGenerated = True
+        return self.doProcessModelRequest(bioSimRequest)
+
+    async def doProcessEphemeralModelRequestAsync(self, bioSimRequest : WeatherGeneratorEpheremalRequest):
+        teleIODictList = await self.doWeatherGenerationAsync(bioSimRequest)
+        bioSimRequest.storeTeleIODictList(teleIODictList)
+        bioSimRequest.weatherGenerated = True
+        return await self.models.get(bioSimRequest.mod).doProcessAsync(bioSimRequest)
+
+
+
+
+def do_job_reaper(server : Server):
+    '''
+    Unload the components that have not been used for a while. The warm components are never unloaded.
+    '''
+    interval = min(60, Settings.idleUnloadDelaySec / 2)
+    while True:
+        time.sleep(interval)
+        for component in server.getComponents():
+            if component.getComponentName() not in Settings.warmComponents:
+                try:
+                    component.unloadIfIdle(Settings.idleUnloadDelaySec)
+                except Exception as ex:
+                    print("Failed to unload " + component.getComponentName() + ". Reason: " + str(ex))
 
 
 def do_job_thread(server : Server, tasks_to_accomplish : Queue, tasks_that_are_done : Queue):
     currentDay = time.gmtime().tm_yday
     while True:
         try:
-            time.sleep(3600)
+            time.sleep(Settings.updaterCheckIntervalSec)
 #            print("Checking time...")
             newCurrentDay = time.gmtime().tm_yday
+            server.updaterStatus["lastCheck"] = time.time()
             if (currentDay != newCurrentDay):
                 print("Calling update...")
+                start = time.time()
                 tasks_to_accomplish.put(CurrentDailyHandler.getAlternativeCurrentDaily().value)  #### sends the destination folder to the process
                 result = tasks_that_are_done.get()
+                if result == "done" and not server.swapLatestDaily(CurrentDailyHandler.getAlternativeCurrentDaily()):
+                    result = "Error: " + server.updaterStatus["lastSwapError"]
                 if result == "done":
-                    CurrentDailyHandler.toggleCurrentDaily()
-                    listWrapper = server.weatherGen.get(RCP.PastClimate)
-                    listWrapper[len(listWrapper) - 1].respawn()
                     currentDay = newCurrentDay
+                    server.updaterStatus["nbUpdates"] += 1
+                    server.updaterStatus["lastUpdate"] = time.time()
+                    server.updaterStatus["lastUpdateDurationSec"] = time.time() - start
+                else:       ### the update is attempted again at the next check
+                    server.updaterStatus["nbFailures"] += 1
+                    print("The update failed: " + str(result))
         except:
             break;
     return True
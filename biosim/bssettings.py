@@ -6,10 +6,10 @@ Provides different enums
 @author: M. Fortin and R. Saint-Amant, Canadian Forest Service, August 2020
 @copyright: Her Majesty the Queen in right of Canada
 '''
+from copy import copy
 from enum import Enum
 from math import floor
-from nt import listdir, write
-from os import path
+from os import listdir, path
 import os
 
 
@@ -21,7 +21,54 @@ class Settings():
     nbMaxCoordinatesNormals = 50
     nbMaxCoordinatesWG = 10
     UpdaterEnabled = False
+    updaterCheckIntervalSec = 3600
     MinimalConfiguration = True
+    nbProcessesNormals = 2
+    startupParallelism = 4
+    lazyLoading = False
+    warmComponents = []
+    idleUnloadDelaySec = 0
+    workerSupervisionIntervalSec = 5
+    nbThreadsContexts = 8
+    workerTaskTimeoutSec = 900
+    workerResultTimeoutSec = 3600
+    workerMaxRespawns = 5
+    normalsCacheEnabled = True
+    normalsCacheMaxEntries = 100000
+    normalsCacheTTLSec = 86400
+    normalsCacheCoordinateTolerance = 0.00001
+    normalsCacheElevationTolerance = 1
+    wgoutLibraryMaxBytes = 4 * 1024 ** 3
+    wgoutLibraryMaxEntries = 100000
+    wgoutLibraryTTLSec = 0
+    wgoutStore = "memory"
+    wgoutStoreFilename = None
+    wgoutStoreHotMaxBytes = 512 * 1024 ** 2
+    wgoutStoreMmapSizeBytes = 1024 ** 3
+    streamingEnabled = False
+    streamingChunkSize = 10000
+    jobsNbThreads = 2
+    jobsMaxPending = 20
+    jobsMaxCoordinates = 100000
+    jobsTTLSec = 86400
+    jobsMaxBytes = 10 * 1024 ** 3
+    jobsDirectory = None
+    coalescingEndpoints = []
+    serverTimingEnabled = True
+    slowRequestLogThresholdSec = 0
+    slowRequestLogSampleRate = 1.
+    slowRequestLogFilename = None
+    backend = os.environ.get("BIOSIM_BACKEND", "native")    ### the settings of the backend are read from the environment variables in the worker processes
+    simulatorNormalsLatencySec = float(os.environ.get("BIOSIM_SIMULATOR_NORMALS_LATENCY_SEC", .005))
+    simulatorGenerateLatencySec = float(os.environ.get("BIOSIM_SIMULATOR_GENERATE_LATENCY_SEC", .0002))
+    simulatorExecuteLatencySec = float(os.environ.get("BIOSIM_SIMULATOR_EXECUTE_LATENCY_SEC", .0001))
+    nbFrontEnds = 1
+    frontEndReusePort = True
+    brokerPort = 0
+    asyncMode = False
+    asyncMaxRequestsInProgress = 1000
+    asyncMaxRequestsWaiting = 1000
+    asyncMaxBodyBytes = 16 * 1024 ** 2
     ROOT_DIR = os.path.dirname(os.path.abspath(__file__)) + os.path.sep
 
     '''
@@ -42,8 +89,114 @@ class Settings():
             Settings.nbMaxCoordinatesWG = d["NB_MAX_COORDINATES_WG"]
         if d.__contains__("UPDATER_ENABLED"):
             Settings.UpdaterEnabled = d["UPDATER_ENABLED"]
+        if d.__contains__("UPDATER_CHECK_INTERVAL_SEC"):
+            Settings.updaterCheckIntervalSec = d["UPDATER_CHECK_INTERVAL_SEC"]
         if d.__contains__("MINIMAL_CONFIG"):
             Settings.MinimalConfiguration = d["MINIMAL_CONFIG"]
+        if d.__contains__("NB_PROCESSES_NORMALS"):
+            Settings.nbProcessesNormals = d["NB_PROCESSES_NORMALS"]
+        if d.__contains__("STARTUP_PARALLELISM"):
+            Settings.startupParallelism = d["STARTUP_PARALLELISM"]
+        if d.__contains__("LAZY_LOADING"):
+            Settings.lazyLoading = d["LAZY_LOADING"]
+        if d.__contains__("WARM_COMPONENTS"):
+            Settings.warmComponents = d["WARM_COMPONENTS"]
+        if d.__contains__("IDLE_UNLOAD_DELAY_SEC"):
+            Settings.idleUnloadDelaySec = d["IDLE_UNLOAD_DELAY_SEC"]
+        if d.__contains__("WORKER_SUPERVISION_INTERVAL_SEC"):
+            Settings.workerSupervisionIntervalSec = d["WORKER_SUPERVISION_INTERVAL_SEC"]
+        if d.__contains__("WORKER_TASK_TIMEOUT_SEC"):
+            Settings.workerTaskTimeoutSec = d["WORKER_TASK_TIMEOUT_SEC"]
+        if d.__contains__("WORKER_RESULT_TIMEOUT_SEC"):
+            Settings.workerResultTimeoutSec = d["WORKER_RESULT_TIMEOUT_SEC"]
+        if d.__contains__("WORKER_MAX_RESPAWNS"):
+            Settings.workerMaxRespawns = d["WORKER_MAX_RESPAWNS"]
+        if d.__contains__("NB_THREADS_CONTEXTS"):
+            Settings.nbThreadsContexts = d["NB_THREADS_CONTEXTS"]
+        if d.__contains__("NORMALS_CACHE_ENABLED"):
+            Settings.normalsCacheEnabled = d["NORMALS_CACHE_ENABLED"]
+        if d.__contains__("NORMALS_CACHE_MAX_ENTRIES"):
+            Settings.normalsCacheMaxEntries = d["NORMALS_CACHE_MAX_ENTRIES"]
+        if d.__contains__("NORMALS_CACHE_TTL_SEC"):
+            Settings.normalsCacheTTLSec = d["NORMALS_CACHE_TTL_SEC"]
+        if d.__contains__("NORMALS_CACHE_COORDINATE_TOLERANCE"):
+            Settings.normalsCacheCoordinateTolerance = d["NORMALS_CACHE_COORDINATE_TOLERANCE"]
+        if d.__contains__("NORMALS_CACHE_ELEVATION_TOLERANCE"):
+            Settings.normalsCacheElevationTolerance = d["NORMALS_CACHE_ELEVATION_TOLERANCE"]
+        if d.__contains__("WGOUT_LIBRARY_MAX_BYTES"):
+            Settings.wgoutLibraryMaxBytes = d["WGOUT_LIBRARY_MAX_BYTES"]
+        if d.__contains__("WGOUT_LIBRARY_MAX_ENTRIES"):
+            Settings.wgoutLibraryMaxEntries = d["WGOUT_LIBRARY_MAX_ENTRIES"]
+        if d.__contains__("WGOUT_LIBRARY_TTL_SEC"):
+            Settings.wgoutLibraryTTLSec = d["WGOUT_LIBRARY_TTL_SEC"]
+        if d.__contains__("WGOUT_STORE"):
+            Settings.wgoutStore = d["WGOUT_STORE"]
+        if d.__contains__("WGOUT_STORE_FILENAME"):
+            Settings.wgoutStoreFilename = d["WGOUT_STORE_FILENAME"]
+        if d.__contains__("WGOUT_STORE_HOT_MAX_BYTES"):
+            Settings.wgoutStoreHotMaxBytes = d["WGOUT_STORE_HOT_MAX_BYTES"]
+        if d.__contains__("WGOUT_STORE_MMAP_SIZE_BYTES"):
+            Settings.wgoutStoreMmapSizeBytes = d["WGOUT_STORE_MMAP_SIZE_BYTES"]
+        if d.__contains__("STREAMING_ENABLED"):
+            Settings.streamingEnabled = d["STREAMING_ENABLED"]
+        if d.__contains__("STREAMING_CHUNK_SIZE"):
+            Settings.streamingChunkSize = d["STREAMING_CHUNK_SIZE"]
+        if d.__contains__("JOBS_NB_THREADS"):
+            Settings.jobsNbThreads = d["JOBS_NB_THREADS"]
+        if d.__contains__("JOBS_MAX_PENDING"):
+            Settings.jobsMaxPending = d["JOBS_MAX_PENDING"]
+        if d.__contains__("JOBS_MAX_COORDINATES"):
+            Settings.jobsMaxCoordinates = d["JOBS_MAX_COORDINATES"]
+        if d.__contains__("JOBS_TTL_SEC"):
+            Settings.jobsTTLSec = d["JOBS_TTL_SEC"]
+        if d.__contains__("JOBS_MAX_BYTES"):
+            Settings.jobsMaxBytes = d["JOBS_MAX_BYTES"]
+        if d.__contains__("JOBS_DIRECTORY"):
+            Settings.jobsDirectory = d["JOBS_DIRECTORY"]
+        if d.__contains__("COALESCING_ENDPOINTS"):
+            Settings.coalescingEndpoints = d["COALESCING_ENDPOINTS"]
+        if d.__contains__("SERVER_TIMING_ENABLED"):
+            Settings.serverTimingEnabled = d["SERVER_TIMING_ENABLED"]
+        if d.__contains__("SLOW_REQUEST_LOG_THRESHOLD_SEC"):
+            Settings.slowRequestLogThresholdSec = d["SLOW_REQUEST_LOG_THRESHOLD_SEC"]
+        if d.__contains__("SLOW_REQUEST_LOG_SAMPLE_RATE"):
+            Settings.slowRequestLogSampleRate = d["SLOW_REQUEST_LOG_SAMPLE_RATE"]
+        if d.__contains__("SLOW_REQUEST_LOG_FILENAME"):
+            Settings.slowRequestLogFilename = d["SLOW_REQUEST_LOG_FILENAME"]
+        if d.__contains__("BACKEND"):
+            Settings.backend = d["BACKEND"]
+        if d.__contains__("SIMULATOR_NORMALS_LATENCY_SEC"):
+            Settings.simulatorNormalsLatencySec = d["SIMULATOR_NORMALS_LATENCY_SEC"]
+        if d.__contains__("SIMULATOR_GENERATE_LATENCY_SEC"):
+            Settings.simulatorGenerateLatencySec = d["SIMULATOR_GENERATE_LATENCY_SEC"]
+        if d.__contains__("SIMULATOR_EXECUTE_LATENCY_SEC"):
+            Settings.simulatorExecuteLatencySec = d["SIMULATOR_EXECUTE_LATENCY_SEC"]
+        if d.__contains__("NB_FRONTENDS"):
+            Settings.nbFrontEnds = d["NB_FRONTENDS"]
+        if d.__contains__("FRONTEND_REUSE_PORT"):
+            Settings.frontEndReusePort = d["FRONTEND_REUSE_PORT"]
+        if d.__contains__("BROKER_PORT"):
+            Settings.brokerPort = d["BROKER_PORT"]
+        if d.__contains__("ASYNC_MODE"):
+            Settings.asyncMode = d["ASYNC_MODE"]
+        if d.__contains__("ASYNC_MAX_REQUESTS_IN_PROGRESS"):
+            Settings.asyncMaxRequestsInProgress = d["ASYNC_MAX_REQUESTS_IN_PROGRESS"]
+        if d.__contains__("ASYNC_MAX_REQUESTS_WAITING"):
+            Settings.asyncMaxRequestsWaiting = d["ASYNC_MAX_REQUESTS_WAITING"]
+        if d.__contains__("ASYNC_MAX_BODY_BYTES"):
+            Settings.asyncMaxBodyBytes = d["ASYNC_MAX_BODY_BYTES"]
+        Settings.exportBackendSettings()
+
+    @staticmethod
+    def exportBackendSettings():
+        '''
+        Export the settings of the backend to the environment so that the worker processes, which
+        may reimport this module, use the same backend.
+        '''
+        os.environ["BIOSIM_BACKEND"] = str(Settings.backend)
+        os.environ["BIOSIM_SIMULATOR_NORMALS_LATENCY_SEC"] = str(Settings.simulatorNormalsLatencySec)
+        os.environ["BIOSIM_SIMULATOR_GENERATE_LATENCY_SEC"] = str(Settings.simulatorGenerateLatencySec)
+        os.environ["BIOSIM_SIMULATOR_EXECUTE_LATENCY_SEC"] = str(Settings.simulatorExecuteLatencySec)
 
     @staticmethod
     def updateGribsRegistry():
@@ -352,15 +505,23 @@ class Daily(Enum):
     CanUSA1950_1980 = ["Canada-USA 1950-1980.DailyDB", 1950, 1979]
     CanUSA1900_1950 = ["Canada-USA 1900-1950.DailyDB", 1900, 1949]
 
-    def getPath(self):
-        if (self == Daily.CanUSA2020_2021):
-            dailyFolderName = CurrentDailyHandler.currentDaily.value  ### this variable set the path to either the DailyLatest or the DailyLatestAlt directory
+    def isLatest(self):
+        '''
+        Return True if this database is updated daily in either the DailyLatest or the DailyLatestAlt directory.
+        '''
+        return self == Daily.CanUSA2020_2021
+
+    def getPath(self, currentDaily = None):
+        if self.isLatest():
+            if currentDaily is None:
+                currentDaily = CurrentDailyHandler.currentDaily
+            dailyFolderName = currentDaily.value  ### this variable set the path to either the DailyLatest or the DailyLatestAlt directory
         else:
             dailyFolderName = "Daily" 
         return Settings.ROOT_DIR + "data" + path.sep + "Weather" + path.sep + dailyFolderName + path.sep + self.value[0]
 
-    def getCommand(self):
-        return "Daily=" + self.getPath()
+    def getCommand(self, currentDaily = None):
+        return "Daily=" + self.getPath(currentDaily)
     
     def getInitialDateYr(self): 
         return self.value[1]
@@ -398,6 +559,7 @@ class Context:
         self.dem = dem
         self.gribs = gribs
         self.nbProcesses = nbProcesses
+        self.currentDaily = CurrentDailyHandler.currentDaily    ### kept with the context so that the worker processes load the same latest daily database whatever their start method
           
     def getContextName(self):
         if self.daily != None:
@@ -410,11 +572,22 @@ class Context:
     
     def isMultiProcessEnabled(self):
         return self.getNbProcesses() > 1
+
+    def usesLatestDaily(self):
+        return self.daily != None and self.daily.isLatest()
+
+    def withCurrentDaily(self, currentDaily : CurrentDaily):
+        '''
+        Provide a copy of this context that loads the latest daily database from another directory.
+        '''
+        context = copy(self)
+        context.currentDaily = currentDaily
+        return context
     
     def getInitializationString(self):
         initializationString = self.shore.getCommand() + "&" + self.normals.getCommand() + "&" + self.dem.getCommand() + "&" + self.gribs.getCommand()
         if self.daily != None:
-            initializationString += "&" + self.daily.getCommand()
+            initializationString += "&" + self.daily.getCommand(self.currentDaily)
         return initializationString
      
     def getMatchInThisInterval(self, initDateYr, finalDateYr, isFromObservation): 
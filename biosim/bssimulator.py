@@ -0,0 +1,249 @@
+'''
+A pure-Python stand-in for the BioSIM_API extension. It provides the teleIO, WeatherGenerator and Model
+classes with the same methods as the C++ library so that the server can run on any platform. The outputs
+are synthetic but they have the shape and the size of the real ones:
+    - the weather generation produces daily records with a header repeated for each replication and
+      the years are offsets (0, -1, ...) unless the weather is generated from the observations
+    - the normals are 12 monthly records
+    - the models produce annual, monthly or daily records depending on the name of the model file
+
+The latency of each call is configurable so that the queueing, the interprocess communication and
+the serialization can be measured without the C++ engine. The latency is simulated with time.sleep,
+which releases the GIL unlike some calls to the C++ library.
+
+@author: M. Fortin and R. Saint-Amant, Canadian Forest Service, August 2020
+@copyright: Her Majesty the Queen in right of Canada
+'''
+import calendar
+import random
+import time
+
+import numpy as np
+
+from biosim.bssettings import Settings
+
+
+DailyVariableFormats = {"TN" : "%.1f", "T" : "%.1f", "TX" : "%.1f", "P" : "%.1f", "TD" : "%.1f", "H" : "%.1f",
+                        "WS" : "%.1f", "WD" : "%.0f", "R" : "%.2f", "Z" : "%.1f", "S" : "%.1f", "SD" : "%.1f",
+                        "SWE" : "%.1f", "WS2" : "%.1f"}
+DefaultVariables = ["TN", "T", "TX", "P"]
+
+
+class teleIO():
+    '''
+    The container of the inputs and outputs of the BioSIM library.
+    '''
+
+    def __init__(self, compress = False, msg = "Success", comment = "", metadata = "", text = "", data = ""):
+        self.compress = compress
+        self.msg = msg
+        self.comment = comment
+        self.metadata = metadata
+        self.text = text
+        self.data = data
+
+
+def parseRequestString(requestString : str):
+    d = dict()
+    for token in requestString.split("&"):
+        if "=" in token:
+            key, value = token.split("=", 1)
+            d[key] = value
+    return d
+
+
+def getRandomGenerator(d : dict):
+    if d.__contains__("Seed"):
+        return np.random.default_rng(int(d["Seed"]))
+    else:
+        return np.random.default_rng(random.getrandbits(64))
+
+
+def simulateDailyWeather(rng, latitude : float, years, variables : list):
+    '''
+    Return the columns of the daily records of these years as a list of formatted strings, one per day.
+    '''
+    nbDays = [366 if calendar.isleap(int(year) if year > 0 else 2001 + int(year)) else 365 for year in years]  ### the offsets are given the leap years of a recent period
+    yearColumn = np.repeat(np.asarray(years), nbDays)
+    months = list()
+    days = list()
+    for n in nbDays:
+        monthLengths = [31, 29 if n == 366 else 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]
+        months.append(np.repeat(np.arange(1, 13), monthLengths))
+        days.append(np.concatenate([np.arange(1, m + 1) for m in monthLengths]))
+    monthColumn = np.concatenate(months)
+    dayColumn = np.concatenate(days)
+    dayOfYear = np.concatenate([np.arange(n) for n in nbDays])
+    seasonal = -np.cos(2 * np.pi * (dayOfYear - 15) / 365.25)
+    meanT = 20 - .5 * abs(latitude) + 14 * seasonal + rng.normal(0, 3, len(dayOfYear))
+    amplitude = np.abs(rng.normal(10, 2, len(dayOfYear)))
+    columns = [yearColumn, monthColumn, dayColumn]
+    formats = ["%d", "%d", "%d"]
+    for var in variables:
+        if var == "TN":
+            values = meanT - amplitude / 2
+        elif var == "TX":
+            values = meanT + amplitude / 2
+        elif var == "T":
+            values = meanT
+        elif var == "P":
+            values = np.where(rng.random(len(dayOfYear)) < .4, rng.exponential(5, len(dayOfYear)), 0)
+        elif var == "H":
+            values = rng.uniform(40, 100, len(dayOfYear))
+        elif var == "WD":
+            values = rng.uniform(0, 360, len(dayOfYear))
+        else:
+            values = np.abs(rng.normal(10, 4, len(dayOfYear)))
+        columns.append(values)
+        formats.append(DailyVariableFormats.get(var, "%.1f"))
+    return formatRows(formats, columns)
+
+
+def formatRows(formats : list, columns : list):
+    rowFormat = ",".join(formats)
+    return [rowFormat % row for row in zip(*[column.tolist() for column in columns])]
+
+
+class WeatherGenerator():
+    '''
+    A stand-in for the weather generator of the BioSIM library.
+    '''
+
+    def __init__(self, contextName : str):
+        self.contextName = contextName
+        self.initialized = False
+
+    def Initialize(self, initializationString : str):
+        self.initialized = True
+        return "Success"
+
+    def GetNormals(self, requestString : str):
+        d = parseRequestString(requestString)
+        errorMessage = checkLocation(d)
+        if errorMessage is not None:
+            return teleIO(False, errorMessage)
+        time.sleep(Settings.simulatorNormalsLatencySec)
+        latitude = float(d["Latitude"])
+        variables = d.get("Variables", "TN+TX+P").split("+")
+        rng = getRandomGenerator(d)
+        months = np.arange(1, 13)
+        seasonal = -np.cos(2 * np.pi * (months - 1.5) / 12)
+        meanT = 20 - .5 * abs(latitude) + 14 * seasonal
+        columns = [months]
+        formats = ["%d"]
+        for var in variables:
+            if var == "TN":
+                values = meanT - 5
+            elif var == "TX":
+                values = meanT + 5
+            elif var == "P":
+                values = rng.uniform(40, 120, 12)
+            else:
+                values = meanT
+            columns.append(values + rng.normal(0, .1, 12))
+            formats.append("%.1f")
+        text = "Month," + ",".join(variables) + "\n" + "\n".join(formatRows(formats, columns)) + "\n"
+        return teleIO(False, "Success", "", "", text, "")
+
+    def Generate(self, requestString : str):
+        d = parseRequestString(requestString)
+        errorMessage = checkLocation(d)
+        if errorMessage is not None:
+            return teleIO(False, errorMessage)
+        nbReplications = int(d.get("Replications", 1))
+        if d.__contains__("First_year"):
+            years = list(range(int(d["First_year"]), int(d["Last_year"]) + 1))
+        else:
+            nbYears = int(d.get("nb_years", 1))
+            years = list(range(1 - nbYears, 1))
+        time.sleep(Settings.simulatorGenerateLatencySec * nbReplications * len(years))
+        variables = d.get("Variables", "+".join(DefaultVariables)).split("+")
+        rng = getRandomGenerator(d)
+        latitude = float(d["Latitude"])
+        header = "Year,Month,Day," + ",".join(variables)
+        blocks = list()
+        for rep in range(nbReplications):
+            blocks.append(header)
+            blocks += simulateDailyWeather(rng, latitude, years, variables)
+        return teleIO(False, "Success", "", "", "\n".join(blocks) + "\n", "")
+
+
+def checkLocation(d : dict):
+    try:
+        latitude = float(d["Latitude"])
+        longitude = float(d["Longitude"])
+    except (KeyError, ValueError):
+        return "Error: the location is missing or invalid"
+    if abs(latitude) > 90 or abs(longitude) > 180:
+        return "Error: the location is out of bounds"
+    return None
+
+
+class Model():
+    '''
+    A stand-in for a model of the BioSIM library. The model computes degree-days over 5 degrees from the
+    daily weather and aggregates them according to the time step in the name of the model file.
+    '''
+
+    def __init__(self, contextName : str):
+        self.contextName = contextName
+        self.timeStep = "Annual"
+
+    def Initialize(self, initializationString : str):
+        d = parseRequestString(initializationString)
+        modelPath = d.get("Model", "")
+        for timeStep in ["Daily", "Monthly", "Annual"]:
+            if "(" + timeStep + ")" in modelPath:
+                self.timeStep = timeStep
+        return "Success"
+
+    def GetWeatherVariablesNeeded(self):
+        return "TN+T+TX+P"
+
+    def GetDefaultParameters(self):
+        return "LowerThreshold=5+Method=0"
+
+    def Help(self):
+        return "Synthetic model of the simulation backend. It computes degree-days over the lower threshold."
+
+    def Execute(self, parms : str, inputTeleIO : teleIO):
+        d = parseRequestString(parms)
+        nbReplications = int(d.get("Replications", 1))
+        threshold = 5.
+        if d.__contains__("Parameters"):
+            for parm in d["Parameters"].split("+"):
+                if parm.startswith("LowerThreshold="):
+                    threshold = float(parm.split("=")[1])
+        lines = inputTeleIO.text.splitlines()
+        header = lines[0].split(",")
+        blocks = list()     ### the records of each replication of the weather
+        for line in lines:
+            if line.startswith("Year"):
+                blocks.append(list())
+            elif len(line) > 0:
+                blocks[-1].append(line)
+        time.sleep(Settings.simulatorExecuteLatencySec * nbReplications * sum([len(block) for block in blocks]) / 365.)
+        temperatureIndex = header.index("T") if "T" in header else header.index("TX")
+        outputLines = list()
+        for block in blocks:
+            table = np.array([line.split(",") for line in block], dtype = float).reshape(-1, len(header))
+            degreeDays = np.maximum(table[:, temperatureIndex] - threshold, 0)
+            if self.timeStep == "Daily":
+                keys = table[:, 0:3]
+                outputHeader = "Year,Month,Day,DD"
+                formats = ["%d", "%d", "%d", "%.1f"]
+            elif self.timeStep == "Monthly":
+                keys = table[:, 0:2]
+                outputHeader = "Year,Month,DD"
+                formats = ["%d", "%d", "%.1f"]
+            else:
+                keys = table[:, 0:1]
+                outputHeader = "Year,DD"
+                formats = ["%d", "%.1f"]
+            uniqueKeys, inverse = np.unique(keys, axis = 0, return_inverse = True)
+            sums = np.bincount(inverse.ravel(), weights = degreeDays)
+            rows = formatRows(formats, [uniqueKeys[:, j] for j in range(uniqueKeys.shape[1])] + [sums])
+            for rep in range(nbReplications):
+                outputLines.append(outputHeader)
+                outputLines += rows
+        return teleIO(False, "Success", "", "", "\n".join(outputLines) + "\n", "")
@@ -0,0 +1,252 @@
+'''
+Storage backends for the wgout instances produced by the weather generation in the non ephemeral mode.
+
+@author: M. Fortin and R. Saint-Amant, Canadian Forest Service, August 2020
+@copyright: Her Majesty the Queen in right of Canada
+'''
+from threading import Lock, local
+import os
+import pickle
+import sqlite3
+import time
+
+from biosim.bssettings import Settings
+from biosim.bsutility import WgoutLibrary
+
+
+MemoryStore = "memory"
+SQLiteStore = "sqlite"
+
+
+class SQLiteWgoutStore():
+    '''
+    A wgout store in an embedded SQLite database. The database file is memory-mapped and it can be
+    shared by several server processes on the same host. The tickets are generated by the database
+    so that they are unique across processes and they remain valid after a restart.
+
+    The instances recently used by this process are kept in a hot tier in RAM. A hot entry is still
+    checked against the database so that an entry removed by another process is not served anymore.
+
+    This class provides the same methods as the WgoutLibrary class so that both can be used as the
+    BioSimUtility.library instance.
+    '''
+
+    def __init__(self, filename : str, maxBytes : int, maxEntries : int, ttlSec = 0, hotMaxBytes = 512 * 1024 ** 2, mmapSizeBytes = 1024 ** 3):
+        '''
+        Constructor
+        @param filename: the path to the database file, which is created if needed
+        @param maxBytes: the maximum size of the serialized instances in the database
+        @param maxEntries: the maximum number of entries
+        @param ttlSec: the time to live of an entry since its last use in seconds (0 means the entries never expire)
+        @param hotMaxBytes: the memory budget of the hot tier
+        @param mmapSizeBytes: the maximum number of bytes of the database file that are memory-mapped
+        '''
+        self.filename = filename
+        self.mmapSizeBytes = mmapSizeBytes
+        self.setLimits(maxBytes, maxEntries, ttlSec)
+        self.hotEntries = WgoutLibrary(hotMaxBytes, maxEntries)
+        self.connections = local()   ### one connection per thread
+        self.statsLock = Lock()      ### the counters are updated by the request threads
+        self.evictions = 0
+        self.expirations = 0
+        self.hits = 0
+        self.misses = 0
+        directory = os.path.dirname(filename)
+        if len(directory) > 0 and not os.path.exists(directory):
+            os.makedirs(directory)
+        connection = self.getConnection()
+        connection.execute("CREATE TABLE IF NOT EXISTS wgout (ticket INTEGER PRIMARY KEY AUTOINCREMENT, namespace TEXT, lastUsed REAL, sizeBytes INTEGER, payload BLOB)")
+        connection.execute("CREATE INDEX IF NOT EXISTS wgout_lastUsed ON wgout (lastUsed)")
+        connection.execute("CREATE INDEX IF NOT EXISTS wgout_namespace ON wgout (namespace)")
+
+    def setLimits(self, maxBytes : int, maxEntries : int, ttlSec = 0):
+        self.maxBytes = maxBytes
+        self.maxEntries = maxEntries
+        self.ttlSec = ttlSec
+
+    def getConnection(self):
+        connection = getattr(self.connections, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.filename, timeout = 30, isolation_level = None)   ### autocommit unless a transaction is explicitly started
+            connection.execute("PRAGMA journal_mode=WAL")     ### the readers of other processes do not block the writer
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("PRAGMA mmap_size=" + str(int(self.mmapSizeBytes)))
+            self.connections.connection = connection
+        return connection
+
+    def getLastUseResolutionSec(self):
+        '''
+        The last use of an entry is written to the database only if it is older than this resolution so that
+        the reads do not turn into writes every time.
+        '''
+        if self.ttlSec > 0:
+            return min(60, self.ttlSec * .1)
+        else:
+            return 60
+
+    def register(self, teleIODicts : list, namespace = None):
+        '''
+        Register the TeleIODict instances and return their keys
+        @param teleIODicts: a list of TeleIODict instances
+        @param namespace: an optional namespace for a bulk removal
+        @return: a list of keys in the same order as the instances
+        @raise exception: if the instances alone exceed the budget of the store
+        '''
+        payloads = [pickle.dumps(obj, pickle.HIGHEST_PROTOCOL) for obj in teleIODicts]
+        totalSize = sum([len(payload) for payload in payloads])
+        if totalSize > self.maxBytes:
+            raise Exception("The outputs (" + str(totalSize) + " bytes) exceed the budget of the wgout store (" + str(self.maxBytes) + " bytes)!")
+        now = time.time()
+        keys = list()
+        connection = self.getConnection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            for payload in payloads:
+                cursor = connection.execute("INSERT INTO wgout (namespace, lastUsed, sizeBytes, payload) VALUES (?, ?, ?, ?)",
+                                            (namespace, now, len(payload), payload))
+                keys.append(str(cursor.lastrowid))
+            self.__evict__(connection, now)
+            connection.execute("COMMIT")
+        except Exception as error:
+            connection.execute("ROLLBACK")
+            raise error
+        for i in range(len(keys)):
+            self.hotEntries.put(keys[i], teleIODicts[i], namespace)
+        return keys
+
+    def __evict__(self, connection, now : float):
+        if self.ttlSec > 0:
+            cursor = connection.execute("DELETE FROM wgout WHERE lastUsed < ?", (now - self.ttlSec,))
+            self.__count__("expirations", cursor.rowcount)
+        nbEntries, nbBytes = connection.execute("SELECT COUNT(*), IFNULL(SUM(sizeBytes), 0) FROM wgout").fetchone()
+        if nbEntries > self.maxEntries or nbBytes > self.maxBytes:
+            tickets = list()
+            for ticket, sizeBytes in connection.execute("SELECT ticket, sizeBytes FROM wgout ORDER BY lastUsed"):  ### the least recently used first
+                if nbEntries <= self.maxEntries and nbBytes <= self.maxBytes:
+                    break
+                tickets.append(ticket)
+                nbEntries -= 1
+                nbBytes -= sizeBytes
+            connection.executemany("DELETE FROM wgout WHERE ticket = ?", [(ticket,) for ticket in tickets])
+            self.__count__("evictions", len(tickets))
+
+    def __count__(self, counter : str, n = 1):
+        '''
+        Add n to one of the counters of the statistics: evictions, expirations, hits or misses.
+        '''
+        self.statsLock.acquire()
+        setattr(self, counter, getattr(self, counter) + n)
+        self.statsLock.release()
+
+    def get(self, key : str):
+        '''
+        Return the TeleIODict instance associated with this key or None if the key is not found or if the entry has expired
+        '''
+        try:
+            ticket = int(key)
+        except ValueError:
+            self.__count__("misses")
+            return None
+        obj = self.hotEntries.get(key)
+        connection = self.getConnection()
+        if obj is None:
+            row = connection.execute("SELECT lastUsed, namespace, payload FROM wgout WHERE ticket = ?", (ticket,)).fetchone()
+        else:
+            row = connection.execute("SELECT lastUsed, namespace FROM wgout WHERE ticket = ?", (ticket,)).fetchone()
+        if row is None:     ### removed in the meantime, possibly by another process
+            self.hotEntries.remove([key])
+            self.__count__("misses")
+            return None
+        now = time.time()
+        if self.ttlSec > 0 and now - row[0] > self.ttlSec:
+            self.remove([key])
+            self.__count__("expirations")
+            self.__count__("misses")
+            return None
+        self.__count__("hits")
+        if now - row[0] > self.getLastUseResolutionSec():
+            connection.execute("UPDATE wgout SET lastUsed = ? WHERE ticket = ?", (now, ticket))
+        if obj is None:
+            obj = pickle.loads(row[2])
+            self.hotEntries.put(key, obj, row[1])
+        return obj
+
+    def remove(self, keys : list):
+        '''
+        Remove the entries with these keys
+        @return: the number of entries removed
+        '''
+        tickets = list()
+        for key in keys:
+            try:
+                tickets.append((int(key),))
+            except ValueError:
+                pass
+        cursor = self.getConnection().executemany("DELETE FROM wgout WHERE ticket = ?", tickets)
+        self.hotEntries.remove(keys)
+        return cursor.rowcount
+
+    def removeNamespace(self, namespace : str):
+        '''
+        Remove all the entries registered under this namespace
+        @return: the number of entries removed
+        '''
+        cursor = self.getConnection().execute("DELETE FROM wgout WHERE namespace = ?", (namespace,))
+        self.hotEntries.removeNamespace(namespace)
+        return cursor.rowcount
+
+    def removeUnusedSince(self, delaySec : float):
+        '''
+        Remove the entries that have not been used for longer than the delay as well as the expired entries
+        @return: the number of entries removed
+        '''
+        if self.ttlSec > 0:
+            delaySec = min(delaySec, self.ttlSec)
+        cursor = self.getConnection().execute("DELETE FROM wgout WHERE lastUsed < ?", (time.time() - delaySec,))
+        self.hotEntries.removeUnusedSince(delaySec)
+        return cursor.rowcount
+
+    def __len__(self):
+        return self.getConnection().execute("SELECT COUNT(*) FROM wgout").fetchone()[0]
+
+    def getStats(self):
+        nbEntries, nbBytes = self.getConnection().execute("SELECT COUNT(*), IFNULL(SUM(sizeBytes), 0) FROM wgout").fetchone()
+        hotStats = self.hotEntries.getStats()
+        self.statsLock.acquire()
+        stats = {"size" : nbEntries,
+                 "maxEntries" : self.maxEntries,
+                 "bytes" : nbBytes,
+                 "maxBytes" : self.maxBytes,
+                 "ttlSec" : self.ttlSec,
+                 "evictions" : self.evictions,
+                 "expirations" : self.expirations,
+                 "hits" : self.hits,
+                 "misses" : self.misses,
+                 "hotSize" : hotStats["size"],
+                 "hotBytes" : hotStats["bytes"],
+                 "hotMaxBytes" : hotStats["maxBytes"]}
+        self.statsLock.release()
+        return stats
+
+
+def createWgoutStore():
+    '''
+    Create the wgout store selected in the settings.
+    @return: a WgoutLibrary instance for the memory store or a SQLiteWgoutStore instance
+    @raise exception: if the store is unknown
+    '''
+    if Settings.wgoutStore == MemoryStore:
+        return WgoutLibrary(Settings.wgoutLibraryMaxBytes, Settings.wgoutLibraryMaxEntries, Settings.wgoutLibraryTTLSec)
+    elif Settings.wgoutStore == SQLiteStore:
+        if Settings.wgoutStoreFilename is None:
+            filename = Settings.ROOT_DIR + "data" + os.path.sep + "wgout.sqlite"
+        else:
+            filename = Settings.wgoutStoreFilename
+        return SQLiteWgoutStore(filename,
+                                Settings.wgoutLibraryMaxBytes,
+                                Settings.wgoutLibraryMaxEntries,
+                                Settings.wgoutLibraryTTLSec,
+                                Settings.wgoutStoreHotMaxBytes,
+                                Settings.wgoutStoreMmapSizeBytes)
+    else:
+        raise Exception("The wgout store " + str(Settings.wgoutStore) + " is unknown. It should be either " + MemoryStore + " or " + SQLiteStore)
@@ -0,0 +1,196 @@
+'''
+Lightweight tracing of the phases of a request. The spans are accumulated in a Trace instance that follows
+the request through a context variable. The time measured in the worker processes is sent back with the
+results and added to the trace of the request that submitted the task.
+
+The trace is rendered as a Server-Timing header and the slow requests can be logged on a sampling basis.
+
+@author: M. Fortin and R. Saint-Amant, Canadian Forest Service, August 2020
+@copyright: Her Majesty the Queen in right of Canada
+'''
+from collections import OrderedDict
+from contextvars import ContextVar
+from threading import Lock
+import json
+import random
+import time
+
+from biosim.bsmetrics import Metrics
+
+
+NativeCalls = ("GetNormals", "Generate", "Execute")
+
+currentTrace = ContextVar("currentTrace", default = None)
+
+
+class Trace():
+    '''
+    The spans of a request. A span that occurs several times, for instance once per location, is summed up.
+    '''
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.spans = OrderedDict()    ### name -> [duration in sec, count]
+        self.lock = Lock()
+
+    def add(self, name : str, durationSec : float, count = 1):
+        self.lock.acquire()
+        entry = self.spans.get(name)
+        if entry is None:
+            self.spans[name] = [durationSec, count]
+        else:
+            entry[0] += durationSec
+            entry[1] += count
+        self.lock.release()
+
+    def addAll(self, spans : dict):
+        '''
+        Add the spans of another trace, typically the one of a worker process.
+        @param spans: a dict name -> [duration in sec, count] as returned by the getSpans method
+        '''
+        for name, entry in spans.items():
+            self.add(name, entry[0], entry[1])
+
+    def getSpans(self):
+        self.lock.acquire()
+        spans = OrderedDict([(name, list(entry)) for name, entry in self.spans.items()])
+        self.lock.release()
+        return spans
+
+    def getElapsedSec(self):
+        return time.perf_counter() - self.start
+
+    def getServerTimingHeader(self):
+        '''
+        Return the value of the Server-Timing header. The durations are in milliseconds as required by the
+        specification. The spans that occurred more than once are described with their count.
+        '''
+        metrics = list()
+        for name, entry in self.getSpans().items():
+            if entry[1] > 1:
+                metrics.append(name + ";desc=\"" + str(entry[1]) + " times\";dur=" + "%.3f" % (entry[0] * 1000))
+            else:
+                metrics.append(name + ";dur=" + "%.3f" % (entry[0] * 1000))
+        metrics.append("total;dur=" + "%.3f" % (self.getElapsedSec() * 1000))
+        return ", ".join(metrics)
+
+
+class Span():
+    '''
+    A context manager that adds its duration to the trace of the current request, if any.
+    '''
+
+    def __init__(self, name : str):
+        self.name = name
+        self.trace = None
+        self.start = 0
+
+    def __enter__(self):
+        self.trace = currentTrace.get()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, excType, excValue, tb):
+        if self.trace is not None:
+            self.trace.add(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class NativeCallSpan(Span):
+    '''
+    A span around a call to the BioSIM library. Its duration is also reported to the metrics.
+    '''
+
+    def __init__(self, componentName : str, call : str):
+        Span.__init__(self, call)
+        self.componentName = componentName
+
+    def __exit__(self, excType, excValue, tb):
+        durationSec = time.perf_counter() - self.start
+        Metrics.observeNativeCall(self.componentName, self.name, durationSec)
+        if self.trace is not None:
+            self.trace.add(self.name, durationSec)
+        return False
+
+
+class Tracing():
+
+    @staticmethod
+    def start():
+        '''
+        Start a new trace in the current context.
+        @return: the Trace instance
+        '''
+        trace = Trace()
+        currentTrace.set(trace)
+        return trace
+
+    @staticmethod
+    def stop():
+        currentTrace.set(None)
+
+    @staticmethod
+    def getCurrentTrace():
+        return currentTrace.get()
+
+    @staticmethod
+    def span(name : str):
+        return Span(name)
+
+    @staticmethod
+    def nativeCall(componentName : str, call : str):
+        return NativeCallSpan(componentName, call)
+
+    @staticmethod
+    def addWorkerSpans(componentName : str, trace : Trace, spans : dict):
+        '''
+        Report the spans sent back by a worker process to the metrics and to the trace of the request.
+        @param trace: the Trace instance of the request or None if the request is not traced
+        '''
+        for call in NativeCalls:
+            if spans.__contains__(call):
+                Metrics.observeNativeCall(componentName, call, spans[call][0])
+        if trace is not None:
+            trace.addAll(spans)
+
+
+class SlowRequestLog():
+    '''
+    Log the requests that exceed a threshold, one JSON record per line. Only a sample of them is
+    logged if the sample rate is lower than 1.
+    '''
+
+    MaxQueryLength = 2000
+
+    def __init__(self, thresholdSec : float, sampleRate : float, filename = None):
+        '''
+        Constructor
+        @param thresholdSec: the requests that last longer are logged
+        @param sampleRate: the proportion of the slow requests that are logged
+        @param filename: the log file or None to print the records
+        '''
+        self.thresholdSec = thresholdSec
+        self.sampleRate = sampleRate
+        self.filename = filename
+        self.lock = Lock()
+
+    def isSlow(self, durationSec : float):
+        return durationSec >= self.thresholdSec and random.random() < self.sampleRate
+
+    def log(self, endpoint : str, query : str, statusCode : int, trace : Trace):
+        record = {"time" : time.strftime("%Y-%m-%dT%H:%M:%S"),
+                  "endpoint" : endpoint,
+                  "query" : query[:SlowRequestLog.MaxQueryLength],
+                  "status" : statusCode,
+                  "durationSec" : round(trace.getElapsedSec(), 6),
+                  "spans" : dict([(name, {"durationSec" : round(entry[0], 6), "count" : entry[1]}) for name, entry in trace.getSpans().items()])}
+        line = json.dumps(record)
+        if self.filename is None:
+            print("Slow request: " + line)
+        else:
+            self.lock.acquire()
+            try:
+                with open(self.filename, "a") as f:
+                    f.write(line + "\n")
+            finally:
+                self.lock.release()
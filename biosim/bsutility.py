@@ -4,25 +4,30 @@ A module that contains utility classes
 @author: M. Fortin and R. Saint-Amant, Canadian Forest Service, August 2020
 @copyright: Her Majesty the Queen in right of Canada
 '''
-import biosim.biosimdll.BioSIM_API as BioSIM_API
 from threading import Lock
 from collections import OrderedDict
+from concurrent.futures import Future
+from operator import methodcaller
+import asyncio
+import json
+import time
 
-lock = Lock()
+import numpy as np
+
+from biosim.bsbackend import BioSIM_API
+from biosim.bstracing import Tracing
 
 class BioSimUtility():
     '''
     A class with static methods for utility
     '''
 
-    maxNumberWgoutInstances = 100000;
-    
-    library = OrderedDict()
+    library = None      ### a WgoutLibrary instance created below and replaced by the store selected in the settings when the server is instantiated
 
 
 
     @staticmethod
-    def convertTeleIOToDict(obj : BioSIM_API.teleIO):
+    def convertTeleIOToDict(obj : "BioSIM_API.teleIO"):
         '''
             Convert the teleIO instance into a dict instance so that it can be sent back and forth to the sub processes
         '''
@@ -59,13 +64,345 @@ class BioSimUtility():
             outputList.append(obsDict)
         return outputList
 
+class LRUCache():
+    '''
+    A bounded cache with a least-recently-used eviction policy and an optional time to live. The
+    number of hits, misses and evictions is recorded for monitoring purposes.
+    '''
+
+    def __init__(self, maxEntries : int, ttlSec = 0):
+        '''
+        Constructor
+        @param maxEntries: the maximum number of entries in the cache
+        @param ttlSec: the time to live of an entry in seconds (0 means the entries never expire)
+        '''
+        self.maxEntries = maxEntries
+        self.ttlSec = ttlSec
+        self.entries = OrderedDict()    ### key -> [timestamp, value] 
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        '''
+        Return the value associated with this key or None if the key is not found or if the entry has expired
+        '''
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(key)
+            if entry is not None and self.ttlSec > 0 and time.time() - entry[0] > self.ttlSec:
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            else:
+                self.entries.move_to_end(key, last = True) ### move the entry to the end so that it shows it's been recently used
+                self.hits += 1
+                return entry[1]
+        finally:
+            self.lock.release()
+
+    def put(self, key, value):
+        self.lock.acquire()
+        try:
+            self.entries[key] = [time.time(), value]
+            self.entries.move_to_end(key, last = True)
+            while len(self.entries) > self.maxEntries:
+                self.entries.popitem(last = False)   ## the least recently used entries are the first in the ordered dict
+                self.evictions += 1
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        self.entries.clear()
+        self.lock.release()
+
+    def getStats(self):
+        self.lock.acquire()
+        stats = {"size" : len(self.entries), 
+                 "maxEntries" : self.maxEntries, 
+                 "hits" : self.hits, 
+                 "misses" : self.misses, 
+                 "evictions" : self.evictions}
+        self.lock.release()
+        return stats
+
+
+class SingleFlight():
+    '''
+    Coalesce the concurrent computations with the same key. The first caller carries out the computation
+    and the callers that arrive while it is in progress wait for its result instead of computing it again.
+    The result is not kept once the computation is over.
+    '''
+
+    def __init__(self):
+        self.lock = Lock()
+        self.calls = dict()     ### key -> Future instance of the computation in progress
+        self.nbCalls = 0
+        self.nbCoalesced = 0
+
+    def do(self, key, function):
+        '''
+        Return the result of the function or the result of the computation in progress with the same key.
+        @param key: a hashable key
+        @param function: a function without arguments
+        @raise exception: the exception raised by the function
+        '''
+        self.lock.acquire()
+        future = self.calls.get(key)
+        if future is not None:
+            self.nbCoalesced += 1
+            self.lock.release()
+            return future.result()
+        future = Future()
+        self.calls[key] = future
+        self.nbCalls += 1
+        self.lock.release()
+        try:
+            result = function()
+            future.set_result(result)
+            return result
+        except Exception as error:
+            future.set_exception(error)
+            raise error
+        finally:
+            self.lock.acquire()
+            del self.calls[key]
+            self.lock.release()
+
+    async def doAsync(self, key, function):
+        '''
+        The counterpart of the do method for the coroutines of the async mode. The computations in progress
+        are shared with the do method.
+        @param key: a hashable key
+        @param function: a function without arguments that returns an awaitable
+        @raise exception: the exception raised by the function
+        '''
+        self.lock.acquire()
+        future = self.calls.get(key)
+        if future is not None:
+            self.nbCoalesced += 1
+            self.lock.release()
+            return await asyncio.shield(asyncio.wrap_future(future))   ### cancelling a caller must not cancel the shared computation
+        future = Future()
+        self.calls[key] = future
+        self.nbCalls += 1
+        self.lock.release()
+        try:
+            result = await function()
+            future.set_result(result)
+            return result
+        except Exception as error:
+            future.set_exception(error)
+            raise error
+        except BaseException as error:     ### the coroutine has been cancelled: the other callers must not wait forever
+            future.set_exception(Exception("The computation has been cancelled"))
+            raise error
+        finally:
+            self.lock.acquire()
+            del self.calls[key]
+            self.lock.release()
+
+    def getStats(self):
+        self.lock.acquire()
+        stats = {"inFlight" : len(self.calls),
+                 "calls" : self.nbCalls,
+                 "coalesced" : self.nbCoalesced}
+        self.lock.release()
+        return stats
+
+
+class WgoutLibrary():
+    '''
+    The library of the TeleIODict instances produced by the weather generation in the non ephemeral mode.
+
+    The library is bounded by a memory budget in bytes and by a maximum number of entries. The size of each
+    entry is estimated when it is registered and the least recently used entries are evicted first. An entry 
+    that has not been used for longer than the time to live expires. The entries can also be registered 
+    under a namespace so that they can be removed in bulk.
+    '''
+
+    def __init__(self, maxBytes : int, maxEntries : int, ttlSec = 0):
+        '''
+        Constructor
+        @param maxBytes: the memory budget in bytes
+        @param maxEntries: the maximum number of entries
+        @param ttlSec: the time to live of an entry since its last use in seconds (0 means the entries never expire)
+        '''
+        self.setLimits(maxBytes, maxEntries, ttlSec)
+        self.entries = OrderedDict()    ### key -> [last use, size in bytes, namespace, TeleIODict instance]
+        self.lock = Lock()
+        self.ticketNumber = 0
+        self.nbBytes = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.hits = 0
+        self.misses = 0
+
+    def setLimits(self, maxBytes : int, maxEntries : int, ttlSec = 0):
+        self.maxBytes = maxBytes
+        self.maxEntries = maxEntries
+        self.ttlSec = ttlSec
+
+    def register(self, teleIODicts : list, namespace = None):
+        '''
+        Register the TeleIODict instances and return their keys
+        @param teleIODicts: a list of TeleIODict instances
+        @param namespace: an optional namespace for a bulk removal
+        @return: a list of keys in the same order as the instances
+        @raise exception: if the instances alone exceed the memory budget
+        '''
+        sizes = [obj.getSizeBytes() for obj in teleIODicts]
+        if sum(sizes) > self.maxBytes:
+            raise Exception("The outputs (" + str(sum(sizes)) + " bytes) exceed the memory budget of the library (" + str(self.maxBytes) + " bytes)!")
+        keys = list()
+        self.lock.acquire()
+        try:
+            for i in range(len(teleIODicts)):
+                key = str(self.ticketNumber)
+                self.ticketNumber += 1
+                self.__put__(key, teleIODicts[i], sizes[i], namespace)
+                keys.append(key)
+        finally:
+            self.lock.release()
+        return keys
+
+    def put(self, key : str, teleIODict, namespace = None):
+        '''
+        Add a TeleIODict instance under a key provided by the caller
+        '''
+        self.lock.acquire()
+        try:
+            self.__put__(key, teleIODict, teleIODict.getSizeBytes(), namespace)
+        finally:
+            self.lock.release()
+
+    def __put__(self, key : str, teleIODict, size : int, namespace):
+        now = time.time()
+        self.__removeExpired__(now)
+        if self.entries.__contains__(key):
+            self.__pop__(key)
+        self.entries.__setitem__(key, [now, size, namespace, teleIODict])
+        self.nbBytes += size
+        while self.nbBytes > self.maxBytes or len(self.entries) > self.maxEntries:
+            self.__pop__(next(iter(self.entries.keys())))   ## we remove the least recently used instances first, these are the first instances in the ordered dict 
+            self.evictions += 1
+
+    def get(self, key : str):
+        '''
+        Return the TeleIODict instance associated with this key or None if the key is not found or if the entry has expired
+        '''
+        now = time.time()
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if self.__isExpired__(entry, now):
+                self.__pop__(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self.hits += 1
+            entry[0] = now
+            self.entries.move_to_end(key, last = True) ### move the entry to the end so that it shows it's been recently used
+            return entry[3]
+        finally:
+            self.lock.release()
+
+    def __pop__(self, key : str):
+        entry = self.entries.pop(key)
+        self.nbBytes -= entry[1]
+
+    def __isExpired__(self, entry : list, now : float):
+        return self.ttlSec > 0 and now - entry[0] > self.ttlSec
+
+    def __removeExpired__(self, now : float):
+        if self.ttlSec <= 0:
+            return 0
+        nbRemoved = 0
+        while len(self.entries) > 0:
+            key = next(iter(self.entries))    ### the entries are sorted by last use: only the front is visited
+            if not self.__isExpired__(self.entries[key], now):
+                break
+            self.__pop__(key)
+            nbRemoved += 1
+        self.expirations += nbRemoved
+        return nbRemoved
+
+    def remove(self, keys : list):
+        '''
+        Remove the entries with these keys
+        @return: the number of entries removed
+        '''
+        nbRemoved = 0
+        self.lock.acquire()
+        for key in keys:
+            if self.entries.__contains__(key):
+                self.__pop__(key)
+                nbRemoved += 1
+        self.lock.release()
+        return nbRemoved
+
+    def removeNamespace(self, namespace : str):
+        '''
+        Remove all the entries registered under this namespace
+        @return: the number of entries removed
+        '''
+        self.lock.acquire()
+        keys = [key for key, entry in self.entries.items() if entry[2] == namespace]
+        self.lock.release()
+        return self.remove(keys)
+
+    def removeUnusedSince(self, delaySec : float):
+        '''
+        Remove the entries that have not been used for longer than the delay as well as the expired entries
+        @return: the number of entries removed
+        '''
+        now = time.time()
+        self.lock.acquire()
+        try:
+            nbRemoved = self.__removeExpired__(now)
+            while len(self.entries) > 0:
+                key = next(iter(self.entries))
+                if now - self.entries[key][0] <= delaySec:
+                    break
+                self.__pop__(key)
+                nbRemoved += 1
+            return nbRemoved
+        finally:
+            self.lock.release()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def getStats(self):
+        self.lock.acquire()
+        stats = {"size" : len(self.entries),
+                 "maxEntries" : self.maxEntries,
+                 "bytes" : self.nbBytes,
+                 "maxBytes" : self.maxBytes,
+                 "ttlSec" : self.ttlSec,
+                 "evictions" : self.evictions,
+                 "expirations" : self.expirations,
+                 "hits" : self.hits,
+                 "misses" : self.misses}
+        self.lock.release()
+        return stats
+
+
+BioSimUtility.library = WgoutLibrary(4 * 1024 ** 3, 100000)
+
+
 class TeleIODictList(list):
     '''
     A List of TeleIODict instances. It handles the concatenation of instances from several contexts in order
     to have a single TeleIODict instance in the end. 
     '''
-    
-    ticketNumber = int(0)
 
     def add(self, l : list):
         '''
@@ -83,80 +420,350 @@ class TeleIODictList(list):
                 if isEmpty:
                     self.append(l[i])
                 else:
-                    self[i].__merge__(l[i])
+                    with Tracing.span("merge"):
+                        self[i].__merge__(l[i])
     
     def setLastDailyDate(self, date):
         for obj in self:
             obj.__setLastDailyDate__(date)
 
-    def registerTeleIODictList(self):
+    def registerTeleIODictList(self, namespace = None):
         '''
-        Register the TeleIODictList instance in the library for the non ephemeral mode
+        Register the TeleIODict instances in the library for the non ephemeral mode
+        @param namespace: an optional namespace for a bulk removal
+        @return: the keys separated by spaces
         '''
-        lock.acquire()
-        outputStr = ""
-        for i in range(len(self)):
-            key = str(TeleIODictList.ticketNumber)
-            BioSimUtility.library.__setitem__(key, self[i]);
-            if i == 0:
-                outputStr += key
-            else:
-                outputStr += " " + key
-            TeleIODictList.ticketNumber += 1
-        while len(BioSimUtility.library) > BioSimUtility.maxNumberWgoutInstances:
-            firstkey = next(iter(BioSimUtility.library.keys()))
-            del BioSimUtility.library[firstkey]  ## we remove the oldest instances first these are the first instance in the ordered dict
-        lock.release()
-        return outputStr
+        return " ".join(BioSimUtility.library.register(self, namespace))
     
     def getOutputText(self):
         '''
         Parse the text before it is sent to the client
         '''
-        outputStr = ""
-        for i in range(len(self)):
-            outputStr += self[i].__getText__(True)
-        return outputStr;
+        return "".join(self.iterOutputText())
+
+    def iterOutputText(self, chunkSize = 10000):
+        '''
+        Yield the text sent to the client location by location and replication by replication 
+        so that the response can be streamed.
+        @param chunkSize: the maximum number of rows in each piece of text
+        '''
+        for teleIODict in self:
+            for text in teleIODict.iterText(True, chunkSize):
+                yield text
     
 
     @staticmethod
     def removeTeleIODictList(references):
-        lock.acquire()
-        for ref in references:
-            if BioSimUtility.library.__contains__(ref):
-                del BioSimUtility.library[ref]
-        lock.release()
+        BioSimUtility.library.remove(references)
         
     @staticmethod
     def getTeleIODictList(l : list):
         teleIODictList = TeleIODictList()
-        lock.acquire()
         for key in l:
             obj = BioSimUtility.library.get(key)
             if obj is not None:
-                BioSimUtility.library.move_to_end(key, last = True) ### move the object to the end so that it shows it's been recently used
                 teleIODictList.append(obj)
-        lock.release()
         return teleIODictList;
     
     
     def parseToJSON(self):
-        mainDict = dict()
+        return json.loads("".join(self.iterJSON()))
+
+    def iterJSON(self, chunkSize = 10000, firstIndex = 0):
+        '''
+        Yield a JSON object by pieces. The keys are the indices of the locations and the values are either
+        the error message or an object whose keys are the replications and the values are lists of records. 
+        The numeric fields are written as numbers.
+        @param firstIndex: the index of the first location
+        '''
+        yield "{"
+        for i in range(len(self)):
+            if i > 0:
+                yield ","
+            yield "\"" + str(firstIndex + i) + "\":"
+            teleIODict = self[i]
+            if teleIODict.isValid():
+                table = teleIODict["table"]
+                yield "{"
+                for j in range(table.getNbReplications()):
+                    yield ("," if j > 0 else "") + "\"" + str(j) + "\":["
+                    isFirst = True
+                    for records in table.iterJSONRecords(j, chunkSize, ","):
+                        yield records if isFirst else "," + records
+                        isFirst = False
+                    yield "]"
+                yield "}"
+            else:
+                yield json.dumps(teleIODict["msg"])
+        yield "}"
+
+    def iterNDJSON(self, chunkSize = 10000, firstIndex = 0):
+        '''
+        Yield one JSON record per line. Each record starts with the index of the location. A location
+        that failed produces a single record with its error message.
+        @param firstIndex: the index of the first location
+        '''
         for i in range(len(self)):
-            mainDict.__setitem__(i, self[i].__parseToJSON__()) 
-        return mainDict
+            teleIODict = self[i]
+            if teleIODict.isValid():
+                table = teleIODict["table"]
+                for j in range(table.getNbReplications()):
+                    for records in table.iterJSONRecords(j, chunkSize, "\n", {"Location" : str(firstIndex + i)}):
+                        yield records + "\n"
+            else:
+                yield json.dumps({"Location" : firstIndex + i, "error" : teleIODict["msg"]}) + "\n"
 
     
     
     
     
+class TeleIOColumn():
+    '''
+    A column of a TeleIOTable instance. The values are stored in a typed NumPy array according to the kind
+    of the column:
+        - "int": the values are integers
+        - "float": the values are floats formatted with a fixed number of decimals
+        - "str": the values are codes that refer to a list of categories
+    A column is stored as numbers only if the numbers are formatted back exactly as they were received. 
+    Consequently, the original text can always be reproduced.
+    '''
+
+    def __init__(self, kind : str, values, decimals = 0, categories = None):
+        self.kind = kind
+        self.values = values
+        self.decimals = decimals
+        self.categories = categories
+
+    @staticmethod
+    def parse(tokens : list):
+        '''
+        Create a column from a list of strings
+        '''
+        if len(tokens) > 0:
+            try:
+                values = list(map(int, tokens))
+                if list(map(str, values)) == tokens:
+                    return TeleIOColumn("int", TeleIOColumn.__shrinkIntegers__(np.array(values, dtype=np.int64)))
+            except (ValueError, OverflowError):
+                pass
+            withPoint = next(filter(methodcaller("__contains__", "."), tokens), None)    ### the first values may be non finite such as nan
+            if withPoint is not None:
+                decimals = len(withPoint) - withPoint.index(".") - 1
+                try:
+                    values = list(map(float, tokens))
+                    if list(map(("%." + str(decimals) + "f").__mod__, values)) == tokens:
+                        if max(map(len, tokens)) <= 7:  ### at most 6 significant digits: the single precision is enough to format the values back
+                            return TeleIOColumn("float", np.array(values, dtype=np.float32), decimals)
+                        else:
+                            return TeleIOColumn("float", np.array(values, dtype=np.float64), decimals)
+                except ValueError:
+                    pass
+        return TeleIOColumn.createStringColumn(tokens)
+
+    @staticmethod
+    def createStringColumn(tokens : list):
+        codes = dict()
+        values = [codes.setdefault(t, len(codes)) for t in tokens]
+        return TeleIOColumn("str", TeleIOColumn.__shrinkIntegers__(np.array(values, dtype=np.int64)), categories = list(codes.keys()))
+
+    @staticmethod
+    def __shrinkIntegers__(values):
+        if len(values) == 0:
+            return values
+        for dtype in (np.int8, np.int16, np.int32):
+            info = np.iinfo(dtype)
+            if values.min() >= info.min and values.max() <= info.max:
+                return values.astype(dtype)
+        return values.astype(np.int64)
+
+    def __len__(self):
+        return len(self.values)
+
+    def getStrings(self, start = 0, end = None):
+        '''
+        Return the values between the start and end rows as a list of strings.
+        '''
+        values = self.values[start:end].tolist()
+        if self.kind == "int":
+            return list(map(str, values))
+        elif self.kind == "float":
+            return list(map(("%." + str(self.decimals) + "f").__mod__, values))
+        else:
+            return list(map(self.categories.__getitem__, values))
+
+    def getJSONStrings(self, start = 0, end = None):
+        '''
+        Return the values between the start and end rows as a list of JSON values. The numbers are not quoted
+        and the non finite floats are converted into null.
+        '''
+        if self.kind == "str":
+            encodedCategories = [json.dumps(c) for c in self.categories]
+            return list(map(encodedCategories.__getitem__, self.values[start:end].tolist()))
+        strings = self.getStrings(start, end)
+        if self.kind == "float":
+            isFinite = np.isfinite(self.values[start:end])
+            if not isFinite.all():
+                strings = [strings[i] if isFinite[i] else "null" for i in range(len(strings))]
+        return strings
+
+    def take(self, indices):
+        return TeleIOColumn(self.kind, self.values[indices], self.decimals, self.categories)
+
+    def isCompatibleWith(self, column):
+        return self.kind == column.kind and self.decimals == column.decimals
+
+    @staticmethod
+    def concatenate(col1, col2):
+        '''
+        Concatenate two columns. If their kinds differ, the values are parsed again.
+        '''
+        if len(col1) == 0:
+            return col2
+        elif len(col2) == 0:
+            return col1
+        elif col1.isCompatibleWith(col2):
+            if col1.kind == "str" and col1.categories != col2.categories:
+                categories = sorted(set(col1.categories).union(col2.categories))
+                newCodes = dict(zip(categories, range(len(categories))))
+                codes1 = np.array([newCodes[c] for c in col1.categories])[col1.values]
+                codes2 = np.array([newCodes[c] for c in col2.categories])[col2.values]
+                return TeleIOColumn("str", TeleIOColumn.__shrinkIntegers__(np.concatenate((codes1, codes2))), categories = categories)
+            else:
+                return TeleIOColumn(col1.kind, np.concatenate((col1.values, col2.values)), col1.decimals, col1.categories)
+        else:
+            return TeleIOColumn.parse(col1.getStrings() + col2.getStrings())
+
+    def getSizeBytes(self):
+        size = self.values.nbytes
+        if self.categories is not None:
+            size += sum([len(c) for c in self.categories])
+        return size
+
+
+class TeleIOTable():
+    '''
+    A columnar representation of the text of a teleIO instance. The rows of all the replications are 
+    stored in TeleIOColumn instances and the repOffsets array contains the index of the first row of 
+    each replication plus the total number of rows. The field names are interned so that the tables 
+    with the same header share a single tuple.
+    '''
+
+    internedFields = dict()
+
+    def __init__(self, fields : tuple, columns : list, repOffsets):
+        self.fields = TeleIOTable.internFields(fields)
+        self.columns = columns
+        self.repOffsets = repOffsets
+
+    @staticmethod
+    def internFields(fields : tuple):
+        return TeleIOTable.internedFields.setdefault(fields, fields)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.fields = TeleIOTable.internFields(self.fields)  ### the instances sent by the sub processes share the header as well
+
+    @staticmethod
+    def parse(header : str, lines : list, repOffsets : list):
+        '''
+        Create a table from the header and the lines of all replications
+        @param header: the comma-separated field names
+        @param lines: the lines of all the replications without the headers
+        @param repOffsets: the index of the first line of each replication plus the total number of lines
+        '''
+        fields = tuple(header.split(","))
+        nbFields = len(fields)
+        if len(lines) > 0:
+            if set(map(methodcaller("count", ","), lines)) != {nbFields - 1}:
+                raise Exception("The number of values does not match the number of fields in the header!")
+            tokens = ",".join(lines).split(",")
+            columns = [TeleIOColumn.parse(tokens[j::nbFields]) for j in range(nbFields)]
+        else:
+            columns = [TeleIOColumn.createStringColumn([]) for f in fields]
+        return TeleIOTable(fields, columns, np.array(repOffsets, dtype=np.int64))
+
+    def getHeader(self):
+        return ",".join(self.fields)
+
+    def getNbReplications(self):
+        return len(self.repOffsets) - 1
+
+    def getNbRows(self):
+        return int(self.repOffsets[-1])
+
+    def getColumn(self, field : str):
+        return self.columns[self.fields.index(field)]
+
+    def setColumn(self, field : str, column : TeleIOColumn):
+        self.columns[self.fields.index(field)] = column
+
+    def getRepText(self, i : int):
+        '''
+        Return the rows of replication i as text. Each row ends with a new line.
+        '''
+        return self.getRowsText(int(self.repOffsets[i]), int(self.repOffsets[i + 1]))
+
+    def getRowsText(self, start : int, end : int):
+        if start >= end:
+            return ""
+        strings = [c.getStrings(start, end) for c in self.columns]
+        return "\n".join(map(",".join, zip(*strings))) + "\n"
+
+    def iterRepText(self, i : int, chunkSize : int):
+        '''
+        Yield the rows of replication i as text by chunks of at most chunkSize rows.
+        '''
+        end = int(self.repOffsets[i + 1])
+        for start in range(int(self.repOffsets[i]), end, chunkSize):
+            yield self.getRowsText(start, min(start + chunkSize, end))
+
+    def iterJSONRecords(self, i : int, chunkSize : int, separator : str, extraFields = None):
+        '''
+        Yield the rows of replication i as JSON objects by chunks of at most chunkSize rows. 
+        @param separator: the separator between the records of a chunk
+        @param extraFields: an optional dict of fields and JSON values added at the beginning of each record
+        '''
+        prefix = "{"
+        if extraFields is not None:
+            for field, value in extraFields.items():
+                prefix += json.dumps(field) + ":" + value + ","
+        keys = [json.dumps(f) + ":" for f in self.fields]
+        end = int(self.repOffsets[i + 1])
+        for start in range(int(self.repOffsets[i]), end, chunkSize):
+            chunkEnd = min(start + chunkSize, end)
+            strings = [list(map(keys[j].__add__, self.columns[j].getJSONStrings(start, chunkEnd))) for j in range(len(keys))]
+            yield separator.join([prefix + ",".join(row) + "}" for row in zip(*strings)])
+
+    def merge(self, table):
+        '''
+        Return a new table in which the rows of each replication of this table are followed by the rows 
+        of the same replication in the table argument.
+        '''
+        if self.fields != table.fields or self.getNbReplications() != table.getNbReplications():
+            raise Exception("The tables should have the same header and the same number of replications!")
+        nbRows = self.getNbRows()
+        order = list()
+        repOffsets = [0]
+        for i in range(self.getNbReplications()):
+            order.append(np.arange(self.repOffsets[i], self.repOffsets[i + 1]))
+            order.append(nbRows + np.arange(table.repOffsets[i], table.repOffsets[i + 1]))
+            repOffsets.append(repOffsets[-1] + len(order[-2]) + len(order[-1]))
+        order = np.concatenate(order)
+        columns = [TeleIOColumn.concatenate(self.columns[j], table.columns[j]).take(order) for j in range(len(self.fields))]
+        return TeleIOTable(self.fields, columns, np.array(repOffsets, dtype=np.int64))
+
+    def getSizeBytes(self):
+        return self.repOffsets.nbytes + sum([c.getSizeBytes() for c in self.columns])
+
+
 class TeleIODict(dict): 
     '''
-    A representation of a BioSIM_API.teleIO instance that can be pickled and parsed. It handles the 
-    concatenation of various BioSIM_API.teleIO instances by updating the value corresponding to the
-    "text" key. This is done through the __merge__ function.
+    A representation of a BioSIM_API.teleIO instance that can be pickled and parsed. The text is parsed
+    once into a columnar TeleIOTable instance stored under the "table" key. The CSV, JSON and teleIO 
+    text are produced from this table. It handles the concatenation of various BioSIM_API.teleIO 
+    instances through the __merge__ function.
     '''
-    def __init__(self, obj : BioSIM_API.teleIO, dateYr, isWeatherGenerationOutput = True):
+    def __init__(self, obj : "BioSIM_API.teleIO", dateYr, isWeatherGenerationOutput = True):
         '''
             Convert the teleIO instance into a dict instance so that it can be sent back and forth to the sub processes
         '''
@@ -168,96 +775,82 @@ class TeleIODict(dict):
             self["metadata"] = obj.metadata
             self["msg"] = obj.msg
             if obj.msg == "Success":
-                if isWeatherGenerationOutput == False:
-                    self["lastDailyDate"] = dateYr
-                    self.__parseText__(obj.text, isWeatherGenerationOutput)
-                else:
-                    self.__parseText__(obj.text, isWeatherGenerationOutput, dateYr) ## here dateYr is the finalDate of the context
+                with Tracing.span("parseText"):
+                    if isWeatherGenerationOutput == False:
+                        self["lastDailyDate"] = dateYr
+                        self.__parseText__(obj.text, isWeatherGenerationOutput)
+                    else:
+                        self.__parseText__(obj.text, isWeatherGenerationOutput, dateYr) ## here dateYr is the finalDate of the context
 
        
     def __parseText__(self, text, isWeatherGenerationOutput, dateYr = None):
-        replications = list()
-        stringForThisRep = ""
+        '''
+        Parse the text once into a TeleIOTable instance. The header is repeated at the beginning of
+        each replication.
+        '''
         lines = text.split("\n")
-        repId = 0
-        for i in range(len(lines)):
-            if i == 0:
-                self["header"] = lines[i]
-                headerFields = self["header"].split(",")
-                indexYearField = headerFields.index("Year")
-            elif lines[i] == self["header"]:
-                replications.append(stringForThisRep)
-                stringForThisRep = ""
-                repId += 1
-            elif len(lines[i]) > 0:
-                myLine = lines[i]
-                values = myLine.split(",")
-                if isWeatherGenerationOutput == True:
-                    thisYear = int(values[indexYearField])
-                    if thisYear <= 0:
-                        values[indexYearField] = dateYr + thisYear
-                        myLine = self.__parseListToString__(values)
-                else: ## then it is a model output
-                    lastDailyDate = self["lastDailyDate"]
+        header = lines[0]
+        dataLines = list()
+        repOffsets = [0]
+        for line in lines[1:]:
+            if line == header:
+                repOffsets.append(len(dataLines))
+            elif len(line) > 0:
+                dataLines.append(line)
+        repOffsets.append(len(dataLines))
+        table = TeleIOTable.parse(header, dataLines, repOffsets)
+        yearColumn = table.getColumn("Year")
+        if isWeatherGenerationOutput == True:
+            if yearColumn.kind != "int":
+                raise Exception("The Year field should contain integers!")
+            years = yearColumn.values.astype(np.int64)
+            table.setColumn("Year", TeleIOColumn("int", TeleIOColumn.__shrinkIntegers__(np.where(years <= 0, years + dateYr, years))))
+        else: ## then it is a model output
+            nbReps = table.getNbReplications()
+            repIds = np.repeat(np.arange(nbReps), np.diff(table.repOffsets))
+            categories = ["Real_Data", "Real_Data/Simulated", "Simulated", "No year provided"]
+            if yearColumn.kind == "int":
+                codes = np.sign(yearColumn.values.astype(np.int64) - self["lastDailyDate"]) + 1
+            else:
+                codes = list()
+                for year in yearColumn.getStrings():
                     try:
-                        thisYear = int(values[indexYearField])
-                        if thisYear < lastDailyDate:
-                            dataType = "Real_Data"
-                        elif thisYear == lastDailyDate: 
-                            dataType = "Real_Data/Simulated"
-                        else:
-                            dataType = "Simulated"
+                        codes.append(np.sign(int(year) - self["lastDailyDate"]) + 1)
                     except Exception:
-                        dataType = "No year provided"
-                    myLine = str(repId) + "," + myLine + "," + dataType
-                stringForThisRep += myLine + "\n"
-        replications.append(stringForThisRep)
-        if isWeatherGenerationOutput == False:
-            currentHeader = self["header"]
-            newHeader = "Rep," + currentHeader + ",DataType"
-            self["header"] = newHeader
-        self["replist"] = replications
-
-    def __parseListToString__(self, myList:list):
-        s = ""
-        for i in range(len(myList)):
-            s += str(myList[i])
-            if i < (len(myList) - 1):
-                s += ","
-        return s
+                        codes.append(3)
+                codes = np.array(codes, dtype=np.int64)
+            table = TeleIOTable(("Rep",) + table.fields + ("DataType",),
+                                [TeleIOColumn("int", TeleIOColumn.__shrinkIntegers__(repIds))] + table.columns + [TeleIOColumn("str", codes.astype(np.int8), categories = categories)],
+                                table.repOffsets)
+        self["table"] = table
+
+    def getHeader(self):
+        return self["table"].getHeader()
 
     def __getText__(self, isOutput = False):
+        return "".join(self.iterText(isOutput))
+
+    def iterText(self, isOutput = False, chunkSize = 10000):
+        '''
+        Yield the text by pieces of at most chunkSize rows. 
+        @param isOutput: True to have a single header (output for the client) or False to repeat the header for each replication (teleIO text)
+        '''
         if self.isValid():
-            outputStr = ""
-            rep = self["replist"]  
+            table = self["table"]
+            header = table.getHeader() + "\n"
             if isOutput == True:        ### then only one header
-                outputStr += self["header"] + "\n"
-            for i in range(len(rep)):
+                yield header
+            for i in range(table.getNbReplications()):
                 if isOutput == False:
-                    outputStr += self["header"] + "\n"
-                outputStr += rep[i]
-            return outputStr
+                    yield header
+                for text in table.iterRepText(i, chunkSize):
+                    yield text
         else:
-            return self["msg"]
+            yield self["msg"]
 
     def __setLastDailyDate__(self, date):
         self["lastDailyDate"] = date
         
-    def __parseToJSON__(self):
-        if self.isValid():
-            headerFields = self["header"].split(",")
-            mainDict = dict()
-            for i in range(len(self["replist"])):
-                mainDict.__setitem__(i, list())
-                thisRep = self["replist"][i]
-                lines = thisRep.split("\n")
-                for line in lines:
-                    values = line.split(",")
-                    mainDict.get(i).append(dict(zip(headerFields, values)))
-            return mainDict
-        else:
-            return self["msg"]
-        
     def getTeleIO(self):
         '''
         Re-convert a TeleIODict instance into a BioSIM_API.teleIO instance
@@ -268,18 +861,36 @@ class TeleIODict(dict):
     def isValid(self):
         return "Success" == self["msg"]
 
+    def getSizeBytes(self):
+        '''
+        Provide an estimate of the memory used by this instance in bytes
+        '''
+        size = 200      ### approximate overhead of the dict instance
+        for k in ["comment", "data", "metadata", "msg"]:
+            if self.__contains__(k):
+                size += len(self[k])
+        if self.__contains__("table"):
+            size += self["table"].getSizeBytes()
+        return size
+
     def __merge__(self, w):
         if self.isValid():  ### if the current msg is not Success we don't do anything
             if w.isValid(): ### if both msgs are equal to Success then merge
-                thisRepList = self["replist"]
-                thatRepList = w["replist"]
-                if isinstance(w, TeleIODict) == False or len(thisRepList) != len(thatRepList):
-                    raise("The w argument should be a WeatherGeneratorLocation instance with the same number of replications!")
-                for i in range(len(thisRepList)):
-                    thisRepList[i] += thatRepList[i]    
+                if isinstance(w, TeleIODict) == False or self["table"].getNbReplications() != w["table"].getNbReplications():
+                    raise Exception("The w argument should be a TeleIODict instance with the same number of replications!")
+                self["table"] = self["table"].merge(w["table"])     ### a new table so that the clones of this instance are not affected
             else:
                 self["msg"] = w["msg"]      # update the current TeleIODict instance with the new message of failure
 
+    @staticmethod
+    def createErrorInstance(msg : str):
+        '''
+        Create a TeleIODict instance that only reports a failure. Such an instance is not valid.
+        '''
+        teleIODict = TeleIODict(None, None, False)  ### to get an empty instance
+        teleIODict["msg"] = msg
+        return teleIODict
+
     def clone(self):
         teleIODict = TeleIODict(None, None, False)  ### to get an empty instance
         for k in self.keys():
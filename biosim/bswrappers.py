@@ -5,18 +5,20 @@ instantiate several BioSim applications with different contexts
 @author: M. Fortin and R. Saint-Amant, Canadian Forest Service, August 2020
 @copyright: Her Majesty the Queen in right of Canada
 '''
-from datetime import datetime
-from multiprocessing import Process, Queue
+from multiprocessing import Queue, SimpleQueue
 from threading import Lock
+import time
 
-from biosim.bssettings import Context, Settings
+from biosim.bsbackend import BioSIM_API
+from biosim.bssettings import Context, CurrentDaily, Settings
 from biosim.bsrequest import NormalsRequest, AbstractRequest, WeatherGeneratorRequest 
-from biosim.bsutility import TeleIODictList, TeleIODict
+from biosim.bsutility import TeleIODictList, TeleIODict, BioSimUtility
+from biosim.bspool import WorkerPool, LazyComponent
+from biosim.bstracing import Tracing
  
-import biosim.biosimdll.BioSIM_API as BioSIM_API
 
 
-def do_job(context : Context, tasks_to_accomplish : Queue, tasks_that_are_done : Queue):
+def do_job(workerId, context : Context, tasks_to_accomplish : Queue, tasks_that_are_done : SimpleQueue):
     '''
         This function is passed to a Process instance.
         
@@ -27,13 +29,15 @@ def do_job(context : Context, tasks_to_accomplish : Queue, tasks_that_are_done :
         Without conversion there would be a pickled exception. The dict are reconverted into teleIO object in the
         main process. 
         
+        The messages follow the protocol of the WorkerPool class.
+        
         The code of this function was inspired by an example available on the JournalDev website at
         https://www.journaldev.com/15631/python-multiprocessing-example . We are thankful to the authors.
     '''
     WG = BioSIM_API.WeatherGenerator(context.getContextName())
     initializationString = context.getInitializationString()
     msg = WG.Initialize(initializationString);
-    tasks_that_are_done.put(msg)
+    tasks_that_are_done.put({"init" : workerId, "msg" : msg})
     if msg != "Success":
         return ### we get out of the process, the msg has been sent to the main thread anyway
 #     else:
@@ -41,134 +45,288 @@ def do_job(context : Context, tasks_to_accomplish : Queue, tasks_that_are_done :
 #             print("Successfully loaded context: " + context.getContextName())
     
     while True:
+        task = tasks_to_accomplish.get()
+        tag = {"workerId" : workerId, 
+               "reqId" : task["reqId"],     ### the request id so that the instance is routed to the proper request
+               "natOrd" : task["natOrd"]}   ### the natural order to sort the instances upon reception in the main process
+        tasks_that_are_done.put(dict(tag, started = True))
+        trace = Tracing.start()     ### the spans of the worker are sent back to the main process
         try:
-            task = tasks_to_accomplish.get()
-            naturalOrder = task["natOrd"]
             request = task["request"]
-            finalDateYr = task["finalDateYr"]
-            outputTeleIOobj = WG.Generate(request)
-            teleIODict = TeleIODict(outputTeleIOobj, finalDateYr)   ### conversion in a dict instance to avoid pickled exception
-            teleIODict["natOrd"] = naturalOrder   ### adding the natural order to sort the instances upon reception in the main process
-            tasks_that_are_done.put(teleIODict)
-        except:
-            break;
-    return True
+            if task.get("normals", False):
+                with Tracing.span("GetNormals"):
+                    outputTeleIOobj = WG.GetNormals(request)
+                teleIODict = BioSimUtility.convertTeleIOToDict(outputTeleIOobj)   ### conversion in a dict instance to avoid pickled exception
+            else:
+                finalDateYr = task["finalDateYr"]
+                with Tracing.span("Generate"):
+                    outputTeleIOobj = WG.Generate(request)
+                teleIODict = TeleIODict(outputTeleIOobj, finalDateYr)   ### conversion in a dict instance to avoid pickled exception
+            teleIODict.update(tag)
+            teleIODict["spans"] = trace.getSpans()
+        except Exception as error:
+            teleIODict = dict(tag, error = "Error: " + str(error))
+        tasks_that_are_done.put(teleIODict)
 
 
 
-class BioSimNormalsAndWeatherGeneratorWrapper:
+class BioSimNormalsAndWeatherGeneratorWrapper(LazyComponent):
     '''
     A wrapper for the BioSim normals or weather generator in C++
     '''
     
-    def __init__(self, context : Context):
+    def __init__(self, context : Context, lazy = False):
         '''
         Constructor
         @param context: a BioSimContext instance that defines how BioSim is initialized 
+        @param lazy: True to defer the initialization of the BioSim instance until it is first used
         @raise exception: if the BioSim instance in C++ cannot be initialized
         '''
+        LazyComponent.__init__(self, context.getContextName())
         self.context = context
         self.lock = Lock()
+        self.pool = None
+        self.WG = None
+        if lazy == False:
+            self.ensureLoaded()
+
+    def load(self):
+        context = self.context
         if context.isMultiProcessEnabled():
-            self.tasksToDo = Queue()
-            self.tasksDone = Queue()
-            self.processes = self.initializeProcesses(context, self.tasksToDo, self.tasksDone)
+            self.pool = self.initializePool(context)
             if Settings.Verbose == True:
-                print("Successfully loaded context: " + context.getContextName() + " (" + str(len(self.processes)) + " processes)")
+                print("Successfully loaded context: " + context.getContextName() + " (" + str(self.pool.getNbProcesses()) + " processes)")
         else:
-            self.WG = BioSIM_API.WeatherGenerator(context.getContextName())
-            initializationString = context.getInitializationString()
-            msg = self.WG.Initialize(initializationString);
-            if msg != "Success":
-                raise Exception(msg)
-            else:
-                if Settings.Verbose == True:
-                    print("Successfully loaded context: " + context.getContextName())
+            self.WG = BioSimNormalsAndWeatherGeneratorWrapper.createWeatherGenerator(context)
+            if Settings.Verbose == True:
+                print("Successfully loaded context: " + context.getContextName())
 
+    def unload(self):
+        if self.context.isMultiProcessEnabled():
+            self.pool.terminate()
+            self.pool = None
+        else:
+            self.WG = None
 
-    def initializeProcesses(self, context : Context, tasksToDo : Queue, tasksDone : Queue):
-        processes = []
-        for i in range(context.getNbProcesses()):  
-            p = Process(target=do_job, args = (context, tasksToDo, tasksDone))
-            processes.append(p)
-            p.start()
-            msg = tasksDone.get()
-            if msg != "Success":
-                raise Exception(msg)
-        return processes
+    def initializePool(self, context : Context):
+        pool = WorkerPool(context.getContextName(), do_job, (context,), context.getNbProcesses())
+        pool.start()
+        return pool
 
     def getContext(self):
         return self.context
 
-    def respawn(self):
-        context = self.context
-        print("Carrying out the respawning...")
-        if context.isMultiProcessEnabled():
-            tasksToDo = Queue()
-            tasksDone = Queue()
-            processes = self.initializeProcesses(context, tasksToDo, tasksDone)
-#             for i in range(context.getNbProcesses()):  
-#                 p = Process(target=do_job, args = (context, tasksToDo, tasksDone))
-#                 processes.append(p)
-#                 p.start()
-            self.lock.acquire()
-            formerProcesses = self.processes
-            self.processes = processes
-            self.tasksToDo = tasksToDo
-            self.tasksDone = tasksDone
-            self.lock.release()
-            for p in formerProcesses:
-                p.terminate()
-                
-            #### TODO should the weather generator instance be somehow finalized.....? MF20200928
-        else:
-            WG = BioSIM_API.WeatherGenerator(context.getContextName())
-            initializationString = context.getInitializationString()
-            msg = WG.Initialize(initializationString);
-            if msg != "Success":
-                raise Exception(msg)
-            else:
-                self.lock.acquire()
-                self.WG = WG
-                self.lock.release()
-                print("Successfully loaded context: " + context.getContextName())
-        currentTime = datetime.now().time()
-        print("Respawn successfully terminated at", currentTime)
+    def getNbProcesses(self):
+        return self.context.getNbProcesses()
+
+    @staticmethod
+    def createWeatherGenerator(context : Context):
+        '''
+        Create and initialize a BioSim instance in the main process.
+        @raise exception: if the BioSim instance cannot be initialized
+        '''
+        WG = BioSIM_API.WeatherGenerator(context.getContextName())
+        initializationString = context.getInitializationString()
+        msg = WG.Initialize(initializationString);
+        if msg != "Success":
+            raise Exception(msg)
+        return WG
 
-    def doProcess(self, bioSimRequest : AbstractRequest):
+    def doProcess(self, bioSimRequest : AbstractRequest, indices = None):
         '''
         Process the request whether it is a request for normals or weather generation. The
         class of the AbstractRequest instance allows distinguishing the type of request. 
-        Return a list of teleIO objects.
+        Return a list of teleIO objects. The context is loaded first if needed.
+        @param indices: an optional list of location indices for normals requests (by default all the locations are processed)
         '''
+        self.beginUse()
+        try:
+            return self.__doProcess__(bioSimRequest, indices)
+        finally:
+            self.endUse()
+
+    async def doProcessAsync(self, bioSimRequest : AbstractRequest, indices = None):
+        '''
+        The counterpart of the doProcess method in the async mode. In multiprocess mode, the coroutine waits
+        for the worker processes without holding a thread. Otherwise, the request is processed in a thread 
+        since the calls to the BioSim instance are blocking.
+        '''
+        if not self.context.isMultiProcessEnabled():
+            return await self.runInThread(self.doProcess, bioSimRequest, indices)
+        await self.runInThread(self.beginUse)     ### the component may have to be loaded and its lock may be held by another thread
+        try:
+            futures = self.pool.submit(self.createTasks(bioSimRequest, indices))
+            await WorkerPool.waitAsync(futures)
+            return self.collectOutputs(bioSimRequest, futures, time.time())    ### the waiting is over
+        finally:
+            self.endUse()
+
+    def createTasks(self, bioSimRequest : AbstractRequest, indices):
+        '''
+        Create the tasks sent to the worker processes, one per location.
+        '''
+        tasks = list()
         if isinstance(bioSimRequest, NormalsRequest):
-            teleIODictList = [] #### TODO fix this as well
+            if indices is None:
+                indices = range(bioSimRequest.n)
+            for i in indices:
+                d = dict()
+                d["request"] = bioSimRequest.parseRequest(i, self.context)
+                d["normals"] = True
+                tasks.append(d)
+        elif isinstance(bioSimRequest, WeatherGeneratorRequest):
             for i in range(bioSimRequest.n):
-                teleIODictList.append(self.WG.GetNormals(bioSimRequest.parseRequest(i, self.context))) 
+                d = dict()
+                d["request"] = bioSimRequest.parseRequest(i, self.context)
+                d["finalDateYr"] = bioSimRequest.getDatesYr(self.context)[1]
+                tasks.append(d)
+        return tasks
+
+    def collectOutputs(self, bioSimRequest : AbstractRequest, futures : list, deadline = None):
+        '''
+        Retrieve the outputs of the worker processes. The failure of a task does not affect the others: its 
+        output is then an invalid teleIO or TeleIODict instance that contains the error message.
+        @param deadline: the time until which the outputs are awaited (see the WorkerPool.getDeadline method), by default from now on
+        '''
+        if deadline is None:
+            deadline = WorkerPool.getDeadline()
+        if isinstance(bioSimRequest, NormalsRequest):
+            teleIODictList = []
+            for future in futures:
+                try:
+                    teleIODictList.append(BioSimUtility.convertDictToTeleIO(WorkerPool.getResult(future, deadline)))
+                except Exception as error:
+                    teleIODictList.append(BioSIM_API.teleIO(False, str(error), "", "", "", ""))
+        else:
+            teleIODictList = TeleIODictList()
+            for future in futures:
+                try:
+                    teleIODictList.append(WorkerPool.getResult(future, deadline))
+                except Exception as error:
+                    teleIODictList.append(TeleIODict.createErrorInstance(str(error)))
+        return teleIODictList
+
+    def __doProcess__(self, bioSimRequest : AbstractRequest, indices):
+        if isinstance(bioSimRequest, NormalsRequest):
+            if indices is None:
+                indices = range(bioSimRequest.n)
+            teleIODictList = [] #### TODO fix this as well
+            if (self.context.isMultiProcessEnabled()):
+                teleIODictList = self.collectOutputs(bioSimRequest, self.pool.submit(self.createTasks(bioSimRequest, indices)))
+            else:
+                with Tracing.span("lockWait"):
+                    self.lock.acquire()     ### The C++ instance is shared by all the threads
+                try:
+                    for i in indices:
+                        request = bioSimRequest.parseRequest(i, self.context)
+                        with Tracing.nativeCall(self.componentName, "GetNormals"):
+                            teleIODictList.append(self.WG.GetNormals(request))
+                finally:
+                    self.lock.release()
         elif isinstance(bioSimRequest, WeatherGeneratorRequest):
             teleIODictList = TeleIODictList()
             if (self.context.isMultiProcessEnabled()):
-                mainDict = dict()
-                self.lock.acquire()     ### To avoid concurrent feeding of the taskToDo queue
-                for i in range(bioSimRequest.n):
-                    d = dict()
-                    d["natOrd"] = i
-                    d["request"] = bioSimRequest.parseRequest(i, self.context)
-                    d["finalDateYr"] = bioSimRequest.getDatesYr(self.context)[1]
-                    self.tasksToDo.put(d)
-                for i in range(bioSimRequest.n):
-                    teleIODict = self.tasksDone.get()
-                    naturalOrder = teleIODict["natOrd"]
-                    del teleIODict["natOrd"]
-                    mainDict[naturalOrder] = teleIODict
-                self.lock.release()      ### release the lock for other threads
-                for i in range(bioSimRequest.n):
-                    teleIODictList.append(mainDict[i])  
+                teleIODictList = self.collectOutputs(bioSimRequest, self.pool.submit(self.createTasks(bioSimRequest, indices)))
             else:
-                for i in range(bioSimRequest.n):
-                    WGout = self.WG.Generate(bioSimRequest.parseRequest(i, self.context))
-                    datesYr = bioSimRequest.getDatesYr(self.context)
-                    teleIODictList.append(TeleIODict(WGout, datesYr[1]))
+                with Tracing.span("lockWait"):
+                    self.lock.acquire()     ### The C++ instance is shared by all the threads
+                try:
+                    for i in range(bioSimRequest.n):
+                        request = bioSimRequest.parseRequest(i, self.context)
+                        with Tracing.nativeCall(self.componentName, "Generate"):
+                            WGout = self.WG.Generate(request)
+                        datesYr = bioSimRequest.getDatesYr(self.context)
+                        teleIODictList.append(TeleIODict(WGout, datesYr[1]))
+                finally:
+                    self.lock.release()
         return teleIODictList
 
-        
+
+class StandbyInstance():
+    '''
+    A new instance of the weather generator of a wrapper that loads the latest daily database from
+    the other directory (blue/green swap). It is loaded and warmed with a probe request while the 
+    current instance keeps serving the requests. It then replaces the current instance at once and 
+    the former instance is released once the requests in progress are completed.
+    '''
+
+    ProbeParameters = {"lat" : "46.81", "long" : "-71.22"}     ### Quebec City, within the extent of the database
+
+    def __init__(self, wrapper : BioSimNormalsAndWeatherGeneratorWrapper, currentDaily : CurrentDaily):
+        self.wrapper = wrapper
+        self.currentDaily = currentDaily
+        self.context = wrapper.getContext().withCurrentDaily(currentDaily)
+        self.pool = None
+        self.WG = None
+        self.former = None
+
+    def load(self):
+        '''
+        Load the new instance unless the wrapper is not loaded, in which case its next use loads the new database.
+        @raise exception: if the new instance cannot be loaded
+        '''
+        if self.wrapper.isLoaded():
+            if self.context.isMultiProcessEnabled():
+                self.pool = self.wrapper.initializePool(self.context)
+            else:
+                self.WG = BioSimNormalsAndWeatherGeneratorWrapper.createWeatherGenerator(self.context)
+
+    def probe(self):
+        '''
+        Generate the weather of the last year of the database at a single location with the new instance.
+        @raise exception: if the generation fails
+        '''
+        if self.pool is None and self.WG is None:
+            return
+        finalDateYr = self.context.daily.getFinalDateYr()
+        d = dict(StandbyInstance.ProbeParameters)
+        d["from"] = str(finalDateYr)
+        d["to"] = str(finalDateYr)
+        bioSimRequest = WeatherGeneratorRequest(d)
+        context = self.wrapper.getContext()     ### the tasks are created with the context of the wrapper, which has the same time interval
+        bioSimRequest.doesThisContextMatch(context)
+        if self.pool is not None:
+            output = self.wrapper.collectOutputs(bioSimRequest, self.pool.submit(self.wrapper.createTasks(bioSimRequest, None)))[0]
+            msg = output["msg"]
+        else:
+            msg = self.WG.Generate(bioSimRequest.parseRequest(0, context)).msg
+        if msg != "Success":
+            raise Exception("The probe request failed on " + self.context.getContextName() + ": " + msg)
+
+    def switch(self):
+        '''
+        Replace the current instance of the wrapper. Later loads and respawns of the wrapper use the new database.
+        '''
+        wrapper = self.wrapper
+        wrapper.initLock.acquire()
+        try:
+            if not wrapper.isLoaded() or (self.pool is None and self.WG is None):
+                self.former = self.pool   ### the wrapper has been unloaded in the meantime
+            elif self.pool is not None:
+                self.former = wrapper.pool
+                wrapper.pool = self.pool
+            else:
+                wrapper.lock.acquire()      ### the calls to the former instance are completed since they hold the lock
+                self.former = wrapper.WG
+                wrapper.WG = self.WG
+                wrapper.lock.release()
+            wrapper.getContext().currentDaily = self.currentDaily
+        finally:
+            wrapper.initLock.release()
+
+    def drain(self):
+        '''
+        Wait until the requests in progress on the former instance are completed and release it.
+        '''
+        if isinstance(self.former, WorkerPool):
+            self.former.shutdown(self.pool if self.former is not self.pool else None)
+        self.former = None
+
+    def discard(self):
+        '''
+        Release the new instance if the swap is abandoned.
+        '''
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+        self.WG = None
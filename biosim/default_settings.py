@@ -1,9 +1,58 @@
 # Default configuration for BioSIM web API 
+import os
+
 VERBOSE = True
 MULTIPROCESS_MODE = False
 PRODUCTION_MODE = False
 UPDATER_ENABLED = False
+UPDATER_CHECK_INTERVAL_SEC = 3600                   # the updater checks for a new day at this interval and then swaps the latest daily database without interruption
 MINIMAL_CONFIG = True
 NB_MAX_COORDINATES_NORMALS = 50
 NB_MAX_COORDINATES_WG = 10
 PORT = 5000
+NB_PROCESSES_NORMALS = 2                            # number of processes per normals context in multiprocess mode
+STARTUP_PARALLELISM = 4                             # maximum number of multi-process contexts and models initialized concurrently at startup
+LAZY_LOADING = False                                # True to load the contexts and the models on first use
+WARM_COMPONENTS = []                                # in lazy mode, the context names (e.g. Shore1-CanUSA1981_2010-WorldWide30sec-HRDPS_daily) and model names (e.g. DegreeDay_Annual) loaded at boot
+IDLE_UNLOAD_DELAY_SEC = 0                           # in lazy mode, the components that are idle for longer are unloaded (0 means never), except the warm ones
+WORKER_SUPERVISION_INTERVAL_SEC = 5                 # the worker processes are checked at this interval
+WORKER_TASK_TIMEOUT_SEC = 900                       # a worker process busy on the same task for longer is replaced (0 disables the timeout)
+WORKER_RESULT_TIMEOUT_SEC = 3600                    # a request waits at most this long for the result of a worker task (0 disables the timeout)
+WORKER_MAX_RESPAWNS = 5                             # a worker process that fails to initialize is respawned with an exponential backoff and given up after this number of attempts
+NB_THREADS_CONTEXTS = 8                             # number of threads that process the matching contexts of weather generation requests concurrently
+NORMALS_CACHE_ENABLED = True
+NORMALS_CACHE_MAX_ENTRIES = 100000                  # maximum number of locations kept in the normals cache
+NORMALS_CACHE_TTL_SEC = 86400                       # 0 means the entries never expire
+NORMALS_CACHE_COORDINATE_TOLERANCE = 0.00001        # in degrees: latitudes and longitudes are rounded to this tolerance
+NORMALS_CACHE_ELEVATION_TOLERANCE = 1               # in m
+WGOUT_LIBRARY_MAX_BYTES = 4 * 1024 ** 3             # memory budget of the library of wgout instances: the least recently used are evicted first
+WGOUT_LIBRARY_MAX_ENTRIES = 100000                  # maximum number of wgout instances in the library
+WGOUT_LIBRARY_TTL_SEC = 0                           # a wgout instance unused for longer expires (0 means the instances never expire)
+WGOUT_STORE = "memory"                              # either memory or sqlite: the sqlite store survives restarts and can be shared by several server processes
+WGOUT_STORE_FILENAME = None                         # the database file of the sqlite store (None means data/wgout.sqlite in the package directory)
+WGOUT_STORE_HOT_MAX_BYTES = 512 * 1024 ** 2         # memory budget of the recently used instances kept in RAM by the sqlite store
+WGOUT_STORE_MMAP_SIZE_BYTES = 1024 ** 3             # maximum number of bytes of the sqlite database that are memory-mapped
+STREAMING_ENABLED = False                           # True to stream the CSV and JSON outputs of the models location by location and replication by replication (an error in the middle of a stream then truncates a 200 response)
+STREAMING_CHUNK_SIZE = 10000                        # maximum number of rows in each piece of a streamed response
+JOBS_NB_THREADS = 2                                 # number of jobs processed concurrently in the background
+JOBS_MAX_PENDING = 20                               # maximum number of jobs queued or running: the submissions beyond are rejected with a 503 status
+JOBS_MAX_COORDINATES = 100000                       # maximum number of coordinates in a job
+JOBS_TTL_SEC = 86400                                # the outputs of a finished job are discarded after this delay
+JOBS_MAX_BYTES = 10 * 1024 ** 3                     # maximum size of the outputs of the jobs on disk: the submissions beyond are rejected with a 503 status
+JOBS_DIRECTORY = None                               # the outputs of the jobs are written in this directory (None means data/jobs in the package directory)
+COALESCING_ENDPOINTS = []                           # the concurrent identical requests to these endpoints (BioSimNormals, BioSimModel, BioSimModelEphemeral, BioSimWG) share a single computation (the stochastic runs only if seeded)
+SERVER_TIMING_ENABLED = True                        # the time spent in each phase of a request is reported in a Server-Timing header
+SLOW_REQUEST_LOG_THRESHOLD_SEC = 0                  # the requests that last longer are logged with the time spent in each phase (0 disables the log)
+SLOW_REQUEST_LOG_SAMPLE_RATE = 1.                   # proportion of the slow requests that are logged
+SLOW_REQUEST_LOG_FILENAME = None                    # the slow requests are logged in this file, one JSON record per line (None means they are printed)
+BACKEND = os.environ.get("BIOSIM_BACKEND", "native")   # either native (the BioSIM_API extension, Windows only) or simulator (synthetic outputs in pure Python); the BIOSIM_BACKEND environment variable sets the default
+SIMULATOR_NORMALS_LATENCY_SEC = .005                # with the simulator backend, the latency of each request for normals
+SIMULATOR_GENERATE_LATENCY_SEC = .0002              # with the simulator backend, the latency of the weather generation per year and replication
+SIMULATOR_EXECUTE_LATENCY_SEC = .0001               # with the simulator backend, the latency of a model per year and replication
+NB_FRONTENDS = 1                                    # number of HTTP front-end processes: beyond 1, the server runs in a broker process and the wgout store must be sqlite
+FRONTEND_REUSE_PORT = True                          # the front ends share the port if SO_REUSEPORT is available, otherwise they listen on consecutive ports from PORT
+BROKER_PORT = 0                                     # the port of the broker on the loopback interface (0 means any free port)
+ASYNC_MODE = False                                  # True to serve the requests with an ASGI server (uvicorn) whose coroutines wait for the worker processes without holding a thread
+ASYNC_MAX_REQUESTS_IN_PROGRESS = 1000               # in async mode, maximum number of requests for normals, weather generation and models processed concurrently
+ASYNC_MAX_REQUESTS_WAITING = 1000                   # in async mode, maximum number of requests waiting beyond those in progress: the others are rejected with a 503 status
+ASYNC_MAX_BODY_BYTES = 16 * 1024 ** 2               # in async mode, maximum size of the body of a request: the larger bodies are rejected with a 413 status
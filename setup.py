@@ -15,8 +15,9 @@ setup(
     maintainer="Mathieu Fortin",
     maintainer_email="mathieu.fortin.re@gmail.com",
     description="A web service for climate variables and pest development stages.",
-    packages=find_packages(),
+    packages=find_packages(exclude=["benchmarks", "benchmarks.*"]),
     include_package_data=True,
     zip_safe=False,
-    install_requires=["flask", "waitress", "itsdangerous", "jinja2", "markupsafe", "six", "werkzeug", "paste"],
+    install_requires=["flask", "waitress", "itsdangerous", "jinja2", "markupsafe", "six", "werkzeug", "paste", "numpy"],
+    extras_require={"monitoring": ["psutil"], "async": ["uvicorn"]},
 )
\ No newline at end of file
@@ -0,0 +1,44 @@
+'''
+Tests of the admission of the requests in the async mode.
+
+@author: M. Fortin and R. Saint-Amant, Canadian Forest Service, August 2020
+@copyright: Her Majesty the Queen in right of Canada
+'''
+import asyncio
+
+from biosim.bsasgi import BsAsgiApp
+from biosim.bssettings import Settings
+
+
+def serve(app : BsAsgiApp, headers : list, messages : list):
+    '''
+    Serve a POST request to the BioSimNormals endpoint.
+    @return: the messages sent by the application and the number of messages it received
+    '''
+    sent = list()
+    received = list()
+    async def receive():
+        received.append(messages[len(received)])
+        return received[-1]
+    async def send(message):
+        sent.append(message)
+    scope = {"type" : "http", "method" : "POST", "path" : "/BioSimNormals", "query_string" : b"", "headers" : headers}
+    asyncio.run(app(scope, receive, send))
+    return sent, len(received)
+
+
+def testBusyServerDoesNotReadTheBody(monkeypatch):
+    monkeypatch.setattr(Settings, "asyncMaxRequestsInProgress", 0)
+    monkeypatch.setattr(Settings, "asyncMaxRequestsWaiting", 0)
+    sent, nbReceived = serve(BsAsgiApp(None), [], [{"type" : "http.request", "body" : b"lat=45", "more_body" : False}])
+    assert sent[0]["status"] == 503 and nbReceived == 0
+
+
+def testBodySizeIsBounded(monkeypatch):
+    monkeypatch.setattr(Settings, "asyncMaxBodyBytes", 10)
+    sent, nbReceived = serve(BsAsgiApp(None), [(b"content-length", b"11")], [])
+    assert sent[0]["status"] == 413 and nbReceived == 0
+    messages = [{"type" : "http.request", "body" : b"lat=45", "more_body" : True},
+                {"type" : "http.request", "body" : b"&long=-74", "more_body" : False}]
+    sent, nbReceived = serve(BsAsgiApp(None), [], messages)
+    assert sent[0]["status"] == 413 and nbReceived == 2
@@ -0,0 +1,71 @@
+'''
+Tests of the asynchronous jobs.
+
+@author: M. Fortin and R. Saint-Amant, Canadian Forest Service, August 2020
+@copyright: Her Majesty the Queen in right of Canada
+'''
+import os
+import time
+
+import pytest
+
+from biosim.bsjobs import JobScheduler, JobSchedulerBusyException, Done
+from biosim.bssettings import Settings
+from biosim.bsutility import TeleIODictList
+
+from test_bsutility import createTeleIODict, Rep0, Rep1
+
+
+class FakeServer():
+    '''
+    A server whose weather generation returns the same output for every location.
+    '''
+
+    def doWeatherGeneration(self, bioSimRequest):
+        return TeleIODictList([createTeleIODict([Rep0, Rep1]) for i in range(bioSimRequest.n)])
+
+
+@pytest.fixture
+def scheduler(monkeypatch, tmp_path):
+    monkeypatch.setattr(Settings, "jobsDirectory", str(tmp_path))
+    monkeypatch.setattr(Settings, "nbMaxCoordinatesWG", 2)
+    scheduler = JobScheduler(FakeServer())
+    yield scheduler
+    scheduler.executor.shutdown()
+
+
+Parameters = {"lat" : "45 46 47", "long" : "-74 -73 -72", "from" : "2021", "to" : "2021"}
+
+
+def submitAndWait(scheduler):
+    job = scheduler.submit("WG", dict(Parameters))
+    while not job.isFinished():
+        time.sleep(.01)
+    return job
+
+
+def testChunkOutputsAreWrittenOnDisk(scheduler):
+    job = submitAndWait(scheduler)
+    assert job.state == Done and job.getNbChunks() == 2 and len(job.errors) == 0
+    assert all([os.path.exists(filename) for filename in job.outputFiles])
+    assert scheduler.nbBytes == job.nbBytes > 0
+    text = "".join(job.iterChunkOutput(1, "CSV"))
+    assert text == createTeleIODict([Rep0, Rep1]).__getText__(True)
+
+
+def testExpiredJobsReleaseTheirBytes(scheduler, monkeypatch):
+    job = submitAndWait(scheduler)
+    monkeypatch.setattr(Settings, "jobsTTLSec", -1)
+    with pytest.raises(Exception):
+        scheduler.getJob(job.jobId)
+    assert scheduler.nbBytes == 0
+    assert os.listdir(scheduler.directory) == []
+
+
+def testByteBudget(scheduler, monkeypatch):
+    monkeypatch.setattr(Settings, "jobsMaxBytes", 1)
+    job = submitAndWait(scheduler)
+    assert len(job.errors) == 2 and "budget" in job.errors[0]
+    scheduler.nbBytes = 1
+    with pytest.raises(JobSchedulerBusyException):
+        scheduler.submit("WG", dict(Parameters))
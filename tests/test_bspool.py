@@ -0,0 +1,106 @@
+'''
+Tests of the WorkerPool class.
+
+@author: M. Fortin and R. Saint-Amant, Canadian Forest Service, August 2020
+@copyright: Her Majesty the Queen in right of Canada
+'''
+from concurrent.futures import Future
+import asyncio
+import os
+import time
+
+import pytest
+
+from biosim.bspool import WorkerPool
+from biosim.bssettings import Settings
+
+
+def double(workerId, delaySec, tasks_to_accomplish, tasks_that_are_done):
+    '''
+    A worker that doubles the value of the tasks. A task with a "die" entry makes the process exit
+    before or after it reports that it started the task.
+    '''
+    tasks_that_are_done.put({"init" : workerId, "msg" : "Success"})
+    while True:
+        task = tasks_to_accomplish.get()
+        if task.get("die") == "beforeStarted":
+            os._exit(3)
+        tag = {"workerId" : workerId, "reqId" : task["reqId"], "natOrd" : task["natOrd"]}
+        tasks_that_are_done.put(dict(tag, started = True))
+        if task.get("die") == "afterStarted":
+            os._exit(4)
+        time.sleep(delaySec)
+        tasks_that_are_done.put(dict(tag, value = task["value"] * 2))
+
+
+def failToRespawn(workerId, flagFilename, tasks_to_accomplish, tasks_that_are_done):
+    '''
+    A worker that fails to initialize once the flag file exists and that dies on its first task.
+    '''
+    if os.path.exists(flagFilename):
+        tasks_that_are_done.put({"init" : workerId, "msg" : "Error: cannot initialize"})
+        return
+    tasks_that_are_done.put({"init" : workerId, "msg" : "Success"})
+    tasks_to_accomplish.get()
+    os._exit(3)
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    monkeypatch.setattr(Settings, "workerSupervisionIntervalSec", 0.1)
+    pool = WorkerPool("test", double, (0.05,), 2)
+    pool.start()
+    yield pool
+    pool.terminate()
+
+
+def testProcess(pool):
+    assert pool.process([{"value" : i} for i in range(5)]) == [{"value" : 2 * i} for i in range(5)]
+
+
+@pytest.mark.parametrize("die", ["beforeStarted", "afterStarted"])
+def testWorkerCrashFailsItsFuture(pool, die):
+    futures = pool.submit([{"value" : 1}, {"value" : 2, "die" : die}, {"value" : 3}])
+    assert futures[0].result(10) == {"value" : 2}
+    with pytest.raises(Exception, match = "terminated unexpectedly"):
+        futures[1].result(10)
+    assert futures[2].result(10) == {"value" : 6}
+    assert pool.nbRespawns == 1
+    assert pool.process([{"value" : 4}, {"value" : 5}]) == [{"value" : 8}, {"value" : 10}]
+
+
+def testGetResultTimeout(monkeypatch):
+    monkeypatch.setattr(Settings, "workerResultTimeoutSec", 0.1)
+    with pytest.raises(Exception, match = "not received within"):
+        WorkerPool.getResult(Future(), WorkerPool.getDeadline())
+
+
+def testWaitAsyncTimeout(monkeypatch):
+    monkeypatch.setattr(Settings, "workerResultTimeoutSec", 0.1)
+    done = Future()
+    done.set_result({"value" : 1})
+    futures = [done, Future()]
+    asyncio.run(WorkerPool.waitAsync(futures))
+    assert WorkerPool.getResult(futures[0], time.time()) == {"value" : 1}
+    with pytest.raises(Exception, match = "not received within"):
+        WorkerPool.getResult(futures[1], time.time())
+
+
+def testWorkerThatFailsToInitializeIsGivenUp(monkeypatch, tmp_path):
+    monkeypatch.setattr(Settings, "workerSupervisionIntervalSec", 0.05)
+    monkeypatch.setattr(Settings, "workerMaxRespawns", 3)
+    flagFilename = str(tmp_path / "flag")
+    pool = WorkerPool("test", failToRespawn, (flagFilename,), 1)
+    pool.start()
+    try:
+        open(flagFilename, "w").close()
+        futures = pool.submit([{"value" : 1}, {"value" : 2}])
+        with pytest.raises(Exception, match = "terminated unexpectedly"):
+            futures[0].result(10)
+        with pytest.raises(Exception, match = "degraded"):
+            futures[1].result(10)
+        assert pool.isDegraded() and pool.nbRespawns == 3
+        with pytest.raises(Exception, match = "degraded"):
+            pool.submit([{"value" : 3}])[0].result(0)
+    finally:
+        pool.terminate()
@@ -0,0 +1,22 @@
+'''
+Tests of the requests.
+
+@author: M. Fortin and R. Saint-Amant, Canadian Forest Service, August 2020
+@copyright: Her Majesty the Queen in right of Canada
+'''
+import pytest
+
+from biosim.bsrequest import ModelRequest
+
+
+def createModelRequest(d : dict):
+    bioSimRequest = ModelRequest.__new__(ModelRequest)     ### without the validation, which requires wgout instances in the library
+    bioSimRequest.dict = d
+    return bioSimRequest
+
+
+@pytest.mark.parametrize("d, isCoalescable", [({"model" : "Spruce_Budworm_Biology"}, True),
+                                               ({"model" : "Spruce_Budworm_Biology", "repmodel" : 5}, False),
+                                               ({"model" : "Spruce_Budworm_Biology", "repmodel" : 5, "seed" : 2}, True)])
+def testModelRequestsAreCoalescedOnlyIfDeterministic(d, isCoalescable):
+    assert createModelRequest(d).isCoalescable() == isCoalescable
@@ -0,0 +1,37 @@
+'''
+Tests of the coalescing of the requests by the Server class.
+
+@author: M. Fortin and R. Saint-Amant, Canadian Forest Service, August 2020
+@copyright: Her Majesty the Queen in right of Canada
+'''
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event
+import time
+
+from biosim.bsrequest import WeatherGeneratorRequest
+from biosim.bsserver import Server
+from biosim.bssettings import Settings
+from biosim.bsutility import BioSimUtility, SingleFlight, TeleIODictList, WgoutLibrary
+
+from test_bsutility import createTeleIODict, Rep0
+
+
+def testCoalescedWeatherGenerationIsRegisteredOnce(monkeypatch):
+    monkeypatch.setattr(Settings, "coalescingEndpoints", ["BioSimWG"])
+    monkeypatch.setattr(BioSimUtility, "library", WgoutLibrary(1024 ** 2, 100))
+    server = Server.__new__(Server)     ### without the contexts and the models
+    server.coalescer = SingleFlight()
+    released = Event()
+    def doWeatherGeneration(bioSimRequest):
+        released.wait(10)
+        return TeleIODictList([createTeleIODict([Rep0])])
+    server.doWeatherGeneration = doWeatherGeneration
+    parms = {"lat" : "45", "long" : "-74", "from" : "2021", "to" : "2021", "seed" : "1"}
+    with ThreadPoolExecutor(max_workers = 2) as executor:
+        futures = [executor.submit(server.handleRequest, "BioSimWG", WeatherGeneratorRequest(dict(parms))) for i in range(2)]
+        while server.coalescer.nbCoalesced == 0:
+            time.sleep(.01)
+        released.set()
+        keys = [future.result() for future in futures]
+    assert keys[0] == keys[1]
+    assert len(BioSimUtility.library) == 1
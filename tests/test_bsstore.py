@@ -0,0 +1,32 @@
+'''
+Tests of the SQLite wgout store.
+
+@author: M. Fortin and R. Saint-Amant, Canadian Forest Service, August 2020
+@copyright: Her Majesty the Queen in right of Canada
+'''
+from concurrent.futures import ThreadPoolExecutor
+
+from biosim.bsstore import SQLiteWgoutStore
+
+from test_bsutility import createTeleIODict, Rep0
+
+
+def testRegisterAndGet(tmp_path):
+    store = SQLiteWgoutStore(str(tmp_path / "wgout.sqlite"), 1024 ** 2, 10)
+    keys = store.register([createTeleIODict([Rep0])], "ns")
+    assert store.get(keys[0]).__getText__() == createTeleIODict([Rep0]).__getText__()
+    assert store.removeNamespace("ns") == 1
+    assert store.get(keys[0]) is None
+
+
+def testStatsAreCountedUnderConcurrency(tmp_path):
+    store = SQLiteWgoutStore(str(tmp_path / "wgout.sqlite"), 1024 ** 2, 10)
+    key = store.register([createTeleIODict([Rep0])])[0]
+    def getMany(k):
+        for i in range(200):
+            store.get(k)
+    with ThreadPoolExecutor(max_workers = 8) as executor:
+        for future in [executor.submit(getMany, key if i % 2 == 0 else "999") for i in range(8)]:
+            future.result()
+    stats = store.getStats()
+    assert stats["hits"] == 800 and stats["misses"] == 800
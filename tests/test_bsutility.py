@@ -0,0 +1,117 @@
+'''
+Tests of the columnar TeleIODict instances.
+
+@author: M. Fortin and R. Saint-Amant, Canadian Forest Service, August 2020
+@copyright: Her Majesty the Queen in right of Canada
+'''
+from types import SimpleNamespace
+import json
+import time
+
+import pytest
+
+from biosim.bsutility import TeleIODict, TeleIODictList, WgoutLibrary
+
+
+Header = "Year,Month,Day,Tmin,Tmax,Prcp,Source"
+
+Rep0 = ["2021,1,1,-12.5,-0.0,0.00,Real",
+        "2021,1,2,-8.1,2.3,12.75,Real",
+        "2021,1,3,0.0,10.0,3.10,Simulated"]
+
+Rep1 = ["2021,1,1,-11.0,1.5,0.50,Real",
+        "2021,1,2,-7.4,-3.2,0.00,Real",
+        "2021,1,3,1.0,9.9,100.25,Simulated"]
+
+
+def createTeleIODict(reps : list, dateYr = 2021):
+    text = "".join([Header + "\n" + "".join([line + "\n" for line in rep]) for rep in reps])
+    obj = SimpleNamespace(comment = "", compress = False, data = "", metadata = "", msg = "Success", text = text)
+    return TeleIODict(obj, dateYr)
+
+
+def testTextRoundTrip():
+    teleIODict = createTeleIODict([Rep0, Rep1])
+    table = teleIODict["table"]
+    assert table.getNbReplications() == 2
+    assert [table.getColumn(f).kind for f in ("Year", "Tmin", "Source")] == ["int", "float", "str"]
+    assert teleIODict.__getText__() == "".join([Header + "\n" + "".join([line + "\n" for line in rep]) for rep in (Rep0, Rep1)])
+    assert teleIODict.__getText__(True) == Header + "\n" + "".join([line + "\n" for line in Rep0 + Rep1])
+
+
+def testChunkedTextIsTheSame():
+    teleIODict = createTeleIODict([Rep0, Rep1])
+    assert "".join(teleIODict.iterText(True, 2)) == teleIODict.__getText__(True)
+
+
+def testRelativeYears():
+    teleIODict = createTeleIODict([["0,1,1,1.0,2.0,0.00,Real", "-1,1,1,1.0,2.0,0.00,Real"]], 2021)
+    assert teleIODict.__getText__(True) == Header + "\n2021,1,1,1.0,2.0,0.00,Real\n2020,1,1,1.0,2.0,0.00,Real\n"
+
+
+def testMergeKeepsTheReplications():
+    teleIODict = createTeleIODict([Rep0[:2], Rep1[:2]])
+    teleIODict.__merge__(createTeleIODict([Rep0[2:], Rep1[2:]]))
+    assert teleIODict.__getText__() == createTeleIODict([Rep0, Rep1]).__getText__()
+
+
+def testJSONRoundTrip():
+    teleIODictList = TeleIODictList([createTeleIODict([Rep0, Rep1]), TeleIODict.createErrorInstance("Error: failed")])
+    output = teleIODictList.parseToJSON()
+    assert output["1"] == "Error: failed"
+    assert len(output["0"]["0"]) == 3 and len(output["0"]["1"]) == 3
+    assert output["0"]["0"][1] == {"Year" : 2021, "Month" : 1, "Day" : 2, "Tmin" : -8.1, "Tmax" : 2.3, "Prcp" : 12.75, "Source" : "Real"}
+
+
+def testNonFiniteValuesAreNullInJSON():
+    teleIODictList = TeleIODictList([createTeleIODict([["2021,1,1,-12.5,nan,0.00,Real", "2021,1,2,-8.1,2.3,inf,Real"]])])
+    records = teleIODictList.parseToJSON()["0"]["0"]
+    assert records[0]["Tmax"] is None and records[1]["Prcp"] is None
+    assert records[1]["Tmax"] == 2.3
+    lines = "".join(teleIODictList.iterNDJSON()).splitlines()
+    assert [json.loads(line)["Tmax"] for line in lines] == [None, 2.3]
+
+
+class Output():
+    '''
+    A stand-in for a TeleIODict instance of a given size in the library.
+    '''
+
+    def __init__(self, size : int):
+        self.size = size
+
+    def getSizeBytes(self):
+        return self.size
+
+
+def testLibraryEvictsTheLeastRecentlyUsedEntries():
+    library = WgoutLibrary(300, 10)
+    keys = library.register([Output(100), Output(100), Output(100)])
+    assert library.get(keys[0]) is not None      ### the first entry becomes the most recently used
+    library.put("new", Output(100))
+    assert library.get(keys[1]) is None
+    assert all([library.get(k) is not None for k in (keys[0], keys[2], "new")])
+    assert library.getStats()["evictions"] == 1 and library.getStats()["bytes"] == 300
+
+
+def testLibraryMaxEntries():
+    library = WgoutLibrary(10000, 2)
+    keys = library.register([Output(1), Output(1), Output(1)])
+    assert len(library) == 2 and library.get(keys[0]) is None
+
+
+def testLibraryRejectsOutputsBeyondTheBudget():
+    library = WgoutLibrary(100, 10)
+    with pytest.raises(Exception):
+        library.register([Output(60), Output(60)])
+    assert len(library) == 0
+
+
+def testLibraryExpiredEntries():
+    library = WgoutLibrary(1000, 10, ttlSec = 0.05)
+    keys = library.register([Output(10), Output(10)])
+    time.sleep(0.1)
+    assert library.get(keys[0]) is None
+    library.register([Output(10)])
+    assert len(library) == 1
+    assert library.getStats()["expirations"] == 2